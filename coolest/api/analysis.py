@@ -1,10 +1,15 @@
 __author__ = 'aymgal', 'mattgomer', 'gvernard'
 
-import numpy as np
-from astropy.coordinates import SkyCoord
+import os
+import time
 import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
 from coolest.api.composable_models import *
+from coolest.api.chain_reader import get_chain_reader
+from coolest.api.cache import EvaluationCache, fingerprint
 from coolest.api import util
 
 # logging settings
@@ -32,57 +37,163 @@ class Analysis(object):
     supersampling : int, optional
         Supersampling factor (relative to the instrument pixel size)
         that defines the grid on which computations are performed, by default 1.
+    evaluation_cache : EvaluationCache or bool, optional
+        If True or an EvaluationCache instance, fields evaluated by a method 
+        (e.g. convergence or surface brightness maps) are memoized and re-used by 
+        other methods that need them on the same coordinates grid, by default True.
+
+    Composable models are also created once for each selection of profiles 
+    and re-used as long as the point estimates of the parameters do not change
+    (only the most recently used models are kept).
+    Call `clear_cache()` after modifying the COOLEST object in other ways 
+    (e.g. the pixels of pixelated profiles).
     """
 
-    def __init__(self, coolest_object, coolest_directory, supersampling=1):
+    # methods which compute a derived quantity, see `posterior_distribution()`
+    _posterior_quantities = ('effective_einstein_radius', 'effective_radial_slope', 
+                             'effective_radius_light', 'total_magnitude', 'ellipticity_from_moments')
+    _mass_quantities = ('effective_einstein_radius', 'effective_radial_slope')
+
+    # maximum number of cached composable models (least recently used ones are discarded)
+    _max_cached_models = 8
+
+    def __init__(self, coolest_object, coolest_directory, supersampling=1, evaluation_cache=True):
         self.coolest = coolest_object
         self.coolest_dir = coolest_directory
+        if evaluation_cache is True:
+            evaluation_cache = EvaluationCache()
+        elif evaluation_cache is False:
+            evaluation_cache = None
+        self.cache = evaluation_cache
+        self._models = OrderedDict()
         base_coordinates = util.get_coordinates(self.coolest)
         if supersampling > 1:
             self.coordinates = base_coordinates.create_new_coordinates(pixel_scale_factor=1./supersampling)
         else:
             self.coordinates = base_coordinates
 
-    def effective_einstein_radius(self, center=None, initial_guess=1, initial_delta_pix=10, 
-                                  n_iter=5, return_accuracy=False, max_loopcount=100, 
-                                  **kwargs_selection):
-        """Calculates Einstein radius for a kappa grid starting from an initial guess with large step size and zeroing in from there.
+    def __getstate__(self):
+        # cached models and fields are not copied (e.g. to worker processes)
+        state = self.__dict__.copy()
+        state['_models'] = OrderedDict()
+        if self.cache is not None:
+            state['cache'] = EvaluationCache(max_bytes=self.cache.max_bytes)
+        return state
+
+    def get_mass_model(self, **kwargs_selection):
+        """Returns the (cached) ComposableMassModel for a selection of profiles"""
+        return self._get_model(ComposableMassModel, kwargs_selection)
+
+    def get_light_model(self, **kwargs_selection):
+        """Returns the (cached) ComposableLightModel for a selection of profiles"""
+        return self._get_model(ComposableLightModel, kwargs_selection)
+
+    def clear_cache(self):
+        """Discards the cached composable models and evaluated fields"""
+        self._models.clear()
+        if self.cache is not None:
+            self.cache.clear()
+
+    def compute_metrics(self, metrics=None, kwargs_selection_lens_mass=None, 
+                        kwargs_selection_light=None, kwargs_metrics=None):
+        """Computes several derived quantities at once, such that fields shared 
+        by several of them (e.g. the surface brightness map used by `effective_radius_light()`,
+        `total_magnitude()` and `ellipticity_from_moments()`) are evaluated only once.
+
+        Parameters
+        ----------
+        metrics : list, optional
+            Names of the methods to call, by default None (all methods supported by 
+            `posterior_distribution()`, except `total_magnitude()` if the COOLEST object 
+            has no magnitude zero-point)
+        kwargs_selection_lens_mass : dict, optional
+            Selection of the mass profiles, passed to mass-related methods, by default None
+        kwargs_selection_light : dict, optional
+            Selection of the light profiles, passed to light-related methods, by default None
+        kwargs_metrics : dict, optional
+            Additional keyword arguments for each method, keyed by method name, by default None
+
+        Returns
+        -------
+        dict
+            Value of each metric, keyed by method name
+        """
+        if metrics is None:
+            metrics = list(self._posterior_quantities)
+            if self.coolest.observation.mag_zero_point is None:
+                metrics.remove('total_magnitude')
+        if kwargs_metrics is None:
+            kwargs_metrics = {}
+        results = {}
+        for metric in metrics:
+            if metric not in self._posterior_quantities:
+                raise ValueError(f"Metric '{metric}' is not supported "
+                                 f"(supported metrics are {self._posterior_quantities}).")
+            if metric in self._mass_quantities:
+                kwargs_selection = kwargs_selection_lens_mass or {}
+            else:
+                kwargs_selection = kwargs_selection_light or {}
+            results[metric] = getattr(self, metric)(**kwargs_selection, **kwargs_metrics.get(metric, {}))
+        return results
+
+    def _get_model(self, model_class, kwargs_selection):
+        key = fingerprint(model_class.__name__, kwargs_selection, self._point_estimates())
+        if key in self._models:
+            self._models.move_to_end(key)
+            return self._models[key]
+        model = model_class(self.coolest, self.coolest_dir, cache=self.cache, **kwargs_selection)
+        self._models[key] = model
+        # e.g. a model per posterior sample would otherwise be kept
+        while len(self._models) > self._max_cached_models:
+            self._models.popitem(last=False)
+        return model
+
+    def _point_estimates(self):
+        # values of the point estimates of all parameters (None for e.g. pixelated profiles),
+        # which determine the parameters of the composable models
+        return [getattr(getattr(param, 'point_estimate', None), 'value', None) 
+                for param in self.coolest.lensing_entities.get_parameters()]
+
+    def effective_einstein_radius(self, center=None, initial_guess=None, initial_delta_pix=None, 
+                                  n_iter=None, return_accuracy=False, max_loopcount=None, 
+                                  method='auto', tol=1e-8, **kwargs_selection):
+        """Calculates the effective Einstein radius of a kappa grid, defined as the radius 
+        of the circle within which the mean convergence is equal to one.
         Uses the grid from the create_kappa_image which is built from the coolest file.
 
+        Pixels are sorted by their distance to the center, such that the mean convergence 
+        within any radius is given by cumulative sums. The radius at which it crosses one 
+        is found by binary search, and interpolated linearly between the radii of 
+        the two pixels on each side of the crossing.
+
+        If the selected mass profiles are only concentric PEMD profiles, possibly with 
+        a ConvergenceSheet and an ExternalShear (which has no convergence), the radius
+        is instead computed without any grid, from the analytic mean convergence 
+        of the profiles within circles (see `util.PowerLawRadialProfile`).
+
         Parameters
         ----------
         center : (float, float), optional
             (x, y)-coordinates of the center from which to calculate Einstein radius; if None, use the value from create_kappa_image, by default None
-        initial_guess : int, optional
-            initial guess for Einstein radius, by default 1
-        initial_delta_pix : int, optional
-            initial step size before shrinking in future iterations, by default 10
-        n_iter : int, optional
-            number of iterations, by default 5
+        initial_guess, initial_delta_pix, n_iter, max_loopcount : optional
+            Not used anymore (settings of the former iterative algorithm), kept for backward compatibility
         return_accuracy : bool, optional
             if True, return estimate of accuracy as well as R_Ein value, by default False
+        method : str, optional
+            'analytic' (grid-free computation, only for profiles described above), 'grid', 
+            or 'auto' (analytic whenever possible), by default 'auto'
+        tol : float, optional
+            Relative tolerance of the analytic computation, by default 1e-8
 
         Returns
         -------
         float, or (float, float) if return_accuracy is True
-            Effective Einstein radius
-
-        Raises
-        ------
-        RuntimeError
-            If the algorithm is running for more than 100 loops.
+            Effective Einstein radius (NaN if the convergence is sub-critical, 
+            or if the mean convergence is still larger than one at the edge of the grid)
         """
         if kwargs_selection is None:
             kwargs_selection = {}
-        mass_model = ComposableMassModel(self.coolest, self.coolest_dir, **kwargs_selection)
-
-        # get an image of the convergence
-        x, y = self.coordinates.pixel_coordinates
-        kappa_image = mass_model.evaluate_convergence(x, y)
-
-        # import matplotlib.pyplot as plt
-        # plt.imshow(np.log10(kappa_image))
-        # plt.show()
+        mass_model = self.get_mass_model(**kwargs_selection)
 
         # select a center
         if center is None:
@@ -90,78 +201,30 @@ class Analysis(object):
         else:
             center_x, center_y = center
 
-        def _loop_until_overshoot(r_Ein, delta, direction, runningtotal, total_pix):
-            """
-            this subfunction iteratively adjusts the mask radius by delta either inward or outward until the sign flips on mean_kappa-area
-            """
-            loopcount=0
-            if r_Ein==np.nan: #return nan if given nan (needed when I put this in a loop below)
-                return np.nan, np.nan, 0, runningtotal, total_pix
-            while (runningtotal-total_pix)*direction>0:
-                if loopcount > max_loopcount:
-                    raise RuntimeError('Stuck in very long (possibly infinite) loop')
-                if direction > 0:
-                    mask=only_between_r1r2(r_Ein, r_Ein+delta,r_grid)
-                else:
-                    mask=only_between_r1r2(r_Ein-delta, r_Ein, r_grid)
-                kappa_annulus=np.sum(kappa_image[mask])
-                added_pix=np.sum(mask)
-                runningtotal=runningtotal+kappa_annulus*direction
-                total_pix=total_pix+added_pix*direction
-                r_Ein=r_Ein+delta*direction
-
-                if r_Ein < min_guess:
-                    #Either we overshot into the center region between pixels (rare), or kappa is subcritical.
-                    #check starting from zero
-                    mask=only_between_r1r2(0,min_guess,r_grid)
-                    runningtotal=np.sum(kappa_image[mask])
-                    total_pix=np.sum(mask)
-                    if runningtotal-total_pix < 0:
-                        logging.warning('kappa is sub-critical, Einstein radius undefined.')
-                        return np.nan, np.nan, 0, runningtotal, total_pix
-                loopcount+=1
-            return r_Ein, delta, direction, runningtotal, total_pix
-
-        def only_between_r1r2(r1, r2, r_grid):
-            if r1 > r2:
-                raise ValueError('r2 must be greater than r1')
-            return (r_grid >= r1) & (r_grid < r2)
-
-        #some initialization: if there is an even number of pixels we don't want to be stuck in the center between 4 pixels.
-        grid_res=np.abs(x[0,0]-x[0,1])
-        initial_delta=grid_res*initial_delta_pix #default inital step size is 10 pixels
-        min_guess=grid_res*np.sqrt(2)+1e-6
-        initial_guess=max(initial_guess,min_guess) #initial guess must include at least one pixel
-
-        r_grid=np.sqrt((x-center_x)**2+(y-center_y)**2)
-        mask=only_between_r1r2(0,initial_guess,r_grid)
-        runningtotal=np.sum(kappa_image[mask])
-        total_pix=np.sum(mask)
-        if runningtotal > total_pix: #move outward
-            direction=1
-        elif runningtotal < total_pix: #move inward
-            direction=-1
-        else:
-            return initial_guess
-        r_Ein=initial_guess
-        delta=initial_delta
-
-        for n in range(n_iter):
-            #overshoots, turn around and backtrack at higher precision
-            r_Ein, delta, direction, runningtotal, total_pix = _loop_until_overshoot(r_Ein, delta, direction, runningtotal, total_pix)
-            direction=direction*-1
-            delta=delta/2
-        accuracy=grid_res/2 #after testing, accuracy is about grid_res/2
-        if np.isnan(r_Ein):
-            accuracy=np.nan
+        radial_profile = self._analytic_radial_profile(mass_model, center_x, center_y, method, tol)
+        if radial_profile is not None:
+            r_Ein = radial_profile.mean_convergence_radius(mean_value=1.)
+            if return_accuracy:
+                return r_Ein, tol * r_Ein
+            return r_Ein
+
+        # get an image of the convergence
+        x, y = self.coordinates.pixel_coordinates
+        kappa_image = mass_model.evaluate_convergence(x, y)
 
+        r_Ein = util.mean_convergence_radius(kappa_image, x, y, center_x, center_y)
+        grid_res = np.abs(x[0, 0] - x[0, 1])
+        accuracy = np.nan if np.isnan(r_Ein) else grid_res / 2.  # due to the pixelization of the disk
         if return_accuracy:
             return r_Ein, accuracy
         else:
             return r_Ein
 
-    def kappa_1d_profile(self, center=None, r_vec=np.linspace(0, 10, 100),**kwargs_selection):
+    def kappa_1d_profile(self, center=None, r_vec=np.linspace(0, 10, 100), q=1., phi=0.,
+                         return_extra=False, **kwargs_selection):
         """Calculates 1D profile using the kappa grid.
+        The i-th value is the mean convergence of the pixels with radius in (r_vec[i-1], r_vec[i]]
+        (in (0, r_vec[0]] for the first value).
 
         Parameters
         ----------
@@ -169,6 +232,12 @@ class Analysis(object):
             (x, y)-coordinates of the center from which to calculate; if None, use the value from , by default None
         r_vec : _type_, optional
             range of radii over which to calculate the 1D profile, by default np.linspace(0, 10, 100)
+        q : float, optional
+            Axis ratio of the annuli, by default 1 (circular annuli)
+        phi : float, optional
+            Position angle of the annuli, in degrees east of north, by default 0
+        return_extra : bool, optional
+            If True, also returns the standard deviation and the number of pixels in each bin, by default False
 
         Returns
         -------
@@ -177,27 +246,105 @@ class Analysis(object):
         """
         if kwargs_selection is None:
             kwargs_selection = {}
-        mass_model = ComposableMassModel(self.coolest, self.coolest_dir, **kwargs_selection)
+        mass_model = self.get_mass_model(**kwargs_selection)
         x, y = self.coordinates.pixel_coordinates
         kappa_image = mass_model.evaluate_convergence(x, y)
         if center is None:
-            center_x, center_y = mass_model.estimate_center()
-        else:
-            center_x, center_y = center
-        r_grid=np.sqrt((x-center_x)**2+(y-center_y)**2)
-        kappa_profile=np.zeros_like(r_vec)
-        for r_i,r in enumerate(r_vec):
-            if r_i==0:
-                r_min=0
-            else:
-                r_min=r_vec[r_i-1]
-            in_radial_bin=(r_grid > r_min) & (r_grid <= r)
-            kappa_profile[r_i]=np.mean(kappa_image[in_radial_bin])
+            center = mass_model.estimate_center()
+        kappa_profile, kappa_std, counts = self.radial_profile(kappa_image, r_vec=r_vec, center=center, 
+                                                               q=q, phi=phi)
+        if return_extra:
+            return kappa_profile, r_vec, kappa_std, counts
         return kappa_profile, r_vec
 
-    def effective_radial_slope(self, r_eval=None, center=None, r_vec=np.linspace(0, 10, 100),**kwargs_selection):
+    def light_1d_profile(self, center=None, r_vec=np.linspace(0, 10, 100), coordinates=None,
+                         q=1., phi=0., return_extra=False, **kwargs_selection):
+        """Calculates 1D profile of the surface brightness, with the same bins as `kappa_1d_profile()`.
+
+        Parameters
+        ----------
+        center : (float, float), optional
+            (x, y)-coordinates of the center from which to calculate; if None, it is estimated from the light model, by default None
+        r_vec : array-like, optional
+            range of radii over which to calculate the 1D profile, by default np.linspace(0, 10, 100)
+        coordinates : Coordinates, optional
+            Instance of a Coordinates object to be used for the computation.
+            If None, will use an instance based on the Instrument, by default None
+        q : float, optional
+            Axis ratio of the annuli, by default 1 (circular annuli)
+        phi : float, optional
+            Position angle of the annuli, in degrees east of north, by default 0
+        return_extra : bool, optional
+            If True, also returns the standard deviation and the number of pixels in each bin, by default False
+
+        Returns
+        -------
+        (array, array)
+            surface brightness values and associated radius values
+        """
+        if kwargs_selection is None:
+            kwargs_selection = {}
+        light_model = self.get_light_model(**kwargs_selection)
+        if coordinates is None:
+            coordinates = self.coordinates
+        x, y = coordinates.pixel_coordinates
+        light_image = light_model.evaluate_surface_brightness(x, y)
+        if center is None:
+            center = light_model.estimate_center()
+        light_profile, light_std, counts = self.radial_profile(light_image, r_vec=r_vec, center=center,
+                                                               coordinates=coordinates, q=q, phi=phi)
+        if return_extra:
+            return light_profile, r_vec, light_std, counts
+        return light_profile, r_vec
+
+    def radial_profile(self, image, r_vec=np.linspace(0, 10, 100), center=(0., 0.), 
+                       coordinates=None, q=1., phi=0., mask=None):
+        """Calculates the 1D profile of any map (or stack of maps) evaluated on the coordinates grid,
+        by averaging pixel values within circular or elliptical annuli (see `util.RadialProfile`).
+        The i-th bin contains the pixels with radius in (r_vec[i-1], r_vec[i]] 
+        (in (0, r_vec[0]] for the first bin).
+
+        Parameters
+        ----------
+        image : ndarray
+            Map of shape of the coordinates grid, or stack of maps along leading axes
+        r_vec : array-like, optional
+            range of radii over which to calculate the 1D profile, by default np.linspace(0, 10, 100)
+        center : (float, float), optional
+            (x, y)-coordinates of the center of the annuli, by default (0, 0)
+        coordinates : Coordinates, optional
+            Instance of a Coordinates object on which the map is evaluated.
+            If None, will use an instance based on the Instrument, by default None
+        q : float, optional
+            Axis ratio of the annuli, by default 1 (circular annuli)
+        phi : float, optional
+            Position angle of the annuli, in degrees east of north, by default 0
+        mask : ndarray, optional
+            Binary mask (1 for pixels included), by default None
+
+        Returns
+        -------
+        (array, array, array)
+            Mean and standard deviation of the map in each bin (NaN for empty bins), 
+            and number of pixels in each bin
+        """
+        if coordinates is None:
+            coordinates = self.coordinates
+        x, y = coordinates.pixel_coordinates
+        bin_edges = np.concatenate([[0.], r_vec])
+        profile = util.RadialProfile(x, y, bin_edges, center_x=center[0], center_y=center[1],
+                                     q=q, phi=phi, mask=mask)
+        return profile.profile(image)
+
+    def effective_radial_slope(self, r_eval=None, center=None, r_vec=np.linspace(0, 10, 100),
+                               method='auto', tol=1e-8, **kwargs_selection):
         """Numerically calculates slope of the kappa profile. Because this is defined on a grid, it is not as accurate or robust as an analytical calculation. 
 
+        If the selected mass profiles are only concentric PEMD profiles, possibly with 
+        a ConvergenceSheet and an ExternalShear, the logarithmic slope of the circularly 
+        averaged convergence is instead computed analytically, exactly at `r_eval` 
+        or at each radius of `r_vec` (see `util.PowerLawRadialProfile`).
+
         Parameters
         ----------
         r_eval : float, optional
@@ -206,12 +353,28 @@ class Analysis(object):
             (x, y)-coordinates of the center from which to calculate; if None, use the value from create_kappa_image, by default None
         r_vec : array-like, optional
             range of radii over which to calculate the 1D profile, by default np.linspace(0, 10, 100)
+        method : str, optional
+            'analytic' (grid-free computation, only for profiles described above), 'grid', 
+            or 'auto' (analytic whenever possible), by default 'auto'
+        tol : float, optional
+            Relative tolerance of the analytic computation, by default 1e-8
 
         Returns
         -------
         float
             Effective slope
         """
+        if kwargs_selection is None:
+            kwargs_selection = {}
+        if method != 'grid':
+            mass_model = self.get_mass_model(**kwargs_selection)
+            if center is None:
+                center = mass_model.estimate_center()
+            radial_profile = self._analytic_radial_profile(mass_model, *center, method, tol)
+            if radial_profile is not None:
+                if r_eval is None:
+                    return radial_profile.logarithmic_slope(r_vec)
+                return np.atleast_1d(radial_profile.logarithmic_slope(r_eval))
         kappa_profile, r_vec =self.kappa_1d_profile(center=center, r_vec=r_vec, **kwargs_selection)
         rise=np.log10(kappa_profile[:-1])-np.log10(kappa_profile[1:])
         run=np.log10(r_vec[:-1])-np.log10(r_vec[1:])
@@ -222,12 +385,48 @@ class Analysis(object):
             closest_r = self._find_nearest(r_vec,r_eval) #just takes closest r. Could rebuild it to interpolate.
             return slope[r_vec==closest_r]
 
+    @staticmethod
+    def _analytic_radial_profile(mass_model, center_x, center_y, method, tol):
+        # returns the analytic circularly averaged convergence if the mass model allows it 
+        # (concentric PEMD profiles, convergence sheet and external shear), None otherwise
+        if method not in ('auto', 'analytic', 'grid'):
+            raise ValueError(f"Method must be 'auto', 'analytic' or 'grid' (received '{method}').")
+        if method == 'grid':
+            return None
+        theta_E_list, gamma_list, q_list, kappa_sheet = [], [], [], 0.
+        reason = None
+        for profile, params in zip(mass_model.profile_list, mass_model.param_list):
+            if np.ndim(params.get('theta_E', params.get('kappa_s', 0.))) != 0:
+                reason = "parameters are not scalars"
+            elif profile.type == 'PEMD':
+                if not (np.isclose(params['center_x'], center_x, rtol=0., atol=tol) and 
+                        np.isclose(params['center_y'], center_y, rtol=0., atol=tol)):
+                    reason = "PEMD profiles are not centered on the circles"
+                theta_E_list.append(params['theta_E'])
+                gamma_list.append(params['gamma'])
+                q_list.append(params['q'])
+            elif profile.type == 'ConvergenceSheet':
+                kappa_sheet += params['kappa_s']
+            elif profile.type != 'ExternalShear':
+                reason = f"profile '{profile.type}' is not supported"
+        if len(theta_E_list) == 0 and reason is None:
+            reason = "there is no PEMD profile"
+        if reason is not None:
+            if method == 'analytic':
+                raise ValueError(f"Analytic computation is not possible: {reason}.")
+            return None
+        return util.PowerLawRadialProfile(theta_E_list, gamma_list, q_list, 
+                                          kappa_sheet=kappa_sheet, tol=tol)
+
     def effective_radius_light(self, outer_radius=10, center=None, coordinates=None,
                                initial_guess=1, initial_delta_pix=10, 
                                n_iter=10, return_model=False, return_accuracy=False,
-                               circular_mask_radius=None, **kwargs_selection):
+                               circular_mask_radius=None, fraction=0.5, q=1., phi=0., 
+                               **kwargs_selection):
         """Computes the effective radius of the 2D surface brightness profile, 
         based on a definition similar to the half-light radius.
+        The growth curve of the light is computed once (see `growth_curve()`), 
+        such that radii enclosing several fractions of the flux can be obtained at once.
 
         Parameters
         ----------
@@ -238,12 +437,8 @@ class Analysis(object):
         coordinates : Coordinates, optional
             Instance of a Coordinates object to be used for the computation.
             If None, will use an instance based on the Instrument, by default None
-        initial_guess : int, optional
-            Initial guess for effective radius in arcsecond, by default 1
-        initial_delta_pix : int, optional
-            Initial step size in pixels before shrinking in future iterations, by default 10
-        n_iter : int, optional
-            Number of iterations, by default 5
+        initial_guess, initial_delta_pix, n_iter : optional
+            Not used anymore (settings of the former iterative algorithm), kept for backward compatibility
         circular_mask_radius : float, optional
             If not None, multiply the flux by a circular mask with radius `circular_mask_radius` 
             to force to zero any flux outside of it.
@@ -251,79 +446,118 @@ class Analysis(object):
             If True, also returns the surface brightness map used to comouted the radius. By default False.
         return_accuracy : bool, optional
             if True, return a rough estimate of accuracy as well, by default False
+        fraction : float or array_like, optional
+            Fraction(s) of the total flux enclosed by the radius, by default 0.5 (half-light radius)
+        q : float, optional
+            Axis ratio of the apertures, by default 1 (circular apertures)
+        phi : float, optional
+            Position angle of the apertures, in degrees east of north, by default 0
 
         Returns
         -------
         float
-            Effective radius
+            Effective radius (or array of radii if `fraction` is an array)
+        """
+        growth, light_image, coordinates = self.growth_curve(
+            outer_radius=outer_radius, center=center, coordinates=coordinates, 
+            circular_mask_radius=circular_mask_radius, q=q, phi=phi, 
+            return_model=True, **kwargs_selection
+        )
+        r_eff = growth.radius(fraction)
+        accuracy = np.abs(np.diff(coordinates.pixel_axes[0][:2]))[0]
 
-        Raises
-        ------
-        Warning
-            If integration loop exceeds outer bound before convergence.
+        if return_model and return_accuracy:
+            return r_eff, accuracy, light_image
+        elif return_model:
+            return r_eff, light_image
+        elif return_accuracy:
+            return r_eff, accuracy
+        return r_eff
+
+    def growth_curve(self, outer_radius=10, center=None, coordinates=None, no_re_eval=False,
+                     circular_mask_radius=None, q=1., phi=0., return_model=False, **kwargs_selection):
+        """Computes the growth curve (cumulative flux within concentric apertures) 
+        of the 2D surface brightness profile, from which both the effective radius and the 
+        total flux are derived (see `effective_radius_light()` and `total_magnitude()`).
+
+        Parameters
+        ----------
+        outer_radius : float, optional
+            outer limit of integration, by default 10. If None, the whole field-of-view is used.
+        center : (float, float), optional
+            (x, y)-coordinates of the center of the apertures; if None, it is estimated from the light model, by default None
+        coordinates : Coordinates, optional
+            Instance of a Coordinates object to be used for the computation.
+            If None, will use an instance based on the Instrument, by default None
+        no_re_eval : bool, option
+            If True, do re-evaluate the light profile (only relevant for pixelated profiles). Default is False.
+        circular_mask_radius : float, optional
+            If not None, multiply the flux by a circular mask with radius `circular_mask_radius` 
+            to force to zero any flux outside of it.
+        q : float, optional
+            Axis ratio of the apertures, by default 1 (circular apertures)
+        phi : float, optional
+            Position angle of the apertures, in degrees east of north, by default 0
+        return_model : bool, optional
+            If True, also returns the surface brightness map and the coordinates 
+            used to compute the growth curve. By default False.
+
+        Returns
+        -------
+        GrowthCurve
+            Growth curve of the light
         """
         if kwargs_selection is None:
             kwargs_selection = {}
 
-        light_model = ComposableLightModel(self.coolest, self.coolest_dir, **kwargs_selection)
-
-        # select a center
-        if center is None:
-            center_x, center_y = light_model.estimate_center()
-        else:
-            center_x, center_y = center
+        light_model = self.get_light_model(**kwargs_selection)
 
-        # get an image of the convergence
-        if coordinates is None:
-            x, y = self.coordinates.pixel_coordinates
+        if no_re_eval:
+            light_image, _, coordinates = light_model.surface_brightness(return_extra=True)
+            # copy, as the pixels of the (cached) light model are modified below
+            light_image = np.array(light_image, dtype=float)
+            x, y = coordinates.pixel_coordinates
         else:
+            # select a center
+            if center is None:
+                center_x, center_y = light_model.estimate_center()
+            else:
+                center_x, center_y = center
+            if coordinates is None:
+                coordinates = self.coordinates
+                x_FoV = self.coolest.observation.pixels.field_of_view_x
+                y_FoV = self.coolest.observation.pixels.field_of_view_y
+            else:
+                x_FoV = (coordinates.extent[0], coordinates.extent[1])
+                y_FoV = (coordinates.extent[2], coordinates.extent[3])
             x, y = coordinates.pixel_coordinates
-        # make sure to evaluate the profile such that it is centered on the image
-        x_ = x + center_x
-        y_ = y + center_y
-        light_image = light_model.evaluate_surface_brightness(x_, y_)
+            # make sure to evaluate the profile such that it is centered on the image
+            light_image = light_model.evaluate_surface_brightness(x + center_x, y + center_y)
+
+            #if limit of integration exceeds FoV, raise warning
+            if outer_radius is not None:
+                out_of_FoV=False
+                if outer_radius - center_x < x_FoV[0] or outer_radius + center_x > x_FoV[1]:
+                    out_of_FoV=True
+                if outer_radius - center_y < y_FoV[0] or outer_radius + center_y > y_FoV[1]:
+                    out_of_FoV=True
+                if out_of_FoV is True:
+                    logging.warning("Outer limit of integration exceeds FoV; results may not be accurate.")
         light_image[np.isnan(light_image)] = 0.
-        
-        #if limit of integration exceeds FoV, raise warning
-        if coordinates is None:
-            x_FoV = self.coolest.observation.pixels.field_of_view_x
-            y_FoV = self.coolest.observation.pixels.field_of_view_y
-        else:
-            x_FoV = (coordinates.extent[0], coordinates.extent[1])
-            y_FoV = (coordinates.extent[2], coordinates.extent[3])
-        out_of_FoV=False
-        if outer_radius - center_x < x_FoV[0] or outer_radius + center_x > x_FoV[1]:
-            out_of_FoV=True
-        if outer_radius - center_y < y_FoV[0] or outer_radius + center_y > y_FoV[1]:
-            out_of_FoV=True
-        if out_of_FoV is True:
-            logging.warning("Outer limit of integration exceeds FoV; effective radius may not be accurate.")
 
         if circular_mask_radius is not None:  # circular mask that fills the FoV
             mask = (np.hypot(x, y) < circular_mask_radius).astype(float)  # 0. and 1. only
             light_image *= mask
-            # import matplotlib.pyplot as plt
-            # plt.imshow(np.log10(light_image))
-            # plt.show()
-            # raise
-
-        r_eff, accuracy = util.effective_radius(
-            light_image, x, y, outer_radius=outer_radius, initial_guess=initial_guess, 
-            initial_delta_pix=initial_delta_pix, n_iter=n_iter
-        )
 
-        if return_model and return_accuracy:
-            return r_eff, accuracy, light_image
-        elif return_model:
-            return r_eff, light_image
-        elif return_accuracy:
-            return r_eff, accuracy
-        return r_eff
+        growth = util.GrowthCurve(light_image, x, y, q=q, phi=phi, outer_radius=outer_radius)
+        if return_model:
+            return growth, light_image, coordinates
+        return growth
 
     def two_point_correlation(self, Nbins=100, rmax=None, normalize=False, 
                               use_profile_coordinates=True, coordinates=None, 
                               min_flux=None, min_flux_frac=None, 
-                              return_cov=False, return_map=False,
+                              return_cov=False, return_map=False, light_image=None,
                               **kwargs_selection):
         """
         The two point correlation function can be obtained from the covariance matrix of an image and the distances between its pixels.
@@ -355,8 +589,12 @@ class Analysis(object):
             Default is None (i.e., no thresholding).
         return_cov : bool, optional
             If True, also returns the full covariance matrix. Default is False.
-        return_cov : bool, optional
-            If True, also returns the full covariance matrix. Default is False. 
+        return_map : bool, optional
+            If True, also returns the (thresholded and normalized) image. Default is False. 
+        light_image : ndarray, optional
+            If not None, image to be used instead of the light model, 
+            or stack of images along leading axes (e.g. one image per posterior sample),
+            on the grid of `coordinates`. Default is None.
 
         Returns
         -------
@@ -369,31 +607,26 @@ class Analysis(object):
         if coordinates is None:
             coordinates = self.coordinates
 
-        light_model = ComposableLightModel(self.coolest, self.coolest_dir, **kwargs_selection)
-
-        if use_profile_coordinates is True:
+        if light_image is not None:
+            light_image = np.array(light_image, dtype=float)
+        elif use_profile_coordinates is True:
+            light_model = self.get_light_model(**kwargs_selection)
             light_image, _, coordinates = light_model.surface_brightness(return_extra=True)
             if coordinates is None:
                 # can be known if e.g. the underlying light profile is not pixelated
                 raise ValueError("Light profile does not have any coordinates grid attached to it.")
         else:
-            if coordinates is None:
-                coordinates = self.coordinates
+            light_model = self.get_light_model(**kwargs_selection)
             x, y = coordinates.pixel_coordinates
             light_image = light_model.evaluate_surface_brightness(x, y)
         
         light_image = np.nan_to_num(light_image, nan=0.)
-        cov_mask = np.ones_like(light_image)
+        if min_flux is None and min_flux_frac is not None:
+            # maximum of each image of the stack
+            min_flux = min_flux_frac*np.amax(light_image, axis=(-2, -1), keepdims=True)
         if min_flux is not None:
-            logging.info(f"Setting to zero any flux below {min_flux}.")
+            logging.info(f"Setting to zero any flux below {np.squeeze(min_flux)}.")
             light_image[light_image < min_flux] = 0.
-            cov_mask[light_image < min_flux] = 0.
-        elif min_flux_frac is not None:
-            min_flux = min_flux_frac*light_image.max()
-            logging.info(f"Setting to zero any flux below {min_flux}.")
-            light_image[light_image < min_flux] = 0.
-            cov_mask[light_image < min_flux] = 0.
-        cov_mask = cov_mask.astype(bool)
 
         extent = coordinates.extent
         dpix = coordinates.pixel_size
@@ -402,7 +635,7 @@ class Analysis(object):
             rmax = np.hypot(extent[0]-extent[1],extent[2]-extent[3])/2.0
 
         if normalize:
-            max_image = np.amax(light_image)
+            max_image = np.amax(light_image, axis=(-2, -1), keepdims=True)
             light_image = np.divide(light_image,max_image)
         
         bins, means, sdevs, cov = util.azim_averaged_two_point_correlation(
@@ -419,9 +652,10 @@ class Analysis(object):
     
 
     def total_magnitude(self, outer_radius=10, center=None, coordinates=None,
-                        no_re_eval=False, flux_factor=None, mag_zero_point=None, **kwargs_selection):
-        """Computes the effective radius of the 2D surface brightness profile, 
-        based on a definition similar to the half-light radius.
+                        no_re_eval=False, flux_factor=None, mag_zero_point=None, 
+                        q=1., phi=0., **kwargs_selection):
+        """Computes the total magnitude of the 2D surface brightness profile,
+        from the flux enclosed within the outer radius (see `growth_curve()`).
 
         Parameters
         ----------
@@ -438,6 +672,10 @@ class Analysis(object):
         mag_zero_point : float, optional
             Magnitude zero-point corresponding to 1 electron per second. 
             Must be given when no mag_zero_point has been found in the self.coolest object.
+        q : float, optional
+            Axis ratio of the aperture, by default 1 (circular aperture)
+        phi : float, optional
+            Position angle of the aperture, in degrees east of north, by default 0
         
         TODO: flux_factor is temporary, this will be removed in the future.
 
@@ -446,31 +684,9 @@ class Analysis(object):
         float
             Total magnitude from the flux integrated over the field of view.
         """
-        if kwargs_selection is None:
-            kwargs_selection = {}
-
-        light_model = ComposableLightModel(self.coolest, self.coolest_dir, **kwargs_selection)
-
-        # get an image of the convergence
-        if no_re_eval:
-            light_image, _, coordinates = light_model.surface_brightness(return_extra=True)
-            light_image[np.isnan(light_image)] = 0.
-            x, y = coordinates.pixel_coordinates
-        else:
-            # select a center
-            if center is None:
-                center_x, center_y = light_model.estimate_center()
-            else:
-                center_x, center_y = center
-            if coordinates is None:
-                x, y = self.coordinates.pixel_coordinates
-            else:
-                x, y = coordinates.pixel_coordinates
-            # make sure to evaluate the profile such that it is centered on the image
-            x_ = x + center_x
-            y_ = y + center_y
-            light_image = light_model.evaluate_surface_brightness(x_, y_)
-            light_image[np.isnan(light_image)] = 0.
+        growth = self.growth_curve(outer_radius=outer_radius, center=center, 
+                                   coordinates=coordinates, no_re_eval=no_re_eval, 
+                                   q=q, phi=phi, **kwargs_selection)
 
         # retrieve the zero-point from the
         if self.coolest.observation.mag_zero_point is not None:
@@ -482,12 +698,8 @@ class Analysis(object):
         else:
             logging.info(f"Using the magnitude zero-point ({mag_zero_point}.)")
 
-        if outer_radius is not None:
-            mask = (np.hypot(x, y) < outer_radius).astype(float)  # 0. and 1. only
-            light_image *= mask
-
         # compute the magnitude
-        flux_tot = light_image.sum()
+        flux_tot = growth.total_flux
         if flux_factor is not None:
             flux_tot *= flux_factor  # temporary feature
         mag_tot = -2.5*np.log10(flux_tot) + mag_zero_point
@@ -519,7 +731,7 @@ class Analysis(object):
         if kwargs_selection is None:
             kwargs_selection = {}
 
-        light_model = ComposableLightModel(self.coolest, self.coolest_dir, **kwargs_selection)
+        light_model = self.get_light_model(**kwargs_selection)
 
         # select a center
         if center is None:
@@ -547,6 +759,142 @@ class Analysis(object):
 
         return q, phi
 
+    def posterior_distribution(self, quantity, last_n_samples=None, chunk_size=100, 
+                               num_processes=1, checkpoint_path=None, **kwargs_quantity):
+        """Propagates the posterior samples of the chain file referred to in the COOLEST 
+        metadata to a derived quantity, e.g. `'effective_einstein_radius'` or `'total_magnitude'`.
+        
+        For each sample, the point estimates of the parameters present in the chain are 
+        replaced by the sample values, and the `quantity` method is called with `kwargs_quantity`.
+        Samples are processed in chunks, possibly distributed over a pool of processes 
+        (each one holding a copy of this Analysis instance). Progress is logged after each chunk.
+
+        If `checkpoint_path` is given, the values computed so far are saved in this file
+        (numpy .npz format) after each chunk, such that an interrupted computation resumes 
+        from the last saved chunk when called again with the same arguments.
+
+        Parameters
+        ----------
+        quantity : str
+            Name of the Analysis method which computes the derived quantity
+        last_n_samples : int, optional
+            If provided, only the last samples are evaluated, by default None
+        chunk_size : int, optional
+            Number of samples per chunk, by default 100
+        num_processes : int, optional
+            Number of processes to distribute the chunks over, by default 1 (no process pool)
+        checkpoint_path : str, optional
+            Path of the checkpoint file, by default None (no checkpoint)
+        **kwargs_quantity : dict, optional
+            Keyword arguments passed to the `quantity` method
+
+        Returns
+        -------
+        (PosteriorStatistics, ndarray, ndarray)
+            Weighted statistics of the quantity, values of the quantity for each sample 
+            (with a leading sample axis), and probability weights of each sample
+
+        Raises
+        ------
+        ValueError
+            If `quantity` is not a method that computes a derived quantity.
+        """
+        if quantity not in self._posterior_quantities:
+            raise ValueError(f"Posterior distribution of '{quantity}' is not supported "
+                             f"(supported quantities are {self._posterior_quantities}).")
+        chain = get_chain_reader(self.coolest, self.coolest_dir)
+        entities = self.coolest.lensing_entities
+        param_ids = [param_id for param_id in chain.parameter_ids 
+                     if entities.get_parameter_from_id(param_id) is not None]
+        param_values = chain.columns(param_ids)
+        weights = np.array(chain.weights, dtype=float)
+        if last_n_samples is not None and last_n_samples > 0:
+            param_values, weights = param_values[-last_n_samples:], weights[-last_n_samples:]
+        num_samples = len(weights)
+
+        # resume from the checkpoint, if any
+        checkpoint_key = self._checkpoint_key(quantity, kwargs_quantity, param_ids, param_values)
+        values, num_done = None, 0
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            with np.load(checkpoint_path, allow_pickle=False) as content:
+                if str(content['key']) == checkpoint_key:
+                    num_done = int(content['num_done'])
+                    values = content['values']
+                    logging.info(f"Resuming from checkpoint '{checkpoint_path}' ({num_done}/{num_samples} samples).")
+                else:
+                    logging.warning(f"Checkpoint '{checkpoint_path}' does not match the current "
+                                    f"computation, hence it is ignored.")
+        # chunks start from the first pending sample, whatever the chunk size used before
+        pending_chunks = [(start, min(start + chunk_size, num_samples)) 
+                          for start in range(num_done, num_samples, chunk_size)]
+        pending_values = [param_values[start:stop] for start, stop in pending_chunks]
+
+        start_time = time.perf_counter()
+        if num_processes > 1 and len(pending_chunks) > 1:
+            executor = ProcessPoolExecutor(max_workers=num_processes, 
+                                           initializer=_init_posterior_worker, initargs=(self,))
+            futures = [executor.submit(_evaluate_posterior_chunk, (quantity, kwargs_quantity, param_ids, v)) 
+                       for v in pending_values]
+            chunk_results = (future.result() for future in futures)
+        else:
+            executor, futures = None, []
+            chunk_results = (self._evaluate_samples(quantity, kwargs_quantity, param_ids, v) 
+                             for v in pending_values)
+        try:
+            for (start, stop), chunk_values in zip(pending_chunks, chunk_results):
+                if values is None:
+                    values = np.full((num_samples,) + chunk_values.shape[1:], np.nan)
+                values[start:stop] = chunk_values
+                num_done = stop
+                elapsed_time = time.perf_counter() - start_time
+                logging.info(f"Posterior of '{quantity}': {num_done}/{num_samples} samples "
+                             f"({elapsed_time:.1f} s elapsed)")
+                if checkpoint_path is not None:
+                    self._save_checkpoint(checkpoint_path, checkpoint_key, values, num_done)
+        finally:
+            # cancels the pending chunks (`shutdown(cancel_futures=True)` requires python>=3.9)
+            for future in futures:
+                future.cancel()
+            if executor is not None:
+                executor.shutdown()
+
+        stats = util.posterior_statistics(values, weights)
+        return stats, values, weights
+
+    def _evaluate_samples(self, quantity, kwargs_quantity, param_ids, param_values):
+        # evaluates a derived quantity for each vector of parameter values,
+        # and restores the point estimates afterwards
+        entities = self.coolest.lensing_entities
+        params = [entities.get_parameter_from_id(param_id) for param_id in param_ids]
+        saved_point_estimates = [param.point_estimate for param in params]
+        method = getattr(self, quantity)
+        outputs = []
+        try:
+            for sample in param_values:
+                for param, value in zip(params, sample):
+                    param.set_point_estimate(float(value))
+                outputs.append(np.asarray(method(**kwargs_quantity), dtype=float))
+        finally:
+            for param, point_estimate in zip(params, saved_point_estimates):
+                param.point_estimate = point_estimate
+        return np.array(outputs)
+
+    @staticmethod
+    def _checkpoint_key(quantity, kwargs_quantity, param_ids, param_values):
+        try:
+            kwargs_key = fingerprint(kwargs_quantity)
+        except TypeError:
+            kwargs_key = repr(sorted(kwargs_quantity.items()))  # e.g. Coordinates instances
+        return fingerprint(quantity, kwargs_key, param_ids, np.ascontiguousarray(param_values))
+
+    @staticmethod
+    def _save_checkpoint(checkpoint_path, checkpoint_key, values, num_done):
+        # writes to a temporary file first, such that an interruption cannot corrupt the checkpoint
+        tmp_path = checkpoint_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, key=checkpoint_key, values=values, num_done=num_done)
+        os.replace(tmp_path, checkpoint_path)
+
     def lensing_information(self, a=16, b=0, 
                             noise_map=None, arc_mask=None, theta_E=None,
                             entity_idx_theta_E=0, profile_idx_theta_E=0):
@@ -574,4 +922,16 @@ class Analysis(object):
         array = np.asarray(array)
         idx = (np.abs(array - value)).argmin()
         return array[idx]
-    
\ No newline at end of file
+
+
+# Analysis instance of each worker process of `Analysis.posterior_distribution()`
+_worker_analysis = None
+
+
+def _init_posterior_worker(analysis):
+    global _worker_analysis
+    _worker_analysis = analysis
+
+
+def _evaluate_posterior_chunk(args):
+    return _worker_analysis._evaluate_samples(*args)
@@ -0,0 +1,156 @@
+__author__ = 'aymgal'
+
+import hashlib
+import logging
+from collections import OrderedDict
+import numpy as np
+
+
+__all__ = [
+    'EvaluationCache',
+    'fingerprint',
+]
+
+
+# types of attributes that characterize the settings of a profile instance
+_settings_types = (type(None), bool, int, float, complex, str, tuple, list, np.ndarray, np.generic)
+
+
+def fingerprint(*objects):
+    """Computes a (hexadecimal) hash of a set of objects, typically coordinates arrays,
+    profile settings and parameter values, to be used as a cache key.
+    Supported objects are None, numbers, strings, numpy arrays, and (possibly nested)
+    lists, tuples and dictionaries thereof.
+
+    Raises
+    ------
+    TypeError
+        If an object is not supported.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for obj in objects:
+        _update_hash(h, obj)
+    return h.hexdigest()
+
+
+def profile_settings(profile):
+    """Returns the class name and the attributes of a profile instance that
+    characterize its evaluation (e.g. field-of-view, interpolation method, backend),
+    ignoring other objects such as internal caches or third-party instances."""
+    settings = {key: value for key, value in vars(profile).items()
+                if isinstance(value, _settings_types) and not key.startswith('_cache')}
+    return (type(profile).__name__, settings)
+
+
+def _update_hash(h, obj):
+    if isinstance(obj, np.ndarray):
+        h.update(f"ndarray:{obj.dtype.str}:{obj.shape};".encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, np.generic):
+        _update_hash(h, obj.item())
+    elif obj is None or isinstance(obj, (bool, int, float, complex, str)):
+        h.update(f"{type(obj).__name__}:{obj!r};".encode())
+    elif isinstance(obj, dict):
+        h.update(f"dict:{len(obj)};".encode())
+        for key in sorted(obj.keys(), key=str):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"{type(obj).__name__}:{len(obj)};".encode())
+        for item in obj:
+            _update_hash(h, item)
+    else:
+        raise TypeError(f"Object of type '{type(obj).__name__}' cannot be fingerprinted.")
+
+
+class EvaluationCache(object):
+    """Memoizes the arrays evaluated by composable models (e.g. convergence or
+    deflection fields), such that the same field evaluated on the same coordinates
+    grid with the same profiles and parameters is computed only once.
+
+    Entries are keyed by a fingerprint of the coordinates, the selected profiles
+    and the parameter values (see `fingerprint()`), and the least recently used
+    entries are discarded when the total size of the cached arrays exceeds a byte budget.
+    Cached arrays are copied when stored and when retrieved, such that users can safely
+    modify the arrays they receive.
+
+    The same instance can be shared between several models, for instance
+    passed to all the models created by a ModelPlotter.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Maximum total size of the cached arrays, by default 256 MB
+    """
+
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = int(max_bytes)
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self.hits, self.misses = 0, 0
+
+    @property
+    def nbytes(self):
+        """Total size in bytes of the cached arrays"""
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Returns a copy of the cached value, or `default` if it is not in the cache"""
+        if key not in self._entries:
+            return default
+        self._entries.move_to_end(key)
+        value, _ = self._entries[key]
+        return self._copy(value)
+
+    def put(self, key, value):
+        """Stores a copy of a value (array or tuple of arrays) in the cache"""
+        value = self._copy(value)
+        nbytes = self._value_nbytes(value)
+        if nbytes > self.max_bytes:
+            logging.info(f"Value of size {nbytes} bytes is too large to be cached "
+                         f"(max. {self.max_bytes} bytes)")
+            return
+        if key in self._entries:
+            self._remove(key)
+        while self._nbytes + nbytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))  # least recently used
+        self._entries[key] = (value, nbytes)
+        self._nbytes += nbytes
+
+    def get_or_compute(self, key, compute_fn):
+        """Returns the cached value associated to `key`,
+        or calls `compute_fn()` and caches its output"""
+        if key in self._entries:
+            self.hits += 1
+            return self.get(key)
+        self.misses += 1
+        value = compute_fn()
+        self.put(key, value)
+        return value
+
+    def clear(self):
+        """Discards all cached values"""
+        self._entries.clear()
+        self._nbytes = 0
+
+    def _remove(self, key):
+        _, nbytes = self._entries.pop(key)
+        self._nbytes -= nbytes
+
+    @staticmethod
+    def _copy(value):
+        if isinstance(value, tuple):
+            return tuple(np.array(v, copy=True) for v in value)
+        return np.array(value, copy=True)
+
+    @staticmethod
+    def _value_nbytes(value):
+        if isinstance(value, tuple):
+            return sum(v.nbytes for v in value)
+        return value.nbytes
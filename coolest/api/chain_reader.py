@@ -0,0 +1,336 @@
+__author__ = 'aymgal'
+
+import os
+import logging
+import zipfile
+import numpy as np
+
+
+__all__ = [
+    'ChainReader',
+    'PosteriorSamples',
+    'get_chain_reader',
+]
+
+
+# chain readers already loaded during the session, keyed by the absolute path of the chain file
+_loaded_readers = {}
+
+
+def get_chain_reader(coolest_object, coolest_directory=None, use_disk_cache=True):
+    """Returns the (shared) ChainReader instance associated to the chain file
+    referred to in the metadata of a COOLEST object. The file is parsed only once
+    per session, and re-parsed only if it has been modified on the disk.
+
+    Parameters
+    ----------
+    coolest_object : COOLEST
+        COOLEST instance, with the key 'chain_file_name' in its metadata
+    coolest_directory : str, optional
+        Directory which contains the COOLEST template and the chain file, by default None
+    use_disk_cache : bool, optional
+        If True, the parsed columns are also cached on the disk next to the
+        chain file, such that later sessions can skip parsing, by default True
+
+    Returns
+    -------
+    ChainReader
+        Reader instance holding the chain columns
+
+    Raises
+    ------
+    ValueError
+        If the COOLEST metadata does not contain the chain file name.
+    """
+    if ChainReader.chain_key not in coolest_object.meta:
+        raise ValueError(f"Metadata key '{ChainReader.chain_key}' is missing from COOLEST template.")
+    file_path = coolest_object.meta[ChainReader.chain_key]
+    if coolest_directory is not None:
+        file_path = os.path.join(coolest_directory, file_path)
+    file_path = os.path.abspath(file_path)
+    reader = _loaded_readers.get(file_path, None)
+    if reader is None or not reader.is_up_to_date():
+        reader = ChainReader(file_path, use_disk_cache=use_disk_cache)
+        _loaded_readers[file_path] = reader
+    return reader
+
+
+class ChainReader(object):
+    """Parses a chain file of posterior samples a single time, and stores it
+    as a set of contiguous, typed columns (one array per column, e.g. per parameter ID).
+
+    The chain file is a coma-separated CSV file with a header containing
+    parameter IDs, and a column containing the probability weights.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the chain file
+    use_disk_cache : bool, optional
+        If True, the columns are cached on the disk in a binary file next to
+        the chain file (with suffix '.cache.npz'), which is re-used as long as
+        the chain file is not modified, by default True
+
+    Raises
+    ------
+    ValueError
+        If the chain file is not coma-separated.
+    """
+
+    chain_key = "chain_file_name"
+    weights_key = "probability_weights"
+    _cache_suffix = ".cache.npz"
+    _stat_key = "__source_stat__"
+    _names_key = "__column_names__"
+
+    def __init__(self, file_path, use_disk_cache=True):
+        self.file_path = os.path.abspath(file_path)
+        self._source_stat = self._get_source_stat()
+        self._columns = None
+        if use_disk_cache:
+            self._columns = self._read_disk_cache()
+        if self._columns is None:
+            self._columns = self._parse_file()
+            if use_disk_cache:
+                self._write_disk_cache()
+
+    @property
+    def cache_path(self):
+        return self.file_path + self._cache_suffix
+
+    @property
+    def column_names(self):
+        return list(self._columns.keys())
+
+    @property
+    def parameter_ids(self):
+        """Names of all columns except the probability weights"""
+        return [name for name in self._columns.keys() if name != self.weights_key]
+
+    @property
+    def num_samples(self):
+        if len(self._columns) == 0:
+            return 0
+        return len(next(iter(self._columns.values())))
+
+    @property
+    def weights(self):
+        """Probability weights of each sample"""
+        return self.column(self.weights_key)
+
+    def has_column(self, name):
+        return name in self._columns
+
+    def column(self, name):
+        """Returns a read-only view of a single column
+
+        Parameters
+        ----------
+        name : str
+            Column name (typically a parameter ID)
+
+        Returns
+        -------
+        ndarray
+            1D array of values
+
+        Raises
+        ------
+        KeyError
+            If the column is not in the chain file.
+        """
+        if name not in self._columns:
+            raise KeyError(f"Column '{name}' is not in the chain file '{self.file_path}'.")
+        return self._columns[name]
+
+    def columns(self, names):
+        """Returns a new 2D array of shape (num_samples, len(names)),
+        with columns ordered as in `names`"""
+        if len(names) == 0:
+            return np.empty((self.num_samples, 0))
+        return np.stack([self.column(name) for name in names], axis=1)
+
+    def is_up_to_date(self):
+        """Checks that the chain file has not been modified since it has been read"""
+        try:
+            return self._get_source_stat() == self._source_stat
+        except OSError:
+            return False
+
+    def _get_source_stat(self):
+        stat = os.stat(self.file_path)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def _parse_file(self):
+        with open(self.file_path, 'r') as f:
+            header = f.readline()
+        if ';' in header:
+            raise ValueError("Columns must be coma-separated (no semi-colon) in chain file.")
+        import pandas as pd  # imported at first use, as pandas is slow to import
+        table = pd.read_csv(self.file_path, delimiter=',')
+        columns = {}
+        for name in table.columns:
+            values = table[name].to_numpy()
+            values = np.ascontiguousarray(values)
+            values.flags.writeable = False
+            columns[name.strip()] = values
+        return columns
+
+    def _read_disk_cache(self):
+        if not os.path.exists(self.cache_path):
+            return None
+        try:
+            with np.load(self.cache_path, allow_pickle=False) as content:
+                if tuple(content[self._stat_key]) != self._source_stat:
+                    return None  # the chain file has been modified
+                columns = {}
+                for i, name in enumerate(content[self._names_key]):
+                    values = content[f'col_{i}']
+                    values.flags.writeable = False
+                    columns[str(name)] = values
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            logging.warning(f"Could not read chain cache file '{self.cache_path}' ({e}).")
+            return None
+        return columns
+
+    def _write_disk_cache(self):
+        content = {
+            self._stat_key: np.array(self._source_stat, dtype=np.int64),
+            self._names_key: np.array(self.column_names, dtype=str),
+        }
+        for i, values in enumerate(self._columns.values()):
+            content[f'col_{i}'] = values
+        # writes to a temporary file (one per process) first, such that an interruption
+        # or concurrent readers and writers cannot see a partially written cache file
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **content)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logging.warning(f"Could not write chain cache file '{self.cache_path}' ({e}).")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class PosteriorSamples(object):
+    """Compact container of posterior samples of the parameters of a list of profiles,
+    stored as one contiguous 1D array per parameter (i.e., a "struct of arrays"),
+    along with the array of probability weights.
+
+    Indexing with an integer returns the parameters of a single sample, organized 
+    as a list of dictionaries (one per profile) similarly to the point estimates,
+    where values are zero-copy (0-dimensional) views of the underlying arrays. 
+    Indexing with a slice returns a new PosteriorSamples instance holding views 
+    of the selected samples.
+
+    Parameters
+    ----------
+    profile_samples : list
+        List of dictionaries (one per profile) of 1D arrays of samples 
+        for each parameter name. An element can be None for profiles without 
+        samples (e.g. profiles with pixelated parameters), in which case 
+        the corresponding element of `fixed_param_list` is used for all samples.
+    weights : array_like
+        Probability weights of each sample
+    fixed_param_list : list, optional
+        List of dictionaries (one per profile) of fixed parameter values, 
+        by default None
+
+    Raises
+    ------
+    ValueError
+        If arrays of samples do not all have the same length as the weights.
+    """
+
+    def __init__(self, profile_samples, weights, fixed_param_list=None):
+        self.weights = np.asarray(weights)
+        num_samples = len(self.weights)
+        if fixed_param_list is None:
+            fixed_param_list = [None] * len(profile_samples)
+        self._fixed_param_list = fixed_param_list
+        self._profile_samples = []
+        for samples in profile_samples:
+            if samples is not None:
+                samples = {key: np.asarray(values, dtype=float) for key, values in samples.items()}
+                if any(len(values) != num_samples for values in samples.values()):
+                    raise ValueError("All parameters must have the same number of samples as the weights.")
+            self._profile_samples.append(samples)
+
+    @classmethod
+    def from_chain(cls, chain_reader, profile_param_ids, fixed_param_list=None):
+        """Creates the container from the columns of a ChainReader, without copying them.
+
+        Parameters
+        ----------
+        chain_reader : ChainReader
+            Chain reader instance
+        profile_param_ids : list
+            List of dictionaries (one per profile) that map parameter names to 
+            parameter IDs (i.e. columns of the chain file), or None for profiles without samples
+        fixed_param_list : list, optional
+            See the class constructor. Also used for parameters absent 
+            from the chain file, by default None
+        """
+        profile_samples = []
+        for k, param_ids in enumerate(profile_param_ids):
+            if param_ids is None:
+                profile_samples.append(None)
+                continue
+            samples = {}
+            for name, param_id in param_ids.items():
+                if not chain_reader.has_column(param_id) and fixed_param_list is not None:
+                    # parameters absent from the chain (e.g. fixed ones) keep their fixed value
+                    samples[name] = np.full(chain_reader.num_samples, fixed_param_list[k][name], dtype=float)
+                else:
+                    samples[name] = chain_reader.column(param_id)
+            profile_samples.append(samples)
+        return cls(profile_samples, chain_reader.weights, fixed_param_list=fixed_param_list)
+
+    @property
+    def num_profiles(self):
+        return len(self._profile_samples)
+
+    @property
+    def num_samples(self):
+        return len(self.weights)
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        for i in range(self.num_samples):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            profile_samples = [None if samples is None else 
+                               {key: values[index] for key, values in samples.items()}
+                               for samples in self._profile_samples]
+            return self.__class__(profile_samples, self.weights[index], 
+                                  fixed_param_list=self._fixed_param_list)
+        index = int(index)
+        if index < -self.num_samples or index >= self.num_samples:
+            raise IndexError(f"Sample index {index} out of range ({self.num_samples} samples)")
+        return [self._fixed_param_list[k] if samples is None else 
+                {key: values[index, ...] for key, values in samples.items()}
+                for k, samples in enumerate(self._profile_samples)]
+
+    def get_profile_samples(self, profile_index):
+        """Returns the dictionary of 1D arrays of samples for a given profile (or None)"""
+        return self._profile_samples[profile_index]
+
+    def batched_param_list(self, ndim=0):
+        """Returns the samples organized as a list of parameter dictionaries 
+        (one per profile), where each parameter is an array with a leading sample
+        axis, reshaped to (num_samples, 1, ..., 1) with `ndim` trailing axes
+        for broadcasting against coordinates arrays.
+        """
+        batched_list = []
+        for k, samples in enumerate(self._profile_samples):
+            if samples is None:
+                batched_list.append(self._fixed_param_list[k])
+            else:
+                batched_list.append({key: values.reshape((-1,) + (1,)*ndim) 
+                                     for key, values in samples.items()})
+        return batched_list
@@ -4,11 +4,10 @@ import os
 import numpy as np
 import math
 import logging
-from scipy import signal
-import pandas as pd
-from functools import partial
 
 from coolest.api import util
+from coolest.api.chain_reader import get_chain_reader, PosteriorSamples
+from coolest.api.cache import fingerprint, profile_settings
 
 
 # logging settings
@@ -39,6 +38,9 @@ class BaseComposableModel(object):
         List of either lists of indices, or 'all', for selecting which (mass or light) profile 
         of a given lensing entity to consider. If None, selects all the 
         profiles of within the corresponding entity, by default None
+    cache : EvaluationCache, optional
+        If provided, evaluated fields are memoized in this cache and re-used
+        for identical coordinates, profiles and parameters, by default None
 
     Raises
     ------
@@ -52,7 +54,8 @@ class BaseComposableModel(object):
     def __init__(self, model_type, 
                  coolest_object, coolest_directory=None, 
                  load_posterior_samples=False,
-                 entity_selection=None, profile_selection=None):
+                 entity_selection=None, profile_selection=None, cache=None):
+        self.cache = cache
         if entity_selection is None:
             # finds the first entity that has a 'model_type' profile
             entity_selection = None
@@ -74,7 +77,7 @@ class BaseComposableModel(object):
             profile_selection = 'all'
         entities = coolest_object.lensing_entities
         self.directory = coolest_directory
-        self._posterior_bool, self._csv_path = False, None
+        self._posterior_bool, self._chain = False, None
         if load_posterior_samples:
             metadata = coolest_object.meta
             if self._chain_key not in metadata:
@@ -83,7 +86,7 @@ class BaseComposableModel(object):
                                 f"will be loaded.")
             else:
                 self._posterior_bool = True
-                self._csv_path = os.path.join(self.directory, metadata[self._chain_key])
+                self._chain = get_chain_reader(coolest_object, self.directory)
         self.setup_profiles_and_params(model_type, entities, 
                                         entity_selection, profile_selection)
         self.num_profiles = len(self.profile_list)
@@ -93,7 +96,7 @@ class BaseComposableModel(object):
     def setup_profiles_and_params(self, model_type, entities, 
                                   entity_selection, profile_selection):
         profile_list = []
-        param_list, post_param_list = [], []
+        param_list, param_id_list = [], []
         info_list = []
         for i, entity in enumerate(entities):
             if self._selected(i, entity_selection):
@@ -107,22 +110,20 @@ class BaseComposableModel(object):
                                                  "must be provided for loading FITS files.")
                             params, fixed_params = self._get_grid_params(profile, self.directory)
                             profile_list.append(self._get_api_profile(model_type, profile, *fixed_params))
-                            post_params = None  # TODO: support samples for grid parameters
+                            param_ids = None  # TODO: support samples for grid parameters
                         else:
-                            params, post_params = self._get_regular_params(
-                                profile, samples_file_path=self._csv_path
-                            )
+                            params, param_ids = self._get_regular_params(profile, with_samples=True)
                             profile_list.append(self._get_api_profile(model_type, profile))
                         param_list.append(params)
-                        post_param_list.append(post_params)
+                        param_id_list.append(param_ids)
                         info_list.append((entity.name, entity.redshift))
         self.profile_list = profile_list
         self.param_list = param_list
+        self.param_id_list = param_id_list
         self.info_list = info_list
         if self._posterior_bool is True:
-            post_param_list, post_weights = self._finalize_post_samples(post_param_list, self._csv_path)
-            self.post_param_list = post_param_list
-            self.post_weights = np.array(post_weights)
+            self.post_param_list = self._finalize_post_samples(param_id_list, self._chain, param_list)
+            self.post_weights = self.post_param_list.weights
         else:
             self.post_param_list = None
             self.post_weights = None
@@ -137,6 +138,20 @@ class BaseComposableModel(object):
                 return center_x, center_y
         raise ValueError("Could not estimate a center from the composed model")
 
+    def _model_state(self):
+        """Returns what determines the output of the model (except the coordinates)"""
+        return (type(self).__name__, 
+                [profile_settings(profile) for profile in self.profile_list], 
+                self.param_list)
+
+    def _cached(self, compute_fn, *key_args):
+        """Calls `compute_fn()`, or retrieves its output from the evaluation cache (if any),
+        given the model state and additional arguments `key_args` (e.g. the coordinates)"""
+        if self.cache is None:
+            return compute_fn()
+        key = fingerprint(self._model_state(), *key_args)
+        return self.cache.get_or_compute(key, compute_fn)
+
     @staticmethod
     def _get_api_profile(model_type, profile_in, *extra_profile_args):
         """
@@ -152,20 +167,14 @@ class BaseComposableModel(object):
         return ProfileClass(*extra_profile_args)
 
     @staticmethod
-    def _get_regular_params(profile_in, samples_file_path=None):
+    def _get_regular_params(profile_in, with_samples=False):
         parameters = {}  # best-fit values
-        samples = {} if samples_file_path else None  # posterior samples
+        samples = {} if with_samples else None  # IDs of the posterior samples
         for name, param in profile_in.parameters.items():
             parameters[name] = param.point_estimate.value
             if samples is not None:
-                # read just the column corresponding to the parameter ID
-                column = pd.read_csv(
-                    samples_file_path, 
-                    usecols=[param.id], 
-                    delimiter=',',
-                )
-                # TODO: take into account probability weights from nested sampling runs!
-                samples[name] = list(column[param.id])
+                # samples are read from the column corresponding to the parameter ID
+                samples[name] = param.id
         return parameters, samples
 
     @staticmethod
@@ -190,31 +199,14 @@ class BaseComposableModel(object):
         return parameters, fixed_parameters
     
     @staticmethod
-    def _finalize_post_samples(param_list_of_samples, samples_file_path):
+    def _finalize_post_samples(param_list_of_ids, chain_reader, param_list):
         """
-        Takes as input the samples grouped at the leaves of the nested container structure,
-        and returns a list of items each organized as self.param_list
+        Takes as input the parameter IDs grouped at the leaves of the nested container structure,
+        and returns a PosteriorSamples instance holding samples for each profile parameters,
+        along with the probability weights
         """
-        num_profiles = len(param_list_of_samples)
-        profile_0 = param_list_of_samples[0]
-        num_samples = len(profile_0[list(profile_0.keys())[0]])
-        samples_of_param_list = [
-            [{} for _ in range(num_profiles)] for _ in range(num_samples)
-        ]
-        for i in range(num_samples):
-            for k in range(num_profiles):
-                for key in param_list_of_samples[k].keys():
-                    samples_of_param_list[i][k][key] = param_list_of_samples[k][key][i]
-        # also load and return the probability weights
-        # read just the column corresponding to the parameter ID
-        weights_key = 'probability_weights'
-        column = pd.read_csv(
-            samples_file_path, 
-            usecols=[weights_key], 
-            delimiter=',',
-        )
-        weights_list = list(column[weights_key])
-        return samples_of_param_list, weights_list
+        return PosteriorSamples.from_chain(chain_reader, param_list_of_ids,
+                                           fixed_param_list=param_list)
 
     @staticmethod
     def _selected(index, selection):
@@ -251,6 +243,8 @@ class ComposableLightModel(BaseComposableModel):
         List of either lists of indices, or 'all', for selecting which light profile 
         of a given lensing entity to consider. If None, selects all the 
         profiles of within the corresponding entity, by default None
+    cache : EvaluationCache, optional
+        If provided, evaluated fields are memoized in this cache, by default None
 
     Raises
     ------
@@ -258,10 +252,10 @@ class ComposableLightModel(BaseComposableModel):
         No valid entity found or no profiles found.
     """
 
-    def __init__(self, coolest_object, coolest_directory=None, **kwargs_selection):
+    def __init__(self, coolest_object, coolest_directory=None, cache=None, **kwargs_selection):
         super().__init__('light_model', coolest_object, 
                          coolest_directory=coolest_directory,
-                         **kwargs_selection)
+                         cache=cache, **kwargs_selection)
         pixel_size = coolest_object.instrument.pixel_size
         if pixel_size is None:
             self.pixel_area = 1.
@@ -281,8 +275,15 @@ class ComposableLightModel(BaseComposableModel):
             return values, extent, coordinates
         return values
 
+    def _model_state(self):
+        return super()._model_state() + (self.pixel_area,)
+
     def evaluate_surface_brightness(self, x, y):
         """Evaluates the surface brightness at given coordinates"""
+        return self._cached(lambda: self._eval_surface_brightness(x, y), 
+                            'surface_brightness', x, y)
+
+    def _eval_surface_brightness(self, x, y):
         image = np.zeros_like(x)
         for k, (profile, params) in enumerate(zip(self.profile_list, self.param_list)):
             flux_k = profile.evaluate_surface_brightness(x, y, **params)
@@ -308,6 +309,19 @@ class ComposableMassModel(BaseComposableModel):
         List of either lists of indices, or 'all', for selecting which mass profile 
         of a given lensing entity to consider. If None, selects all the 
         profiles of within the corresponding entity, by default None
+    load_posterior_samples : bool, optional
+        If True, loads posterior samples such that `evaluate_*` methods can
+        be called with `mode='posterior'`, by default False
+    posterior_chunk_size : int, optional
+        Number of posterior samples evaluated at once in 'posterior' mode. 
+        If None, it is chosen such that a chunk contains at most ~4 million
+        evaluated points, which keeps the memory usage bounded. By default None
+    cache : EvaluationCache, optional
+        If provided, evaluated fields are memoized in this cache, by default None
+    pemd_backend : str, optional
+        Backend used to compute the deflection of the PEMD profiles, 
+        either 'hyp2f1' or 'series' (see `PEMD`). If None, uses the default 
+        of the profile, by default None
 
     Raises
     ------
@@ -315,35 +329,31 @@ class ComposableMassModel(BaseComposableModel):
         No valid entity found or no profiles found.
     """
 
+    _max_points_per_chunk = 2**22
+
     def __init__(self, coolest_object, coolest_directory=None, 
-                 load_posterior_samples=False,
-                 **kwargs_selection):
+                 load_posterior_samples=False, posterior_chunk_size=None,
+                 cache=None, pemd_backend=None, **kwargs_selection):
         super().__init__('mass_model', coolest_object, 
                          coolest_directory=coolest_directory,
                          load_posterior_samples=load_posterior_samples,
-                         **kwargs_selection)
+                         cache=cache, **kwargs_selection)
+        self.posterior_chunk_size = posterior_chunk_size
+        if pemd_backend is not None:
+            for profile in self.profile_list:
+                if profile.type == 'PEMD':
+                    profile.set_backend(pemd_backend)
 
     def evaluate_potential(self, x, y, mode='point', last_n_samples=None):
         """Evaluates the lensing potential field at given coordinates"""
-        self._check_eval_mode(mode)
-        if mode == 'point' or self._posterior_bool is False:
-            return self._eval_pot_point(x, y, self.param_list)
-        elif mode == 'posterior':
-            return self._eval_pot_posterior(x, y, self.post_param_list, last_n_samples)
+        return self._evaluate(self._eval_pot_point, x, y, mode, last_n_samples)
 
     def _eval_pot_point(self, x, y, param_list):
         psi = np.zeros_like(x)
         for k, profile in enumerate(self.profile_list):
-            psi += profile.potential(x, y, **param_list[k])
+            psi = psi + profile.potential(x, y, **param_list[k])
         return psi
     
-    def _eval_pot_posterior(self, x, y, param_list, last_n_samples):
-        # map the point function at each sample
-        use_all_samples = last_n_samples is None or last_n_samples <= 0
-        val_list = param_list if use_all_samples else param_list[-last_n_samples:]
-        mapped = map(partial(self._eval_pot_point, x, y), val_list)
-        return np.array(list(mapped))
-    
     def fermat_potential(self, x, y, x_src, y_src, mode='point', last_n_samples=None):
         """Computes the Fermat potential for image (x, y) and source position (x_src, y_src)
         """
@@ -354,34 +364,43 @@ class ComposableMassModel(BaseComposableModel):
         geo = np.broadcast_to(geo, psi.shape)  # makes sure geo has same shape as psi
         return geo - psi
     
-    def evaluate_deflection(self, x, y):
+    def evaluate_deflection(self, x, y, mode='point', last_n_samples=None):
         """Evaluates the lensing deflection field at given coordinates"""
+        return self._evaluate(self._eval_defl_point, x, y, mode, last_n_samples)
+
+    def _eval_defl_point(self, x, y, param_list):
         alpha_x, alpha_y = np.zeros_like(x), np.zeros_like(x)
-        for k, (profile, params) in enumerate(zip(self.profile_list, self.param_list)):
-            a_x, a_y = profile.deflection(x, y, **params)
-            alpha_x += a_x
-            alpha_y += a_y
+        for k, profile in enumerate(self.profile_list):
+            a_x, a_y = profile.deflection(x, y, **param_list[k])
+            alpha_x = alpha_x + a_x
+            alpha_y = alpha_y + a_y
         return alpha_x, alpha_y
 
-    def evaluate_convergence(self, x, y):
+    def evaluate_convergence(self, x, y, mode='point', last_n_samples=None):
         """Evaluates the lensing convergence (i.e., 2D mass density) at given coordinates"""
+        return self._evaluate(self._eval_conv_point, x, y, mode, last_n_samples)
+
+    def _eval_conv_point(self, x, y, param_list):
         kappa = np.zeros_like(x)
-        for k, (profile, params) in enumerate(zip(self.profile_list, self.param_list)):
-            kappa += profile.convergence(x, y, **params)
+        for k, profile in enumerate(self.profile_list):
+            kappa = kappa + profile.convergence(x, y, **param_list[k])
         return kappa
 
-    def evaluate_hessian(self, x, y):
+    def evaluate_hessian(self, x, y, mode='point', last_n_samples=None):
         """Evaluates the lensing Hessian components at given coordinates"""
+        return self._evaluate(self._eval_hess_point, x, y, mode, last_n_samples)
+
+    def _eval_hess_point(self, x, y, param_list):
         H_xx_sum = np.zeros_like(x)
         H_xy_sum = np.zeros_like(x)
         H_yx_sum = np.zeros_like(x)
         H_yy_sum = np.zeros_like(x)
-        for k, (profile, params) in enumerate(zip(self.profile_list, self.param_list)):
-            H_xx, H_xy, H_yx, H_yy = profile.hessian(x, y, **params)
-            H_xx_sum += H_xx
-            H_xy_sum += H_xy
-            H_yx_sum += H_yx
-            H_yy_sum += H_yy
+        for k, profile in enumerate(self.profile_list):
+            H_xx, H_xy, H_yx, H_yy = profile.hessian(x, y, **param_list[k])
+            H_xx_sum = H_xx_sum + H_xx
+            H_xy_sum = H_xy_sum + H_xy
+            H_yx_sum = H_yx_sum + H_yx
+            H_yy_sum = H_yy_sum + H_yy
         return H_xx_sum, H_xy_sum, H_yx_sum, H_yy_sum
     
     def evaluate_jacobian(self, x, y):
@@ -390,13 +409,84 @@ class ComposableMassModel(BaseComposableModel):
         A = np.array([[1 - H_xx, -H_xy], [-H_yx, 1 - H_yy]])
         return A
     
-    def evaluate_magnification(self, x, y):
+    def evaluate_magnification(self, x, y, mode='point', last_n_samples=None):
         """Evaluates the lensing magnification at given coordinates"""
-        H_xx, H_xy, H_yx, H_yy = self.evaluate_hessian(x, y)
+        return self._evaluate(self._eval_mag_point, x, y, mode, last_n_samples)
+
+    def _eval_mag_point(self, x, y, param_list):
+        H_xx, H_xy, H_yx, H_yy = self._eval_hess_point(x, y, param_list)
         det_A = (1 - H_xx) * (1 - H_yy) - H_xy*H_yx
         mu = 1. / det_A
         return mu
 
+    def evaluate_lensing_quantities(self, x, y, mode='point', last_n_samples=None):
+        """Evaluates in a single pass the main lensing quantities at given coordinates. 
+        Intermediate quantities shared between the deflection and the hessian 
+        of each profile (e.g., the hypergeometric function of the PEMD) are computed only once.
+
+        Returns
+        -------
+        dict
+            Dictionary with keys 'alpha_x', 'alpha_y' (deflection), 'kappa' (convergence), 
+            'gamma_1', 'gamma_2' (shear), 'det_A' (determinant of the lensing Jacobian) 
+            and 'magnification'.
+        """
+        alpha_x, alpha_y, kappa, gamma_1, gamma_2 \
+            = self._evaluate(self._eval_lensing_point, x, y, mode, last_n_samples)
+        det_A = (1 - kappa)**2 - gamma_1**2 - gamma_2**2
+        with np.errstate(divide='ignore'):  # infinite magnification on critical lines
+            magnification = 1. / det_A
+        return {
+            'alpha_x': alpha_x, 'alpha_y': alpha_y, 
+            'kappa': kappa, 'gamma_1': gamma_1, 'gamma_2': gamma_2,
+            'det_A': det_A, 'magnification': magnification,
+        }
+
+    def _eval_lensing_point(self, x, y, param_list):
+        outputs = [np.zeros_like(x) for _ in range(5)]
+        for k, profile in enumerate(self.profile_list):
+            values = profile.lensing_quantities(x, y, **param_list[k])
+            outputs = [out + v for out, v in zip(outputs, values)]
+        return tuple(outputs)
+
+    def _evaluate(self, point_fn, x, y, mode, last_n_samples):
+        """Evaluates `point_fn` either with point estimates, 
+        or for each posterior sample (with a leading sample axis)"""
+        self._check_eval_mode(mode)
+        if mode == 'point' or self._posterior_bool is False:
+            return self._cached(lambda: point_fn(x, y, self.param_list), 
+                                point_fn.__name__, x, y)
+        elif mode == 'posterior':
+            return self._cached(lambda: self._eval_posterior(point_fn, x, y, self.post_param_list, 
+                                                             last_n_samples),
+                                point_fn.__name__, x, y, last_n_samples,
+                                self.post_param_list.batched_param_list())
+
+    def _eval_posterior(self, point_fn, x, y, param_list, last_n_samples):
+        # evaluates the point function for chunks of samples at once, by giving 
+        # to each profile parameter arrays with a leading sample axis
+        use_all_samples = last_n_samples is None or last_n_samples <= 0
+        val_list = param_list if use_all_samples else param_list[-last_n_samples:]
+        num_samples = len(val_list)
+        shape = np.shape(x)
+        if self.posterior_chunk_size is None:
+            chunk_size = max(1, self._max_points_per_chunk // max(1, np.size(x)))
+        else:
+            chunk_size = max(1, int(self.posterior_chunk_size))
+        outputs = None
+        for start in range(0, num_samples, chunk_size):
+            stop = min(start + chunk_size, num_samples)
+            batched_list = val_list[start:stop].batched_param_list(ndim=len(shape))
+            values = point_fn(x, y, batched_list)
+            is_tuple = isinstance(values, tuple)
+            if not is_tuple:
+                values = (values,)
+            if outputs is None:
+                outputs = tuple(np.empty((num_samples,)+shape, dtype=np.result_type(v)) for v in values)
+            for out, v in zip(outputs, values):
+                out[start:stop] = v  # broadcasts quantities that do not depend on coordinates
+        return outputs if is_tuple else outputs[0]
+
     def ray_shooting(self, x, y):
         """evaluates the lens equation beta = theta - alpha(theta)"""
         alpha_x, alpha_y = self.evaluate_deflection(x, y)
@@ -421,6 +511,9 @@ class ComposableLensModel(object):
         List of either lists of indices, or 'all', for selecting which light/mass profile 
         of a given lensing entity to consider. If None, selects all the 
         profiles of within the corresponding entity, by default None
+    cache : EvaluationCache, optional
+        If provided, evaluated fields (including those of the underlying light 
+        and mass models) are memoized in this cache, by default None
 
     Raises
     ------
@@ -428,9 +521,19 @@ class ComposableLensModel(object):
         No valid entity found or no profiles found.
     """
 
+    # approximate peak memory (in bytes) per evaluated point of a supersampled grid,
+    # accounting for the intermediate arrays of ray-tracing and profile evaluation
+    _bytes_per_evaluated_point = 512
+    # maximum number of points evaluated at once when refining pixels
+    _max_points_per_chunk = 2**22
+
     def __init__(self, coolest_object, coolest_directory=None, 
-                 kwargs_selection_source=None, kwargs_selection_lens_mass=None):
+                 kwargs_selection_source=None, kwargs_selection_lens_mass=None,
+                 cache=None):
         self.coolest = coolest_object
+        self.cache = cache
+        self._psf_convolutions, self._psf_convolution_source = {}, None
+        self._noise_variance_terms, self._noise_variance_source = None, None
         self.coord_obs = util.get_coordinates(self.coolest)
         self.directory = coolest_directory
         if kwargs_selection_source is None:
@@ -439,69 +542,431 @@ class ComposableLensModel(object):
             kwargs_selection_lens_mass = {}
         self.lens_mass = ComposableMassModel(coolest_object, 
                                              coolest_directory,
+                                             cache=cache,
                                              **kwargs_selection_lens_mass)
         self.source = ComposableLightModel(coolest_object, 
                                           coolest_directory,
+                                          cache=cache,
                                           **kwargs_selection_source)
 
-    def model_image(self, supersampling=5, convolved=True, super_convolution=True):
-        """generates an image of the lens based on the selected model components"""
-        obs = self.coolest.observation
-        psf = self.coolest.instrument.psf
-        if convolved is True and psf.type == 'PixelatedPSF':
-            scale_factor = obs.pixels.pixel_size / psf.pixels.pixel_size
-            supersampling_conv = int(round(scale_factor))
-            if not math.isclose(scale_factor, supersampling_conv):
-                raise ValueError(f"PSF supersampling ({scale_factor}) not close to an integer?")
-            if supersampling_conv < 1:
-                raise ValueError("PSF pixel size smaller than data pixel size")
-        if supersampling < 1:
-            raise ValueError("Supersampling must be >= 1")
-        if convolved is True and supersampling_conv > supersampling:
-            supersampling = supersampling_conv
+    def model_image(self, supersampling=5, convolved=True, super_convolution=True, 
+                    max_memory=None):
+        """generates an image of the lens based on the selected model components
+
+        Parameters
+        ----------
+        supersampling : int, optional
+            Supersampling factor of the observation pixels, by default 5
+        convolved : bool, optional
+            If True, the image is convolved with the PSF, by default True
+        super_convolution : bool, optional
+            If True, and if the PSF kernel is supersampled by the same factor,
+            the convolution is performed before downsampling, by default True
+        max_memory : int, optional
+            If provided, the supersampled grid is evaluated by tiles 
+            (blocks of rows) such that the memory used for evaluating 
+            the model is approximately bounded by this number of bytes. 
+            The PSF convolution is then performed tile by tile using the overlap-add 
+            method, and the output matches the full-grid evaluation. By default None
+
+        Returns
+        -------
+        (ndarray, Coordinates)
+            Model image and coordinates of the observation
+        """
+        supersampling_in = supersampling
+        supersampling, supersampling_conv = self._get_supersampling(supersampling, convolved, 
+                                                                    super_convolution)
+        if supersampling > supersampling_in:
             logging.warning(f"Supersampling adapted to the PSF pixel size ({supersampling})")
+        conv_before_down = convolved and super_convolution and supersampling_conv == supersampling
+        psf_conv = None
+        if convolved is True:
+            psf_conv = self.get_psf_convolution(supersampling if conv_before_down else 1)
+        if max_memory is not None:
+            image = self._model_image_tiled(supersampling, psf_conv, conv_before_down, max_memory)
+            return image, self.coord_obs
         coord_eval = self.coord_obs.create_new_coordinates(pixel_scale_factor=1./supersampling)
         x, y = coord_eval.pixel_coordinates
         image = self.evaluate_lensed_surface_brightness(x, y)
         if convolved is True:
-            if psf.type != 'PixelatedPSF':
-                raise NotImplementedError
-            kernel = psf.pixels.get_pixels(directory=self.directory)
-            kernel_sum = kernel.sum()
-            if not math.isclose(kernel_sum, 1., abs_tol=1e-3):
-                kernel /= kernel_sum
-                logging.warning(f"PSF kernel is not normalized (sum={kernel_sum}), "
-                                f"so it has been normalized before convolution")
-            if np.isnan(image).any():
-                np.nan_to_num(image, copy=False, nan=0., posinf=None, neginf=None)
-                logging.warning("Found NaN values in image prior to convolution; "
-                                "they have been replaced by zeros.")
-            if super_convolution and supersampling_conv == supersampling:
+            image = self._replace_nan_values(image)
+            if conv_before_down:
                 # first convolve then downscale
-                image = signal.fftconvolve(image, kernel, mode='same')
+                image = psf_conv.convolve(image)
                 image = util.downsampling(image, factor=supersampling)
             else:
                 # first downscale then convolve
                 image = util.downsampling(image, factor=supersampling)
-                image = signal.fftconvolve(image, kernel, mode='same')
+                image = psf_conv.convolve(image)
         elif supersampling > 1:
             image = util.downsampling(image, factor=supersampling)
         return image, self.coord_obs
 
+    def get_supersampling(self, supersampling=5, convolved=True, super_convolution=True):
+        """Returns the supersampling factor of the grid evaluated by `model_image()` 
+        with the same arguments, which is increased to match the pixel size of a pixelated PSF"""
+        return self._get_supersampling(supersampling, convolved, super_convolution)[0]
+
+    def _get_supersampling(self, supersampling, convolved, super_convolution):
+        # supersampling factors of the evaluated grid and of the PSF convolution (None if not convolved)
+        if supersampling < 1:
+            raise ValueError("Supersampling must be >= 1")
+        supersampling_conv = None
+        if convolved is True:
+            supersampling_conv = self._get_psf_supersampling()
+            if supersampling_conv is None:
+                # analytic PSF, which can be convolved at any resolution
+                supersampling_conv = supersampling if super_convolution else 1
+            supersampling = max(supersampling, supersampling_conv)
+        return supersampling, supersampling_conv
+
+    def model_image_adaptive(self, max_supersampling=5, tolerance=1e-3, 
+                             magnification_threshold=None, convolved=True):
+        """generates an image of the lens based on the selected model components,
+        supersampling only the pixels that need it.
+
+        The model is first evaluated at the center of each pixel. Pixels with a local 
+        variation of surface brightness (i.e., the largest absolute difference with 
+        their direct neighbors) larger than `tolerance` times the peak surface brightness, 
+        as well as pixels with an absolute magnification above `magnification_threshold`,
+        are then evaluated with supersampling factors 2, 4, 8, ... up to `max_supersampling`.
+        A pixel stops being refined as soon as its value changes by less than the tolerance
+        between two successive factors.
+
+        Parameters
+        ----------
+        max_supersampling : int, optional
+            Maximum supersampling factor, by default 5
+        tolerance : float, optional
+            Tolerance relative to the peak surface brightness, by default 1e-3
+        magnification_threshold : float, optional
+            If provided, pixels with a larger absolute magnification 
+            (e.g. near critical lines) are also refined, by default None
+        convolved : bool, optional
+            If True, the image is convolved with the PSF, which must be 
+            defined with the same pixel size as the observation if it is pixelated, by default True
+
+        Returns
+        -------
+        (ndarray, Coordinates, ndarray)
+            Model image, coordinates of the observation, and map of the 
+            supersampling factor used for each pixel
+
+        Raises
+        ------
+        ValueError
+            If the maximum supersampling factor is smaller than 1, or if the PSF kernel is supersampled.
+        """
+        if max_supersampling < 1:
+            raise ValueError("Supersampling must be >= 1")
+        if convolved is True and self._get_psf_supersampling() not in (None, 1):
+            raise ValueError("Adaptive supersampling requires a PSF kernel defined "
+                             "with the same pixel size as the observation")
+        x, y = self.coord_obs.pixel_coordinates
+        image = self.evaluate_lensed_surface_brightness(x, y)
+        refinement_map = np.ones(image.shape, dtype=int)
+        num_evaluations = image.size
+        abs_tolerance = tolerance * np.nanmax(np.abs(image))
+        # local variations with respect to the direct neighbors
+        variation = np.zeros_like(image)
+        diff_x = np.abs(np.diff(image, axis=1))
+        diff_y = np.abs(np.diff(image, axis=0))
+        variation[:, 1:] = np.maximum(variation[:, 1:], diff_x)
+        variation[:, :-1] = np.maximum(variation[:, :-1], diff_x)
+        variation[1:, :] = np.maximum(variation[1:, :], diff_y)
+        variation[:-1, :] = np.maximum(variation[:-1, :], diff_y)
+        refine = variation > abs_tolerance
+        if magnification_threshold is not None:
+            magnification = self.lens_mass.evaluate_magnification(x, y)
+            refine |= np.abs(magnification) > magnification_threshold
+        pixel_size = self.coord_obs.pixel_size
+        step_x = - pixel_size if self.coord_obs.x_is_inverted else pixel_size
+        step_y = - pixel_size if self.coord_obs.y_is_inverted else pixel_size
+        factor = 1
+        while factor < max_supersampling and refine.any():
+            factor = min(2 * factor, max_supersampling)
+            indices = np.flatnonzero(refine)
+            values = self._eval_subpixels(x.flat[indices], y.flat[indices], 
+                                          step_x, step_y, factor)
+            num_evaluations += indices.size * factor**2
+            converged = np.abs(values - image.flat[indices]) <= abs_tolerance
+            image.flat[indices] = values
+            refinement_map.flat[indices] = factor
+            refine.flat[indices[converged]] = False
+        logging.info(f"Adaptive supersampling: {num_evaluations} evaluations "
+                     f"({image.size * max_supersampling**2} with uniform supersampling)")
+        if convolved is True:
+            image = self._replace_nan_values(image)
+            image = self.psf_convolution.convolve(image)
+        return image, self.coord_obs, refinement_map
+
+    def _eval_subpixels(self, x_center, y_center, step_x, step_y, factor):
+        # averages the surface brightness over factor x factor points within each pixel
+        offsets = (np.arange(factor) - (factor - 1) / 2.) / factor
+        num_pixels_per_chunk = max(1, self._max_points_per_chunk // factor**2)
+        values = np.empty(len(x_center))
+        for start in range(0, len(x_center), num_pixels_per_chunk):
+            stop = start + num_pixels_per_chunk
+            x = x_center[start:stop, None, None] + offsets[None, None, :] * step_x
+            y = y_center[start:stop, None, None] + offsets[None, :, None] * step_y
+            x, y = np.broadcast_arrays(x, y)
+            sub_image = self.evaluate_lensed_surface_brightness(x, y)
+            values[start:stop] = sub_image.mean(axis=(1, 2))
+        return values
+
+    def lensing_operator(self, supersampling=1, convolved=False, super_convolution=True):
+        """Builds the sparse linear operator which maps the values of the pixelated source
+        to the pixels of the model image, for the current mass model. The operator gives the 
+        same image as `model_image()` with the same arguments, except that the surface brightness 
+        is zero (instead of NaN) outside of the convex hull of an irregular grid.
+
+        Parameters
+        ----------
+        supersampling : int, optional
+            Supersampling factor, by default 1
+        convolved : bool, optional
+            If True, the operator includes the PSF convolution. Note that the number
+            of non-zero elements then scales with the size of the PSF kernel. By default False
+        super_convolution : bool, optional
+            If True, the convolution is performed before downsampling (see `model_image()`),
+            by default True
+
+        Returns
+        -------
+        LensingOperator
+            Lensing operator instance
+
+        Raises
+        ------
+        ValueError
+            If the source is not a single pixelated profile with an interpolation method
+            which is linear in the pixel values ('nearest' or 'linear').
+        """
+        if supersampling < 1:
+            raise ValueError("Supersampling must be >= 1")
+        if self.source.num_profiles != 1 or self.source.param_id_list[0] is not None:
+            raise ValueError("Lensing operators require a single pixelated source profile.")
+        # imported at first use, such that lens models can be used without scipy.sparse
+        from coolest.api.lensing_operator import LensingOperator, downsampling_matrix, convolution_matrix
+        profile, params = self.source.profile_list[0], self.source.param_list[0]
+        if convolved is True:
+            supersampling_conv = self._get_psf_supersampling()
+            if supersampling_conv is None:
+                supersampling_conv = supersampling if super_convolution else 1
+            if supersampling_conv > supersampling:
+                supersampling = supersampling_conv
+                logging.warning(f"Supersampling adapted to the PSF pixel size ({supersampling})")
+        conv_before_down = convolved and super_convolution and supersampling_conv == supersampling
+        image_shape = self.coord_obs.pixel_coordinates[0].shape
+        coord_eval = self.coord_obs.create_new_coordinates(pixel_scale_factor=1./supersampling)
+        x, y = coord_eval.pixel_coordinates
+        x_rs, y_rs = self.ray_shooting(x, y)
+        if 'pixels' in params:
+            source_shape = np.shape(params['pixels'])
+            matrix = profile.interpolation_matrix(x_rs, y_rs)
+        else:
+            source_shape = np.shape(params['z'])
+            matrix = profile.interpolation_matrix(x_rs, y_rs, params['x'], params['y'])
+        if profile.units == 'per_ang':
+            matrix = matrix * self.source.pixel_area
+        if conv_before_down:
+            kernel = self.get_psf_convolution(supersampling).kernel
+            matrix = convolution_matrix(kernel, x.shape).dot(matrix)
+        if supersampling > 1:
+            matrix = downsampling_matrix(x.shape, supersampling).dot(matrix)
+        if convolved is True and not conv_before_down:
+            kernel = self.psf_convolution.kernel
+            matrix = convolution_matrix(kernel, image_shape).dot(matrix)
+        return LensingOperator(matrix, image_shape, source_shape)
+
+    @property
+    def psf_convolution(self):
+        """ConvolutionOperator for the PSF of the instrument, for images 
+        with the same pixel size as the observation (see `get_psf_convolution()`)"""
+        return self.get_psf_convolution(supersampling=1)
+
+    def get_psf_convolution(self, supersampling=1):
+        """Returns the ConvolutionOperator for the PSF of the instrument.
+        Operators are created the first time they are needed (e.g., reading 
+        and normalizing the PSF kernel), and re-used afterwards as long 
+        as the PSF is not replaced.
+
+        Parameters
+        ----------
+        supersampling : int, optional
+            Ratio between the observation pixel size and the pixel size of the images 
+            to be convolved. This is only used for analytic PSFs, as kernels of pixelated PSFs
+            are defined with their own pixel size. By default 1
+
+        Returns
+        -------
+        ConvolutionOperator
+            Convolution operator instance
+
+        Raises
+        ------
+        NotImplementedError
+            If the PSF type is not supported.
+        """
+        psf = self.coolest.instrument.psf
+        if self._psf_convolution_source is not psf:
+            self._psf_convolutions = {}
+            self._psf_convolution_source = psf
+        if psf.type == 'PixelatedPSF':
+            key = (psf.type,)
+        elif psf.type == 'GaussianPSF':
+            key = (psf.type, psf.fwhm, supersampling)
+        else:
+            raise NotImplementedError(f"PSF type '{psf.type}' is not supported.")
+        if key not in self._psf_convolutions:
+            # imported at first use, such that lens models can be used without scipy.fft
+            from coolest.api.convolution import ConvolutionOperator, GaussianConvolutionOperator
+            if psf.type == 'PixelatedPSF':
+                kernel = psf.pixels.get_pixels(directory=self.directory)
+                psf_conv = ConvolutionOperator(kernel)
+            else:
+                # FWHM in units of the instrument pixel size
+                fwhm = psf.fwhm * supersampling
+                instrument_pixel_size = self.coolest.instrument.pixel_size
+                if instrument_pixel_size is not None:
+                    fwhm *= instrument_pixel_size / self.coord_obs.pixel_size
+                psf_conv = GaussianConvolutionOperator(fwhm)
+            self._psf_convolutions[key] = psf_conv
+        return self._psf_convolutions[key]
+
+    def _get_psf_supersampling(self):
+        """Returns the ratio between the observation pixel size and the 
+        PSF kernel pixel size, or None if the PSF is analytic"""
+        obs = self.coolest.observation
+        psf = self.coolest.instrument.psf
+        if psf.type == 'GaussianPSF':
+            return None
+        elif psf.type != 'PixelatedPSF':
+            raise NotImplementedError(f"PSF type '{psf.type}' is not supported.")
+        scale_factor = obs.pixels.pixel_size / psf.pixels.pixel_size
+        supersampling_conv = int(round(scale_factor))
+        if not math.isclose(scale_factor, supersampling_conv):
+            raise ValueError(f"PSF supersampling ({scale_factor}) not close to an integer?")
+        if supersampling_conv < 1:
+            raise ValueError("PSF pixel size smaller than data pixel size")
+        return supersampling_conv
+
+    @staticmethod
+    def _replace_nan_values(image):
+        if np.isnan(image).any():
+            np.nan_to_num(image, copy=False, nan=0., posinf=None, neginf=None)
+            logging.warning("Found NaN values in image prior to convolution; "
+                            "they have been replaced by zeros.")
+        return image
+
+    def _model_image_tiled(self, supersampling, psf_conv, conv_before_down, max_memory):
+        # supersampled coordinates axes, without creating the full 2D grid
+        x_axis, y_axis = self.coord_obs.new_pixel_axes(pixel_scale_factor=1./supersampling)
+        f = supersampling
+        ny_super, nx_super = len(y_axis), len(x_axis)
+        ny_obs, nx_obs = ny_super // f, nx_super // f
+        if ny_obs * f != ny_super or nx_obs * f != nx_super:
+            raise ValueError(f"Downscaling factor {f} is not possible with shape ({ny_super}, {nx_super})")
+        # number of rows of observation pixels evaluated at once
+        bytes_per_row = self._bytes_per_evaluated_point * nx_super * f
+        rows_per_tile = int(max(1, min(ny_obs, max_memory // bytes_per_row)))
+        logging.info(f"Model image evaluated by tiles of {rows_per_tile} row(s) "
+                     f"({int(np.ceil(ny_obs / rows_per_tile))} tiles)")
+        image = np.zeros((ny_obs, nx_obs))
+        overlap_add = None
+        if psf_conv is not None and conv_before_down:
+            overlap_add = _OverlapAddDownsampling(psf_conv, (ny_super, nx_super), f, image)
+        for row_start in range(0, ny_obs, rows_per_tile):
+            row_stop = min(row_start + rows_per_tile, ny_obs)
+            x, y = np.meshgrid(x_axis, y_axis[row_start*f:row_stop*f])
+            tile = self.evaluate_lensed_surface_brightness(x, y)
+            del x, y
+            if psf_conv is not None:
+                tile = self._replace_nan_values(tile)
+            if overlap_add is not None:
+                overlap_add.add_tile(tile, row_start*f)
+            else:
+                image[row_start:row_stop] = util.downsampling(tile, factor=f)
+        if psf_conv is not None and not conv_before_down:
+            # the image is already downscaled, so it is convolved at once
+            image = psf_conv.convolve(image)
+        return image
+
     def model_residuals(self, mask=None, **model_image_kwargs):
-        """computes the normalized residuals map as (data - model) / sigma"""
+        """computes the normalized residuals map as (data - model) / sigma
+        (zero in pixels with infinite noise variance, which carry no information)"""
         model, _ = self.model_image(**model_image_kwargs)
         data = self.coolest.observation.pixels.get_pixels(directory=self.directory)
-        noise = self.coolest.observation.noise
-        if noise.type != 'NoiseMap':
-            raise NotImplementedError
-        sigma = noise.noise_map.get_pixels(directory=self.directory)
+        sigma = np.sqrt(self.noise_variance_map(model))
+        residuals = np.where(np.isfinite(sigma), (data - model) / sigma, 0.)
         if mask is None:
             mask = np.ones_like(model)
-        return ((data - model) / sigma) * mask, self.coord_obs
+        return residuals * mask, self.coord_obs
+
+    def noise_variance_map(self, model_image=None):
+        """Returns the noise variance in each pixel of the observation, 
+        for any of the supported Noise types. The model-independent term is computed
+        the first time it is needed and re-used afterwards as long as the 
+        noise is not replaced, such that only model-dependent terms 
+        (e.g. shot noise from the target flux) are computed at each call.
+
+        Parameters
+        ----------
+        model_image : ndarray, optional
+            Model image, or stack of model images along the last two axes, 
+            required only if the noise is model-dependent, by default None
+
+        Returns
+        -------
+        ndarray
+            Variance map (or stack of variance maps for a stack of model images)
+
+        Raises
+        ------
+        ValueError
+            If the noise is model-dependent and no model image is given.
+        NotImplementedError
+            If the noise type is not supported.
+        """
+        noise = self.coolest.observation.noise
+        fixed_variance, variance_factor = self.get_noise_variance_terms()
+        if variance_factor is None:
+            return fixed_variance
+        if model_image is None:
+            raise ValueError(f"A model image is required for computing the variance of noise type '{noise.type}'.")
+        return noise.combine_variance_terms(fixed_variance, variance_factor, model_image)
+
+    def get_noise_variance_terms(self):
+        """Returns the (cached) model-independent term of the noise variance map, 
+        and the factor map by which the positive part of the model image is multiplied 
+        to obtain the model-dependent term (None if the noise is model-independent).
+        See `Noise.get_variance_map()`."""
+        observation, instrument = self.coolest.observation, self.coolest.instrument
+        noise = observation.noise
+        if self._noise_variance_source is not noise:
+            fixed_variance = np.array(noise.get_fixed_variance_map(observation, instrument, 
+                                                                   directory=self.directory), dtype=float)
+            fixed_variance.flags.writeable = False
+            if noise.model_dependent:
+                variance_factor = np.array(noise.get_model_variance_factor(observation, instrument, 
+                                                                           directory=self.directory), dtype=float)
+                variance_factor.flags.writeable = False
+            else:
+                variance_factor = None
+            self._noise_variance_terms = (fixed_variance, variance_factor)
+            self._noise_variance_source = noise
+        return self._noise_variance_terms
 
     def evaluate_lensed_surface_brightness(self, x, y):
         """Evaluates the surface brightness of a lensed source at given coordinates"""
+        if self.cache is None:
+            return self._eval_lensed_surface_brightness(x, y)
+        key = fingerprint('lensed_surface_brightness', self.lens_mass._model_state(), 
+                          self.source._model_state(), x, y)
+        return self.cache.get_or_compute(key, lambda: self._eval_lensed_surface_brightness(x, y))
+
+    def _eval_lensed_surface_brightness(self, x, y):
         # ray-shooting
         x_rs, y_rs = self.ray_shooting(x, y)
         # evaluates at ray-shooted coordinates
@@ -511,3 +976,53 @@ class ComposableLensModel(object):
     def ray_shooting(self, x, y):
         """evaluates the lens equation beta = theta - alpha(theta)"""
         return self.lens_mass.ray_shooting(x, y)
+
+
+class _OverlapAddDownsampling(object):
+    """Convolves a supersampled image received as consecutive blocks of rows 
+    (overlap-add method), and downsamples the rows of the convolved image 
+    (equivalent to ConvolutionOperator.convolve(..., mode='same')) as soon as 
+    they are complete, such that only a few blocks of rows are kept in memory.
+    """
+
+    def __init__(self, psf_conv, super_shape, factor, output):
+        self.psf_conv = psf_conv
+        kernel_shape = psf_conv.kernel_shape
+        self.factor = factor
+        self.output = output
+        self.num_rows, self.num_cols = super_shape
+        # offsets between the 'full' and 'same' convolution outputs
+        self.offset_rows = (kernel_shape[0] - 1) // 2
+        self.offset_cols = (kernel_shape[1] - 1) // 2
+        # rows of the 'full' convolution not yet completed, starting at row index `self.first_row`
+        self.pending = np.zeros((0, self.num_cols + kernel_shape[1] - 1))
+        self.first_row = 0
+        self.num_output_rows_done = 0
+
+    def add_tile(self, tile, row_start):
+        tile_conv = self.psf_conv.convolve(tile, mode='full')
+        row_stop = row_start + tile_conv.shape[0]
+        num_missing = row_stop - self.first_row - self.pending.shape[0]
+        if num_missing > 0:
+            self.pending = np.concatenate([self.pending, np.zeros((num_missing, self.pending.shape[1]))])
+        self.pending[row_start-self.first_row:row_stop-self.first_row] += tile_conv
+        # rows of the full convolution before the end of the tile will not receive further contributions
+        tile_end = row_start + tile.shape[0]
+        if tile_end == self.num_rows:
+            num_done_same = self.num_rows
+        else:
+            num_done_same = min(self.num_rows, tile_end - self.offset_rows)
+        self._emit_rows(num_done_same // self.factor)
+
+    def _emit_rows(self, num_output_rows):
+        f = self.factor
+        if num_output_rows <= self.num_output_rows_done:
+            return
+        start = self.num_output_rows_done * f + self.offset_rows - self.first_row
+        stop = num_output_rows * f + self.offset_rows - self.first_row
+        rows = self.pending[start:stop, self.offset_cols:self.offset_cols+self.num_cols]
+        self.output[self.num_output_rows_done:num_output_rows] = util.downsampling(rows, factor=f)
+        self.num_output_rows_done = num_output_rows
+        # discards rows of the full convolution that are no longer needed
+        self.pending = self.pending[stop:].copy()
+        self.first_row += stop
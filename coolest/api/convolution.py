@@ -0,0 +1,160 @@
+__author__ = 'aymgal'
+
+import math
+import logging
+import numpy as np
+from scipy import fft
+
+
+__all__ = [
+    'ConvolutionOperator',
+    'GaussianConvolutionOperator',
+]
+
+
+class ConvolutionOperator(object):
+    """Convolves images with a fixed PSF kernel using real FFTs.
+    The kernel is normalized once, and its Fourier transform is computed once
+    for each padded working shape, then re-used for all subsequent convolutions
+    (e.g. several model images, tiles of the same size, or a stack of images
+    such as one image per posterior sample).
+
+    The output is the same as scipy.signal.fftconvolve().
+
+    Parameters
+    ----------
+    kernel : ndarray
+        2D PSF kernel
+    normalize : bool, optional
+        If True, the kernel is normalized to unit sum if it is not already
+        (up to 1e-3), by default True
+    """
+
+    def __init__(self, kernel, normalize=True):
+        # double precision also for the FFTs, which otherwise follow the kernel data type
+        kernel = np.array(kernel, dtype=float)
+        if normalize:
+            kernel_sum = kernel.sum()
+            if not math.isclose(kernel_sum, 1., abs_tol=1e-3):
+                kernel /= kernel_sum
+                logging.warning(f"PSF kernel is not normalized (sum={kernel_sum}), "
+                                f"so it has been normalized before convolution")
+        kernel.flags.writeable = False
+        self.kernel = kernel
+        self._kernel_ffts = {}
+
+    @property
+    def kernel_shape(self):
+        return self.kernel.shape
+
+    def fft_shape(self, image_shape):
+        """Padded shape of the FFTs for convolving an image of a given 2D shape"""
+        full_shape = self._full_shape(image_shape)
+        return tuple(fft.next_fast_len(n, real=True) for n in full_shape)
+
+    def kernel_fft(self, fft_shape):
+        """Returns the (cached) real FFT of the kernel zero-padded to `fft_shape`"""
+        fft_shape = tuple(fft_shape)
+        if fft_shape not in self._kernel_ffts:
+            self._kernel_ffts[fft_shape] = fft.rfft2(self.kernel, s=fft_shape)
+        return self._kernel_ffts[fft_shape]
+
+    def convolve(self, image, mode='same'):
+        """Convolves an image, or a stack of images along the last two axes
+
+        Parameters
+        ----------
+        image : ndarray
+            Image of shape (ny, nx), or stack of images of shape (..., ny, nx)
+        mode : str, optional
+            Either 'same' (output centered and with the same shape as the image)
+            or 'full' (full discrete linear convolution), by default 'same'
+
+        Returns
+        -------
+        ndarray
+            Convolved image(s)
+        """
+        if mode not in ('same', 'full'):
+            raise ValueError(f"Convolution mode must be 'same' or 'full' (received '{mode}').")
+        image_shape = np.shape(image)[-2:]
+        full_shape = self._full_shape(image_shape)
+        fft_shape = self.fft_shape(image_shape)
+        image_fft = fft.rfft2(image, s=fft_shape)
+        conv = fft.irfft2(image_fft * self.kernel_fft(fft_shape), s=fft_shape)
+        conv = conv[..., :full_shape[0], :full_shape[1]]
+        if mode == 'full':
+            return conv
+        start_0 = (self.kernel_shape[0] - 1) // 2
+        start_1 = (self.kernel_shape[1] - 1) // 2
+        return conv[..., start_0:start_0+image_shape[0], start_1:start_1+image_shape[1]].copy()
+
+    def _full_shape(self, image_shape):
+        return (image_shape[0] + self.kernel_shape[0] - 1,
+                image_shape[1] + self.kernel_shape[1] - 1)
+
+
+class GaussianConvolutionOperator(ConvolutionOperator):
+    """Convolves images with a circular Gaussian PSF, by multiplying their Fourier
+    transform with the analytic Gaussian transfer function. No kernel image is built:
+    the PSF is the continuous Gaussian profile sampled at the pixel centers 
+    (with no truncation) and normalized to unit sum.
+    The transfer function is computed once for each padded working shape.
+
+    Images are zero-padded by `num_sigma` standard deviations on each side before 
+    the (circular) FFT convolution, such that the output matches a linear convolution
+    up to the Gaussian tails beyond that distance (less than 1e-13 for the default value).
+    Accordingly, this is equivalent to a kernel of shape `kernel_shape` for 
+    the 'full' convolution mode.
+
+    Parameters
+    ----------
+    fwhm : float
+        Full width at half maximum, in units of the pixel size of the images to be convolved
+    num_sigma : float, optional
+        Padding size in units of the standard deviation of the Gaussian, by default 8
+    """
+
+    def __init__(self, fwhm, num_sigma=8):
+        if fwhm <= 0:
+            raise ValueError(f"Gaussian PSF FWHM must be positive (received {fwhm}).")
+        self.fwhm = float(fwhm)
+        self.sigma = self.fwhm / (2. * np.sqrt(2. * np.log(2.)))
+        self._half_size = int(np.ceil(num_sigma * self.sigma))
+        # aliases are negligible beyond a few sampling frequencies, unless the Gaussian is very narrow
+        self._num_aliases = int(np.ceil(1. / self.sigma)) + 2
+        self._kernel_ffts = {}
+
+    @property
+    def kernel_shape(self):
+        return (2 * self._half_size + 1, 2 * self._half_size + 1)
+
+    @property
+    def kernel(self):
+        """Gaussian profile evaluated on a pixel grid of shape `kernel_shape`
+        (not used for the convolution)"""
+        coords = np.arange(-self._half_size, self._half_size + 1)
+        profile_1d = np.exp(- coords**2 / (2. * self.sigma**2))
+        kernel = np.outer(profile_1d, profile_1d)
+        return kernel / kernel.sum()
+
+    def kernel_fft(self, fft_shape):
+        """Returns the (cached) Gaussian transfer function on the real FFT grid of shape `fft_shape`,
+        including the phase shift corresponding to a kernel centered at index `kernel_shape // 2`"""
+        fft_shape = tuple(fft_shape)
+        if fft_shape not in self._kernel_ffts:
+            freq_y = fft.fftfreq(fft_shape[0])
+            freq_x = fft.rfftfreq(fft_shape[1])
+            transfer = np.outer(self._transfer_1d(freq_y), self._transfer_1d(freq_x))
+            shift_y = np.exp(- 2j * np.pi * self._half_size * freq_y)
+            shift_x = np.exp(- 2j * np.pi * self._half_size * freq_x)
+            self._kernel_ffts[fft_shape] = transfer * np.outer(shift_y, shift_x)
+        return self._kernel_ffts[fft_shape]
+
+    def _transfer_1d(self, freq):
+        # Fourier transform of the Gaussian sampled at integer positions, i.e. the sum 
+        # of the aliases of the continuous transfer function, normalized to unit sum
+        aliases = np.arange(-self._num_aliases, self._num_aliases + 1)
+        def periodized(f):
+            return np.exp(- 2. * np.pi**2 * self.sigma**2 * (f[..., None] + aliases)**2).sum(axis=-1)
+        return periodized(freq) / periodized(np.zeros(1))
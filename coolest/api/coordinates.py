@@ -155,6 +155,35 @@ class Coordinates(object):
         Coordinates
             New instance of a Coordinates object
         """
+        transform = self._new_transform(pixel_scale_factor, grid_center, grid_shape)
+        # in case it's the same region as the base coordinate grid
+        if transform is None:
+            return copy.deepcopy(self)
+        return Coordinates(*transform)
+
+    def new_pixel_axes(self, pixel_scale_factor=None, 
+                       grid_center=None, grid_shape=None):
+        """Returns the 1D x and y axes of the coordinates grid that would be created
+        by `create_new_coordinates()` with the same arguments, without creating 
+        the 2D coordinates arrays (e.g., to evaluate large supersampled grids by parts).
+        
+        Note that this assumes that the coordinates axes are aligned with the x/y axes.
+
+        Returns
+        -------
+        (ndarray, ndarray)
+            x and y 1D coordinates axes
+        """
+        transform = self._new_transform(pixel_scale_factor, grid_center, grid_shape)
+        if transform is None:
+            return self.pixel_axes
+        nx, ny, matrix_pix2ang, x_at_ij_0, y_at_ij_0 = transform
+        # same operations as in grid_from_coordinate_transform()
+        x_axis = np.arange(nx) * matrix_pix2ang[0, 0] + x_at_ij_0
+        y_axis = np.arange(ny) * matrix_pix2ang[1, 1] + y_at_ij_0
+        return x_axis, y_axis
+
+    def _new_transform(self, pixel_scale_factor, grid_center, grid_shape):
         unchanged_count = 0
         if grid_center is None or grid_center == self.center:
             grid_center_ = self.center
@@ -171,10 +200,8 @@ class Coordinates(object):
             unchanged_count += 1
         else:
             pixel_scale_factor_ = pixel_scale_factor
-
-        # in case it's the same region as the base coordinate grid
         if unchanged_count == 3:
-            return copy.deepcopy(self)
+            return None
 
         pixel_size = self.pixel_size * float(pixel_scale_factor_)
         center_x, center_y = grid_center_
@@ -188,4 +215,4 @@ class Coordinates(object):
         cra, cdec = matrix_pix2ang.dot(np.array([cx, cy]))
         x_at_ij_0, y_at_ij_0 = - cra + center_x + pixel_size/2., - cdec + center_y + pixel_size/2.
 
-        return Coordinates(nx, ny, matrix_pix2ang, x_at_ij_0, y_at_ij_0)
+        return nx, ny, matrix_pix2ang, x_at_ij_0, y_at_ij_0
@@ -0,0 +1,164 @@
+__author__ = 'aymgal'
+
+import numpy as np
+from scipy import sparse
+
+
+__all__ = [
+    'LensingOperator',
+]
+
+
+class LensingOperator(object):
+    """Sparse linear operator which maps the values of a pixelated source
+    (pixels of a regular grid, or z values of an irregular grid) to the pixels
+    of the lensed image, possibly including supersampling, downsampling and
+    PSF convolution. It is typically built once for a given mass model
+    with `ComposableLensModel.lensing_operator()`, and then re-used to render
+    many sources, compute residuals or form the normal equations of a linear inversion.
+
+    Instances only hold arrays, such that they can be pickled (e.g. sent to other processes),
+    or saved to and loaded from a file with `save()` and `load()`.
+
+    Parameters
+    ----------
+    matrix : sparse matrix
+        Matrix of shape (number of image pixels, number of source pixels)
+    image_shape : tuple
+        Shape of the image
+    source_shape : tuple
+        Shape of the source values (e.g. (ny, nx) for a regular grid, (n,) for an irregular grid)
+
+    Raises
+    ------
+    ValueError
+        If the matrix shape is inconsistent with the image and source shapes.
+    """
+
+    def __init__(self, matrix, image_shape, source_shape):
+        self.matrix = sparse.csr_matrix(matrix)
+        self.image_shape = tuple(int(n) for n in image_shape)
+        self.source_shape = tuple(int(n) for n in source_shape)
+        if self.matrix.shape != (int(np.prod(self.image_shape)), int(np.prod(self.source_shape))):
+            raise ValueError(f"Matrix shape {self.matrix.shape} is inconsistent with "
+                             f"image shape {self.image_shape} and source shape {self.source_shape}.")
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def __call__(self, source_values):
+        return self.apply(source_values)
+
+    def apply(self, source_values):
+        """Computes the lensed image of source values, or of a stack of source values
+        (along the leading axes)
+
+        Parameters
+        ----------
+        source_values : ndarray
+            Source values of shape `source_shape`, or (..., *source_shape)
+
+        Returns
+        -------
+        ndarray
+            Lensed image of shape `image_shape`, or (..., *image_shape)
+        """
+        source_values = np.asarray(source_values, dtype=float)
+        batch_shape = source_values.shape[:source_values.ndim-len(self.source_shape)]
+        values = source_values.reshape(-1, self.matrix.shape[1]).T
+        image = self.matrix.dot(values).T
+        return image.reshape(*batch_shape, *self.image_shape)
+
+    def adjoint(self, image):
+        """Applies the transposed operator to an image, or to a stack of images
+        (along the leading axes), which returns arrays of shape (..., *source_shape)"""
+        image = np.asarray(image, dtype=float)
+        batch_shape = image.shape[:image.ndim-len(self.image_shape)]
+        values = image.reshape(-1, self.matrix.shape[0]).T
+        source_values = self.matrix.T.dot(values).T
+        return source_values.reshape(*batch_shape, *self.source_shape)
+
+    def normal_equations(self, data, noise_variance=None, mask=None):
+        """Computes the terms of the normal equations M^T W M s = M^T W d
+        of the weighted least-squares problem for the source values s, where M is the
+        lensing operator, d the data and W the diagonal matrix of inverse noise variances
+        (zero for masked pixels).
+
+        Parameters
+        ----------
+        data : ndarray
+            Data image of shape `image_shape`
+        noise_variance : ndarray, optional
+            Noise variance map (or scalar), by default None (unit variance)
+        mask : ndarray, optional
+            Binary mask (1 for pixels included), by default None
+
+        Returns
+        -------
+        (sparse matrix, ndarray)
+            M^T W M of shape (number of source pixels, number of source pixels),
+            and M^T W d as a 1D array
+        """
+        weights = np.ones(self.matrix.shape[0])
+        if noise_variance is not None:
+            weights = weights / np.broadcast_to(noise_variance, self.image_shape).ravel()
+        if mask is not None:
+            weights = weights * np.asarray(mask, dtype=float).ravel()
+        weighted_matrix = sparse.diags(weights).dot(self.matrix)
+        lhs = self.matrix.T.dot(weighted_matrix).tocsr()
+        rhs = weighted_matrix.T.dot(np.asarray(data, dtype=float).ravel())
+        return lhs, rhs
+
+    def save(self, file_path):
+        """Saves the operator to a (numpy .npz) file"""
+        matrix = self.matrix
+        np.savez_compressed(file_path, data=matrix.data, indices=matrix.indices,
+                            indptr=matrix.indptr, matrix_shape=np.array(matrix.shape),
+                            image_shape=np.array(self.image_shape),
+                            source_shape=np.array(self.source_shape))
+
+    @classmethod
+    def load(cls, file_path):
+        """Loads an operator saved with `save()`"""
+        with np.load(file_path) as content:
+            matrix = sparse.csr_matrix((content['data'], content['indices'], content['indptr']),
+                                       shape=tuple(content['matrix_shape']))
+            return cls(matrix, tuple(content['image_shape']), tuple(content['source_shape']))
+
+
+def downsampling_matrix(image_shape, factor):
+    """Returns the sparse matrix which averages blocks of factor x factor pixels
+    of a (flattened) image, as `util.downsampling()`"""
+    num_rows, num_cols = image_shape
+    if num_rows % factor != 0 or num_cols % factor != 0:
+        raise ValueError(f"Downscaling factor {factor} is not possible with shape {image_shape}")
+    rows, cols = np.indices(image_shape)
+    indices_down = (rows // factor) * (num_cols // factor) + cols // factor
+    size_down = (num_rows // factor) * (num_cols // factor)
+    return sparse.csr_matrix((np.full(rows.size, 1. / factor**2), (indices_down.ravel(), np.arange(rows.size))),
+                             shape=(size_down, rows.size))
+
+
+def convolution_matrix(kernel, image_shape):
+    """Returns the sparse matrix which convolves a (flattened) image with a kernel,
+    as `ConvolutionOperator.convolve(..., mode='same')`.
+    The number of non-zero elements is about the number of pixels times the kernel size."""
+    num_rows, num_cols = image_shape
+    offset_rows, offset_cols = (kernel.shape[0] - 1) // 2, (kernel.shape[1] - 1) // 2
+    rows_out, cols_out = np.indices(image_shape)
+    all_rows, all_cols, all_values = [], [], []
+    for (a, b), value in np.ndenumerate(kernel):
+        if value == 0:
+            continue
+        rows_in = rows_out + offset_rows - a
+        cols_in = cols_out + offset_cols - b
+        valid = (rows_in >= 0) & (rows_in < num_rows) & (cols_in >= 0) & (cols_in < num_cols)
+        all_rows.append(rows_out[valid] * num_cols + cols_out[valid])
+        all_cols.append(rows_in[valid] * num_cols + cols_in[valid])
+        all_values.append(np.full(all_rows[-1].size, value))
+    size = num_rows * num_cols
+    if len(all_values) == 0:
+        return sparse.csr_matrix((size, size))
+    return sparse.csr_matrix((np.concatenate(all_values), (np.concatenate(all_rows), np.concatenate(all_cols))),
+                             shape=(size, size))
@@ -0,0 +1,274 @@
+__author__ = 'aymgal'
+
+import time
+import logging
+import numpy as np
+
+from coolest.api.composable_models import ComposableLensModel
+from coolest.api.chain_reader import get_chain_reader
+
+
+__all__ = [
+    'ImagingLikelihood',
+]
+
+
+class ImagingLikelihood(object):
+    """Evaluates the Gaussian imaging data likelihood of a lens model stored
+    in the COOLEST format, for one or many vectors of parameter values.
+
+    The data, the noise and the mask of the `ImagingDataLikelihood` are read
+    a single time, and only unmasked pixels are kept for computing the chi-square
+
+        chi2 = sum_{unmasked pixels} (data - model)^2 / sigma^2
+
+    and the log-likelihood logL = - chi2 / 2 - sum_{unmasked pixels} log(2 pi sigma^2) / 2.
+    The noise variance sigma^2 is computed for any Noise type (see `Noise.get_variance_map()`).
+    Its model-independent terms are computed once, such that model-dependent 
+    noise (e.g. shot noise from the target flux) only adds a few operations per pixel.
+    Pixels with an infinite variance (e.g. zero weight in the weight map of a `DrizzledNoise`)
+    carry no information, hence they are excluded from the mask.
+
+    Parameter vectors contain the values of the (scalar) parameters of the
+    selected lens mass and source light profiles, ordered as in `parameter_ids`.
+    Other parameters (e.g. pixelated profiles) are fixed to their point estimates.
+
+    Parameters
+    ----------
+    coolest_object : COOLEST
+        COOLEST instance
+    coolest_directory : str, optional
+        Directory which contains the COOLEST template and FITS files, by default None
+    kwargs_selection_source : dict, optional
+        Selection of the source light profiles (see ComposableLightModel), by default None
+    kwargs_selection_lens_mass : dict, optional
+        Selection of the lens mass profiles (see ComposableMassModel), by default None
+    mask : ndarray, optional
+        Binary mask (1 for pixels included in the likelihood) used if the COOLEST
+        object has no ImagingDataLikelihood, by default None (all pixels are used)
+    batch_size : int, optional
+        Maximum number of parameter vectors for which model images are computed at once.
+        If None, it is chosen such that a batch contains at most ~1 million
+        evaluated points. By default None
+    **model_image_kwargs : dict, optional
+        Keyword arguments passed to ComposableLensModel.model_image()
+
+    Raises
+    ------
+    NotImplementedError
+        If the noise type is not supported.
+    """
+
+    _max_points_per_batch = 2**20
+
+    def __init__(self, coolest_object, coolest_directory=None,
+                 kwargs_selection_source=None, kwargs_selection_lens_mass=None,
+                 mask=None, batch_size=None, **model_image_kwargs):
+        self.coolest = coolest_object
+        self.directory = coolest_directory
+        self.lens_model = ComposableLensModel(coolest_object, coolest_directory,
+                                              kwargs_selection_source=kwargs_selection_source,
+                                              kwargs_selection_lens_mass=kwargs_selection_lens_mass)
+        self.model_image_kwargs = model_image_kwargs
+        self.batch_size = batch_size
+        self._setup_parameters()
+        self._setup_data(mask)
+        self.throughput = None
+
+    @property
+    def num_parameters(self):
+        return len(self.parameter_ids)
+
+    @property
+    def num_pixels(self):
+        """Number of pixels included in the likelihood"""
+        return self._data.size
+
+    def point_estimate_vector(self):
+        """Returns the vector of point estimates of the parameters"""
+        return np.array([self._models[m].param_list[k][name]
+                         for m, k, name in self._param_locations], dtype=float)
+
+    def chi2(self, param_vector):
+        """Returns the chi-square for a single vector of parameter values"""
+        return self.evaluate_batch(np.atleast_2d(param_vector))[0][0]
+
+    def log_likelihood(self, param_vector):
+        """Returns the log-likelihood for a single vector of parameter values"""
+        return self.evaluate_batch(np.atleast_2d(param_vector))[1][0]
+
+    def chi2_from_image(self, model_image):
+        """Returns the chi-square of a model image or a stack of model images
+        (the image axes being the last two axes)"""
+        return self._evaluate_images(model_image)[0]
+
+    def log_likelihood_from_image(self, model_image):
+        """Returns the log-likelihood of a model image or a stack of model images
+        (the image axes being the last two axes)"""
+        chi2, log_norm = self._evaluate_images(model_image)
+        return - 0.5 * chi2 + log_norm
+
+    def log_likelihood_from_chi2(self, chi2):
+        """Returns the log-likelihood from the chi-square, 
+        only for noise that does not depend on the model"""
+        if self._variance_factor is not None:
+            raise ValueError("The likelihood normalization depends on the model image "
+                             "for this noise type; use log_likelihood_from_image() instead.")
+        return - 0.5 * chi2 + self._log_norm
+
+    def evaluate_batch(self, param_vectors):
+        """Evaluates the chi-square and the log-likelihood for a batch of parameter vectors.
+        The throughput (in samples per second) is logged and stored in `throughput`.
+
+        Parameters
+        ----------
+        param_vectors : array_like
+            2D array of shape (num_samples, num_parameters),
+            with parameters ordered as in `parameter_ids`
+
+        Returns
+        -------
+        (ndarray, ndarray)
+            Chi-square and log-likelihood values for each vector
+
+        Raises
+        ------
+        ValueError
+            If the number of parameters is inconsistent.
+        """
+        param_vectors = np.atleast_2d(np.asarray(param_vectors, dtype=float))
+        if param_vectors.shape[1] != self.num_parameters:
+            raise ValueError(f"Parameter vectors must have {self.num_parameters} elements "
+                             f"(received {param_vectors.shape[1]}).")
+        num_samples = param_vectors.shape[0]
+        batch_size = self._get_batch_size()
+        chi2, log_norm = np.empty(num_samples), np.empty(num_samples)
+        start_time = time.perf_counter()
+        for start in range(0, num_samples, batch_size):
+            stop = min(start + batch_size, num_samples)
+            model_images = self._model_images(param_vectors[start:stop])
+            chi2[start:stop], log_norm[start:stop] = self._evaluate_images(model_images)
+        elapsed_time = time.perf_counter() - start_time
+        self.throughput = num_samples / max(elapsed_time, 1e-12)
+        logging.info(f"Likelihood evaluated for {num_samples} samples in {elapsed_time:.3f} s "
+                     f"({self.throughput:.1f} samples/s)")
+        return chi2, - 0.5 * chi2 + log_norm
+
+    def evaluate_chain(self, last_n_samples=None):
+        """Evaluates the chi-square and the log-likelihood for the samples of the
+        chain file referred to in the COOLEST metadata. Parameters absent
+        from the chain are fixed to their point estimates.
+
+        Parameters
+        ----------
+        last_n_samples : int, optional
+            If provided, only the last samples are evaluated, by default None
+
+        Returns
+        -------
+        (ndarray, ndarray)
+            Chi-square and log-likelihood values for each sample
+        """
+        chain = get_chain_reader(self.coolest, self.directory)
+        point_values = self.point_estimate_vector()
+        param_vectors = np.empty((chain.num_samples, self.num_parameters))
+        for i, param_id in enumerate(self.parameter_ids):
+            if chain.has_column(param_id):
+                param_vectors[:, i] = chain.column(param_id)
+            else:
+                param_vectors[:, i] = point_values[i]
+        if last_n_samples is not None and last_n_samples > 0:
+            param_vectors = param_vectors[-last_n_samples:]
+        return self.evaluate_batch(param_vectors)
+
+    def _evaluate_images(self, model_image):
+        # chi-square and normalization of the log-likelihood
+        model_image = np.asarray(model_image)
+        model_pixels = model_image[..., self.mask]
+        residuals = model_pixels - self._data
+        if self._variance_factor is None:
+            chi2 = np.sum(residuals**2 * self._inv_variance, axis=-1)
+            return chi2, np.full(np.shape(chi2), self._log_norm)
+        variance = self._fixed_variance + self._variance_factor * np.maximum(model_pixels, 0.)
+        chi2 = np.sum(residuals**2 / variance, axis=-1)
+        log_norm = - 0.5 * np.sum(np.log(2. * np.pi * variance), axis=-1)
+        return chi2, log_norm
+
+    def _model_images(self, param_vectors):
+        # evaluates model images with parameters having a leading sample axis
+        num_samples = param_vectors.shape[0]
+        saved_param_lists = [model.param_list for model in self._models]
+        try:
+            for model in self._models:
+                model.param_list = [dict(params) for params in model.param_list]
+            for i, (m, k, name) in enumerate(self._param_locations):
+                if num_samples == 1:
+                    value = param_vectors[0, i]
+                else:
+                    value = param_vectors[:, i].reshape(num_samples, 1, 1)
+                self._models[m].param_list[k][name] = value
+            image, _ = self.lens_model.model_image(**self.model_image_kwargs)
+        finally:
+            for model, param_list in zip(self._models, saved_param_lists):
+                model.param_list = param_list
+        return np.broadcast_to(image, (num_samples,) + self.mask.shape)
+
+    def _get_batch_size(self):
+        if self.batch_size is not None:
+            return max(1, int(self.batch_size))
+        if self.model_image_kwargs.get('max_memory', None) is not None:
+            return 1  # tiled evaluation of each model image
+        # supersampling actually used by the model image (e.g. adapted to the PSF)
+        supersampling = self.lens_model.get_supersampling(**self.model_image_kwargs)
+        num_points = self.mask.size * supersampling**2
+        return max(1, self._max_points_per_batch // num_points)
+
+    def _setup_parameters(self):
+        self._models = [self.lens_model.lens_mass, self.lens_model.source]
+        self.parameter_ids = []
+        self._param_locations = []  # (model index, profile index, parameter name)
+        for m, model in enumerate(self._models):
+            for k, param_ids in enumerate(model.param_id_list):
+                if param_ids is None:
+                    continue
+                for name, param_id in param_ids.items():
+                    if np.ndim(model.param_list[k][name]) != 0:
+                        continue  # e.g. shapelets amplitudes
+                    self.parameter_ids.append(param_id)
+                    self._param_locations.append((m, k, name))
+
+    def _setup_data(self, user_mask):
+        observation = self.coolest.observation
+        data = observation.pixels.get_pixels(directory=self.directory)
+        fixed_variance, variance_factor = self.lens_model.get_noise_variance_terms()
+        mask = self._get_mask(user_mask)
+        if mask is None:
+            mask = np.ones(data.shape, dtype=bool)
+        mask = np.asarray(mask).astype(bool)
+        has_info = np.isfinite(np.broadcast_to(fixed_variance, data.shape))
+        if variance_factor is not None:
+            has_info &= np.isfinite(np.broadcast_to(variance_factor, data.shape))
+        if np.any(mask & ~has_info):
+            logging.info(f"{int(np.sum(mask & ~has_info))} pixels with infinite noise variance "
+                         f"are excluded from the likelihood.")
+        self.mask = mask & has_info
+        self._data = np.asarray(data, dtype=float)[self.mask]
+        self._fixed_variance = np.broadcast_to(fixed_variance, data.shape)[self.mask]
+        if variance_factor is None:
+            self._variance_factor = None
+            self._inv_variance = 1. / self._fixed_variance
+            self._log_norm = - 0.5 * np.sum(np.log(2. * np.pi * self._fixed_variance))
+        else:
+            self._variance_factor = np.broadcast_to(variance_factor, data.shape)[self.mask]
+
+    def _get_mask(self, user_mask):
+        likelihoods = self.coolest.likelihoods
+        if likelihoods is None:
+            return user_mask
+        try:
+            img_ll = likelihoods[likelihoods.index('ImagingDataLikelihood')]
+        except ValueError:
+            return user_mask
+        if img_ll.mask is None:
+            return user_mask
+        return img_ll.get_mask_pixels(directory=self.directory)
@@ -7,7 +7,6 @@ import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib import ticker
 from mpl_toolkits.axes_grid1 import make_axes_locatable
-from scipy.spatial import Voronoi, voronoi_plot_2d
 from matplotlib.colors import Normalize, LogNorm, TwoSlopeNorm
 from matplotlib.cm import ScalarMappable
 from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
@@ -35,6 +34,7 @@ def plot_voronoi(ax, x, y, z, neg_values_as_bad=False,
         norm = Normalize(zmin, zmax)
 
     # get voronoi regions
+    from scipy.spatial import Voronoi  # imported at first use, as scipy.spatial is slow to import
     voronoi_points = np.column_stack((x,y))
     vor = Voronoi(voronoi_points)
     new_regions, vertices = voronoi_finite_polygons_2d(vor)
@@ -8,14 +8,13 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import Normalize, LogNorm, TwoSlopeNorm
 from matplotlib.colors import ListedColormap
-from getdist import plots, chains, MCSamples
 
 from coolest.api.analysis import Analysis
 from coolest.api.composable_models import *
 from coolest.api import util
 from coolest.api import plot_util as plut
-
-import pandas as pd
+from coolest.api.chain_reader import get_chain_reader
+from coolest.api.cache import EvaluationCache
 
 
 # matplotlib global settings
@@ -44,12 +43,22 @@ class ModelPlotter(object):
     color_bad_values : str, optional
         Color assigned to NaN values (typically negative values in log-scale), 
         by default '#111111' (dark gray)
+    evaluation_cache : EvaluationCache or bool, optional
+        If True or an EvaluationCache instance, fields evaluated for a panel 
+        (e.g. convergence, magnification, lensed surface brightness) are memoized
+        and re-used by other panels that need them on the same coordinates grid, 
+        such that each field is computed only once per figure. By default False
     """
 
     def __init__(self, coolest_object, coolest_directory=None, 
-                 color_bad_values='#222222'):
+                 color_bad_values='#222222', evaluation_cache=False):
         self.coolest = coolest_object
         self._directory = coolest_directory
+        if evaluation_cache is True:
+            evaluation_cache = EvaluationCache()
+        elif evaluation_cache is False:
+            evaluation_cache = None
+        self.cache = evaluation_cache
 
         self.cmap_flux = copy.copy(plt.get_cmap('magma'))
         self.cmap_flux.set_bad(color_bad_values)
@@ -96,15 +105,17 @@ class ModelPlotter(object):
             raise ValueError("`extent_irreg` is deprecated; use `xylim` instead.")
         if kwargs_light is None:
             kwargs_light = {}
-        light_model = ComposableLightModel(self.coolest, self._directory, **kwargs_light)
+        light_model = ComposableLightModel(self.coolest, self._directory, cache=self.cache, **kwargs_light)
         if plot_caustics:
             if kwargs_lens_mass is None:
                 raise ValueError("`kwargs_lens_mass` must be provided to compute caustics")
             if coordinates_lens is None:
-                coordinates_lens = util.get_coordinates(self.coolest).create_new_coordinates(pixel_scale_factor=0.1)
+                # critical lines are refined below the grid resolution, hence the grid can be coarse
+                coordinates_lens = util.get_coordinates(self.coolest)
             # NOTE: here we assume that `kwargs_light` is for the source!
-            mass_model = ComposableMassModel(self.coolest, self._directory, **kwargs_lens_mass)
-            _, caustics = util.find_all_lens_lines(coordinates_lens, mass_model)
+            mass_model = ComposableMassModel(self.coolest, self._directory, cache=self.cache, **kwargs_lens_mass)
+            _, caustics = util.find_all_lens_lines(coordinates_lens, mass_model, 
+                                                   point_spacing=coordinates_lens.pixel_size/10.)
         if cmap is None:
             cmap = self.cmap_flux
         if coordinates is not None:
@@ -153,7 +164,8 @@ class ModelPlotter(object):
             cmap = self.cmap_flux
         lens_model = ComposableLensModel(self.coolest, self._directory,
                                          kwargs_selection_source=kwargs_source,
-                                         kwargs_selection_lens_mass=kwargs_lens_mass)
+                                         kwargs_selection_lens_mass=kwargs_lens_mass,
+                                         cache=self.cache)
         image, coordinates = lens_model.model_image(**model_image_kwargs)
         extent = coordinates.plt_extent
         ax, im = plut.plot_regular_grid(ax, title, image, extent=extent, 
@@ -181,7 +193,8 @@ class ModelPlotter(object):
         ll_mask = self._get_likelihood_mask(mask)
         lens_model = ComposableLensModel(self.coolest, self._directory,
                                          kwargs_selection_source=kwargs_source,
-                                         kwargs_selection_lens_mass=kwargs_lens_mass)
+                                         kwargs_selection_lens_mass=kwargs_lens_mass,
+                                         cache=self.cache)
         image, coordinates = lens_model.model_residuals(mask=ll_mask, **model_image_kwargs)
         extent = coordinates.plt_extent
         ax, im = plut.plot_regular_grid(ax, title, image, extent=extent, 
@@ -212,7 +225,7 @@ class ModelPlotter(object):
         if kwargs_lens_mass is None:
             kwargs_lens_mass = {}
         mass_model = ComposableMassModel(self.coolest, self._directory,
-                                         **kwargs_lens_mass)
+                                         cache=self.cache, **kwargs_lens_mass)
         if cmap is None:
             cmap = self.cmap_conv
         if coordinates is None:
@@ -243,7 +256,7 @@ class ModelPlotter(object):
         if kwargs_lens_mass is None:
             kwargs_lens_mass = {}
         mass_model = ComposableMassModel(self.coolest, self._directory,
-                                         **kwargs_lens_mass)
+                                         cache=self.cache, **kwargs_lens_mass)
         if cmap is None:
             cmap = self.cmap_res
         if norm is None:
@@ -282,7 +295,7 @@ class ModelPlotter(object):
         if kwargs_lens_mass is None:
             kwargs_lens_mass = {}
         mass_model = ComposableMassModel(self.coolest, self._directory,
-                                         **kwargs_lens_mass)
+                                         cache=self.cache, **kwargs_lens_mass)
         if cmap is None:
             cmap = self.cmap_mag
         if norm is None:
@@ -313,7 +326,7 @@ class ModelPlotter(object):
         if kwargs_lens_mass is None:
             kwargs_lens_mass = {}
         mass_model = ComposableMassModel(self.coolest, self._directory,
-                                        **kwargs_lens_mass)
+                                        cache=self.cache, **kwargs_lens_mass)
         if cmap is None:
             cmap = self.cmap_res
         if norm is None:
@@ -560,6 +573,7 @@ class ParametersPlotter(object):
         ValueError
             If the csv file containing samples is is not coma (,) separated.
         """
+        from getdist import chains, MCSamples  # imported at first use, as getdist is slow to import
         chains.print_load_details = False # Just to silence messages
         parameter_id_set = set(self.parameter_id_list)
 
@@ -584,23 +598,14 @@ class ParametersPlotter(object):
         samples_margin, weights_margin = None, None
         mysample_margin = None
         for i in range(self.num_models):
-            chain_file = os.path.join(self.coolest_directories[i],self.coolest_objects[i].meta["chain_file_name"]) # Here get the chain file path for each coolest object
+            # Get the (cached) columns of the chain file associated to each coolest object
+            chain = get_chain_reader(self.coolest_objects[i], self.coolest_directories[i])
 
             # Each chain file can have a different number of free parameters
-            f = open(chain_file)
-            header = f.readline()
-            f.close()
-
-            if ';' in header:
-                raise ValueError("Columns must be coma-separated (no semi-colon) in chain file.")
-
-            chain_file_headers = header.split(',')
-            num_cols = len(chain_file_headers)
-            chain_file_headers.pop() # Remove the last column name that is the probability weights
-            chain_file_headers_set = set(chain_file_headers)
+            chain_file_headers_set = set(chain.parameter_ids)
             
             # Check that the given parameters are a subset of those in the chain file
-            assert parameter_id_set.issubset(chain_file_headers_set), "Not all given parameters are free parameters for model %d (not in the chain file: %s)!" % (i,chain_file)
+            assert parameter_id_set.issubset(chain_file_headers_set), "Not all given parameters are free parameters for model %d (not in the chain file: %s)!" % (i,chain.file_path)
 
             # Set the labels for the parameters in the chain file
             labels = []
@@ -608,13 +613,8 @@ class ParametersPlotter(object):
                 param = self.coolest_objects[i].lensing_entities.get_parameter_from_id(par_id)
                 labels.append(param.latex_str.strip('$'))
 
-            # Read parameter values and probability weights
-            column_indices = [chain_file_headers.index(par_id) for par_id in self.parameter_id_list]
-            columns_to_read = sorted(column_indices) + [num_cols-1]  # add last one for probability weights
-            samples = pd.read_csv(chain_file, usecols=columns_to_read, delimiter=',')
-        
-            # Re-order columns to match self.parameter_id_list and labels
-            sample_par_values = np.array(samples[self.parameter_id_list])
+            # Get parameter values ordered as self.parameter_id_list and labels
+            sample_par_values = chain.columns(self.parameter_id_list)
 
             # If needed, shift samples by a constant
             if shift_sample_list[i] is not None:
@@ -624,7 +624,7 @@ class ParametersPlotter(object):
                                  f"has been shifted by {value}.")
 
             # Clean-up the probability weights
-            mypost = np.array(samples['probability_weights'])
+            mypost = np.array(chain.weights)
             min_non_zero = np.min(mypost[np.nonzero(mypost)])
             sample_prob_weight = np.where(mypost<min_non_zero, min_non_zero, mypost)
             #sample_prob_weight = mypost
@@ -701,6 +701,7 @@ class ParametersPlotter(object):
             # alphas[-1] = 0.7
     
         # Make the plot
+        from getdist import plots
         g = plots.get_subplot_plotter(**subplot_kwargs)
         if legend_fontsize is not None:
             g.settings.legend_fontsize = legend_fontsize 
@@ -782,6 +783,7 @@ class ParametersPlotter(object):
         if legend_ncol is None:
             legend_ncol = 3
         # Make the plot
+        from getdist import plots
         g = plots.get_subplot_plotter(**subplot_kwargs)
         if legend_fontsize is not None:
             g.settings.legend_fontsize = legend_fontsize
@@ -834,6 +836,7 @@ class ParametersPlotter(object):
         if legend_ncol is None:
             legend_ncol = 3
         # Make the plot
+        from getdist import plots
         g = plots.get_subplot_plotter(**subplot_kwargs)
         if legend_fontsize is not None:
             g.settings.legend_fontsize = legend_fontsize
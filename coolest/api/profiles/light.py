@@ -2,13 +2,14 @@ __author__ = 'aymgal', 'lynevdv', 'Giorgos Vernardos'
 
 
 import numpy as np
-from scipy import interpolate
+from scipy import interpolate, sparse, spatial
 
 from coolest.template.classes.profiles.light import (Sersic as TemplateSersic,
                                                      Shapelets as TemplateShapelets,
                                                      PixelatedRegularGrid as TemplatePixelatedRegularGrid,
                                                      IrregularGrid as TemplateIrregularGrid)
 from coolest.api.profiles import util
+from coolest.api.cache import fingerprint
 
 
 class BaseLightProfile(object):
@@ -73,31 +74,85 @@ class Sersic(BaseLightProfile):
 
 class Shapelets(BaseLightProfile):
 
-    """Elliptical Sersic
+    """Set of cartesian shapelets with maximum order n_max, based on the developments of :cite:t:`Refregier2003`.
     
-    The implementation uses functions from `lenstronomy` (:cite:t:`lenstronomy2018`, :cite:t:`lenstronomy2021`), based on the developments of :cite:t:`Refregier2003`.
+    The basis functions and the ordering of the amplitudes follow the implementation in 
+    `lenstronomy` (:cite:t:`lenstronomy2018`, :cite:t:`lenstronomy2021`), but the Hermite functions 
+    are computed with their stable recurrence relation. The 1D basis functions along x and y are cached 
+    for the last (coordinates, n_max, beta, center) evaluated, such that evaluating new amplitudes 
+    only requires matrix products.
     """
 
     _units = 'per_ang'
     _template_class = TemplateShapelets()
 
     def __init__(self):
-        from lenstronomy.LightModel.Profiles.shapelets import ShapeletSet
-        self._backend = ShapeletSet()
+        self._cache_basis = (None, None, None, None)
 
     def surface_brightness(self, amps=0, n_max=0, beta=0, center_x=0, center_y=0):
         raise ValueError("Surface brightness of a set of shapelets can only be evaluated")
 
     def evaluate_surface_brightness(self, x, y, amps=0, n_max=0, beta=0, center_x=0, center_y=0):
         """Returns the surface brightness at the given position (x, y)"""
-        x_, y_ = x.flatten(), y.flatten()
-        flux = self._backend.function(x_, y_, amps, n_max, beta, center_x=center_x, center_y=center_y)
-        return flux.reshape(*x.shape)
+        n_max = int(n_max)
+        basis_x, basis_y = self.get_basis(x, y, n_max, beta, center_x, center_y)
+        indices_x, indices_y = self.basis_indices(n_max)
+        amps_matrix = np.zeros((n_max + 1, n_max + 1))
+        amps_matrix[indices_x, indices_y] = amps
+        flux = np.sum(basis_x * amps_matrix.dot(basis_y), axis=0)
+        return np.nan_to_num(flux).reshape(*np.shape(x))
+
+    def basis_matrix(self, x, y, n_max=0, beta=0, center_x=0, center_y=0):
+        """Returns the matrix of shape (number of points, number of shapelets)
+        of all basis functions evaluated at the (flattened) coordinates,
+        such that the surface brightness is the product of this matrix with the amplitudes"""
+        basis_x, basis_y = self.get_basis(x, y, int(n_max), beta, center_x, center_y)
+        indices_x, indices_y = self.basis_indices(int(n_max))
+        return np.nan_to_num(basis_x[indices_x] * basis_y[indices_y]).T
+
+    def get_basis(self, x, y, n_max, beta, center_x, center_y):
+        """Returns the (cached) 1D basis functions of orders 0 to n_max 
+        evaluated along x and y, as arrays of shape (n_max+1, number of points)"""
+        x_prev, y_prev, settings, basis = self._cache_basis
+        settings_new = (n_max, float(beta), float(center_x), float(center_y))
+        if (settings != settings_new or 
+            not (util.same_array(x, x_prev) and util.same_array(y, y_prev))):
+            basis = (self.hermite_functions((np.ravel(x) - center_x) / beta, n_max),
+                     self.hermite_functions((np.ravel(y) - center_y) / beta, n_max))
+            self._cache_basis = (np.array(x, copy=True), np.array(y, copy=True), settings_new, basis)
+        return basis
+
+    @staticmethod
+    def hermite_functions(u, n_max):
+        """Computes the normalized Hermite functions 
+        phi_n(u) = H_n(u) exp(-u^2/2) / sqrt(2^n n! sqrt(pi)) for n = 0, ..., n_max,
+        using their recurrence relation (stable for any order)"""
+        phi = np.empty((n_max + 1, np.size(u)))
+        phi[0] = np.pi**(-0.25) * np.exp(- u**2 / 2.)
+        if n_max > 0:
+            phi[1] = np.sqrt(2.) * u * phi[0]
+        for n in range(1, n_max):
+            phi[n+1] = np.sqrt(2. / (n + 1)) * u * phi[n] - np.sqrt(n / (n + 1.)) * phi[n-1]
+        return phi
+
+    @staticmethod
+    def basis_indices(n_max):
+        """Returns the orders (n1, n2) along x and y of the shapelets, in the order of the amplitudes,
+        i.e. (0, 0), (1, 0), (0, 1), (2, 0), (1, 1), (0, 2), etc."""
+        indices_x = np.concatenate([np.arange(n, -1, -1) for n in range(n_max + 1)])
+        indices_y = np.concatenate([np.arange(n + 1) for n in range(n_max + 1)])
+        return indices_x, indices_y
 
 
 class PixelatedRegularGrid(BaseLightProfile):
 
-    """Pixelated profile on a regular grid"""
+    """Pixelated profile on a regular grid.
+
+    The spline coefficients of the interpolator are computed once for a given
+    array of pixel values and re-used as long as the pixel values do not change.
+    Likewise, the conversion of evaluation coordinates to pixel coordinates is
+    re-used when the profile is evaluated repeatedly on the same coordinates.
+    """
 
     _units = 'per_pix'
     _template_class = TemplatePixelatedRegularGrid()
@@ -113,7 +168,16 @@ class PixelatedRegularGrid(BaseLightProfile):
         self._shape = (num_pix_x, num_pix_y)
         self._pix_scl_x = np.abs(self._fov_x[0] - self._fov_x[1]) / self._nx
         self._pix_scl_y = np.abs(self._fov_y[0] - self._fov_y[1]) / self._ny
+        self.set_interpolation_method(interpolation_method)
+        self._cache_coordinates = None
+        self._cache_pixel_coords = (None, None, None)
+
+    def set_interpolation_method(self, interpolation_method):
+        """Sets the interpolation method ('nearest', 'linear', 'cubic', 'quintic', 
+        or the spline order), and discards the cached interpolator"""
+        util.CartesianGridInterpolator.get_order(interpolation_method)  # checks the method
         self._interp_method = interpolation_method
+        self._cache_interpolator = (None, None)
 
     def surface_brightness(self, pixels=None):
         """Returns the surface brightness pixels"""
@@ -122,35 +186,82 @@ class PixelatedRegularGrid(BaseLightProfile):
         return pixels
 
     def evaluate_surface_brightness(self, x, y, pixels=None):
-        coordinates = self.get_coordinates()
-        points = coordinates.pixel_axes
-        interp = util.CartesianGridInterpolator(points, pixels, method=self._interp_method)
-        points_eval = np.array([y.ravel(), x.ravel()]).T
-        pixels_eval = interp(points_eval).reshape(*x.shape)
-        return pixels_eval
+        interp = self.get_interpolator(pixels)
+        x_prev, y_prev, coords = self._cache_pixel_coords
+        # comparing arrays is cheaper than hashing them or converting them again
+        if not (util.same_array(x, x_prev) and util.same_array(y, y_prev)):
+            coords = interp.pixel_coordinates(np.array([y.ravel(), x.ravel()]))
+            self._cache_pixel_coords = (np.array(x, copy=True), np.array(y, copy=True), coords)
+        pixels_eval = interp.evaluate_pixel_coordinates(coords)
+        return pixels_eval.reshape(*x.shape)
+
+    def interpolation_matrix(self, x, y):
+        """Returns the sparse matrix of shape (number of evaluation points, number of pixels)
+        which maps the (flattened) pixel values to the interpolated values at the
+        (flattened) evaluation coordinates. This is only possible with the 'nearest' and 
+        'linear' interpolation methods (see `CartesianGridInterpolator.interpolation_matrix()`).
+        """
+        order = util.CartesianGridInterpolator.get_order(self._interp_method)
+        points = self.get_coordinates().pixel_axes[::-1]
+        interp = util.CartesianGridInterpolator(points, np.zeros(self._shape), method=order)
+        coords = interp.pixel_coordinates(np.array([np.ravel(y), np.ravel(x)]))
+        return interp.interpolation_matrix(coords)
+
+    def get_interpolator(self, pixels):
+        """Returns the (cached) interpolator for given pixel values"""
+        pixels = np.asarray(pixels, dtype=float)
+        pixels_key = fingerprint(pixels)
+        if self._cache_interpolator[0] != pixels_key:
+            # pixel values are ordered as (y, x)
+            points = self.get_coordinates().pixel_axes[::-1]
+            interp = util.CartesianGridInterpolator(points, pixels, method=self._interp_method)
+            self._cache_interpolator = (pixels_key, interp)
+        return self._cache_interpolator[1]
 
     def get_extent(self):
         coordinates = self.get_coordinates()
         return coordinates.plt_extent
 
     def get_coordinates(self):
-        from coolest.api.util import get_coordinates_from_regular_grid
-        return get_coordinates_from_regular_grid(self._fov_x, self._fov_y, self._nx, self._ny)
+        if self._cache_coordinates is None:
+            from coolest.api.util import get_coordinates_from_regular_grid
+            self._cache_coordinates = get_coordinates_from_regular_grid(self._fov_x, self._fov_y, 
+                                                                        self._nx, self._ny)
+        return self._cache_coordinates
 
 
 class IrregularGrid(BaseLightProfile):
 
-    """Pixelated profile on an irregular grid of points {x, y, z}"""
+    """Pixelated profile on an irregular grid of points {x, y, z}.
+
+    The Delaunay triangulation of the grid points is computed once for given
+    (x, y) points. For the 'linear' and 'nearest' interpolation methods, 
+    the interpolation weights are also stored as a sparse matrix for given 
+    evaluation coordinates (e.g., ray-traced coordinates for a fixed mass model),
+    such that the profile is evaluated for new z values with a single sparse matrix product.
+    Results are the same as with scipy.interpolate.griddata().
+    """
 
     _units = 'per_pix'
     _template_class = TemplateIrregularGrid()
+    _supported_methods = ('nearest', 'linear', 'cubic')
 
     def __init__(self, field_of_view_x, field_of_view_y, num_pix,
                  interpolation_method='cubic'):
         self._fov_x = field_of_view_x
         self._fov_y = field_of_view_y
         self._n = num_pix
+        self.set_interpolation_method(interpolation_method)
+        self._cache_triangulation = (None, None)
+
+    def set_interpolation_method(self, interpolation_method):
+        """Sets the interpolation method ('nearest', 'linear' or 'cubic'), 
+        and discards the cached interpolation weights"""
+        if interpolation_method not in self._supported_methods:
+            raise ValueError(f"Interpolation method '{interpolation_method}' is not supported "
+                             f"(supported methods are {self._supported_methods}).")
         self._interp_method = interpolation_method
+        self._cache_weights = (None, None, None, None)
 
     def surface_brightness(self, x=None, y=None, z=None):
         """Returns the surface brightness pixels"""
@@ -159,9 +270,71 @@ class IrregularGrid(BaseLightProfile):
         return x, y, z
 
     def evaluate_surface_brightness(self, x_eval, y_eval, x=None, y=None, z=None):
-        z_eval = interpolate.griddata((x, y), z, (x_eval, y_eval), 
-                                      method=self._interp_method)
-        return z_eval
+        z = np.asarray(z, dtype=float)
+        if self._interp_method == 'cubic':
+            interp = interpolate.CloughTocher2DInterpolator(self.get_triangulation(x, y), z)
+            return interp(x_eval, y_eval)
+        weights = self.interpolation_matrix(x_eval, y_eval, x, y)
+        z_eval = weights.dot(z)
+        if self._interp_method == 'linear':
+            # points outside the convex hull of the grid
+            z_eval[np.diff(weights.indptr) == 0] = np.nan
+        return z_eval.reshape(np.shape(x_eval))
+
+    def get_triangulation(self, x, y):
+        """Returns the (cached) Delaunay triangulation of the grid points"""
+        points = np.array([np.ravel(x), np.ravel(y)], dtype=float).T
+        points_key = fingerprint(points)
+        if self._cache_triangulation[0] != points_key:
+            self._cache_triangulation = (points_key, spatial.Delaunay(points))
+        return self._cache_triangulation[1]
+
+    def interpolation_matrix(self, x_eval, y_eval, x, y):
+        """Returns the (cached) sparse matrix of shape (number of evaluation points, 
+        number of grid points) which maps the z values of the grid to the interpolated values
+        at the (flattened) evaluation coordinates. Rows of points outside of the convex hull
+        of the grid are empty with the 'linear' method.
+
+        Raises
+        ------
+        ValueError
+            If the interpolation method is 'cubic', which is not linear in z.
+        """
+        if self._interp_method not in ('linear', 'nearest'):
+            raise ValueError(f"No interpolation matrix for interpolation method '{self._interp_method}'.")
+        tri = self.get_triangulation(x, y)  # also needed for the nearest neighbors
+        points_key, x_prev, y_prev, weights = self._cache_weights
+        if (points_key != self._cache_triangulation[0] or 
+            not (util.same_array(x_eval, x_prev) and util.same_array(y_eval, y_prev))):
+            points_eval = np.array([np.ravel(x_eval), np.ravel(y_eval)], dtype=float).T
+            if self._interp_method == 'linear':
+                weights = self._barycentric_weights(tri, points_eval)
+            else:
+                weights = self._nearest_weights(tri.points, points_eval)
+            self._cache_weights = (self._cache_triangulation[0], np.array(x_eval, copy=True), 
+                                   np.array(y_eval, copy=True), weights)
+        return weights
+
+    @staticmethod
+    def _barycentric_weights(tri, points_eval):
+        num_eval = points_eval.shape[0]
+        simplices = tri.find_simplex(points_eval)
+        inside = simplices >= 0
+        transform = tri.transform[simplices[inside]]
+        delta = points_eval[inside] - transform[:, 2]
+        bary = np.einsum('nij,nj->ni', transform[:, :2], delta)
+        bary = np.column_stack([bary, 1. - bary.sum(axis=1)])
+        rows = np.repeat(np.where(inside)[0], 3)
+        cols = tri.simplices[simplices[inside]].ravel()
+        return sparse.csr_matrix((bary.ravel(), (rows, cols)), 
+                                 shape=(num_eval, tri.npoints))
+
+    @staticmethod
+    def _nearest_weights(points, points_eval):
+        _, indices = spatial.cKDTree(points).query(points_eval)
+        num_eval = points_eval.shape[0]
+        return sparse.csr_matrix((np.ones(num_eval), (np.arange(num_eval), indices)), 
+                                 shape=(num_eval, points.shape[0]))
 
     def get_extent(self):
         return [
@@ -1,6 +1,7 @@
 __author__ = 'aymgal'
 
 
+import logging
 import numpy as np
 from scipy import special
 
@@ -16,6 +17,10 @@ class BaseMassProfile(object):
     Each specific class must be consistent with the equivalent class from the
     coolest.template submodule.
 
+    All methods support parameter values given as arrays with a leading
+    sample axis, of shape (num_samples, 1, ..., 1), which broadcast against
+    the coordinates (x, y) to evaluate many parameter sets at once.
+
     NOTE: in the future, a new coolest.profiles submodule will merge
     profile definitions that are currently split between coolest.template and coolest.api. 
     """
@@ -38,6 +43,19 @@ class BaseMassProfile(object):
         raise NotImplementedError(f"The method hessian() is not defined "
                                   f"for profile '{self.__class__.__name__}'")
 
+    def lensing_quantities(self, x, y, **params):
+        """Returns the deflection, convergence and shear components 
+        (alpha_x, alpha_y, kappa, gamma_1, gamma_2) at the given position (x, y).
+        Profiles that share intermediate quantities between their deflection 
+        and hessian override this method to compute them once.
+        """
+        alpha_x, alpha_y = self.deflection(x, y, **params)
+        H_xx, H_xy, H_yx, H_yy = self.hessian(x, y, **params)
+        kappa = (H_xx + H_yy) / 2.
+        gamma_1 = (H_xx - H_yy) / 2.
+        gamma_2 = H_xy
+        return alpha_x, alpha_y, kappa, gamma_1, gamma_2
+
     @property
     def template_class(self):
         if self._template_class is None:
@@ -58,10 +76,44 @@ class PEMD(BaseMassProfile):
     """
     Power-law Elliptical Mass Distribution (a.k.a. Elliptical Power-law)
     This follows implementations in lenstronomy (:cite:t:`lenstronomy2018`:, :cite:t:`lenstronomy2021`:) based on the formulae :cite:p:`Tessore2015`:.
+
+    The deflection angle can be computed with two backends:
+
+    - 'hyp2f1': evaluates the Gauss hypergeometric function on complex arguments (scipy.special.hyp2f1);
+    - 'series': sums the recursive series of :cite:t:`Tessore2015` (their Eq. 23), stopping 
+      as soon as an upper bound on the sum of the remaining terms is below the tolerance `series_tol`. 
+      As the first term of the series has a modulus of one, this is the truncation error 
+      relative to that first term (not to the full sum, which can be smaller for large ellipticities).
+      This is typically several times faster, in particular for moderate ellipticities.
+
+    Parameters
+    ----------
+    backend : str, optional
+        Either 'hyp2f1' or 'series', by default 'hyp2f1'
+    series_tol : float, optional
+        Tolerance on the truncation error of the 'series' backend, relative to 
+        the first term of the series (see above), by default 1e-10
+    series_max_terms : int, optional
+        Maximum number of terms summed by the 'series' backend, by default 1000
     """
 
     # TODO: use parameter values (point estimates, prior, etc...) contained in the template?
     _template_class = TemplatePEMD()
+    _supported_backends = ('hyp2f1', 'series')
+
+    def __init__(self, backend='hyp2f1', series_tol=1e-10, series_max_terms=1000):
+        self.set_backend(backend, series_tol=series_tol, series_max_terms=series_max_terms)
+
+    def set_backend(self, backend, series_tol=None, series_max_terms=None):
+        """Selects the backend used to compute the deflection angle (see class docstring)"""
+        if backend not in self._supported_backends:
+            raise ValueError(f"PEMD backend must be one of {self._supported_backends} "
+                             f"(received '{backend}').")
+        self.backend = backend
+        if series_tol is not None:
+            self.series_tol = series_tol
+        if series_max_terms is not None:
+            self.series_max_terms = int(series_max_terms)
 
     def param_conv(self, theta_E, q, gamma):
         theta_E_conv = theta_E / (np.sqrt((1. + q**2) / (2. * q)))
@@ -92,10 +144,16 @@ class PEMD(BaseMassProfile):
         a_x, a_y = util.rotate(a_x_, a_y_, - phi_)
         return a_x, a_y
 
+    def _defl_major_axis(self, x_, y_, b, t, q):
+        if self.backend == 'series':
+            return self._defl_major_axis_series(x_, y_, b, t, q, 
+                                                self.series_tol, self.series_max_terms)
+        return self._defl_major_axis_hyp2f1(x_, y_, b, t, q)
+
     @staticmethod
-    def _defl_major_axis(x_, y_, b, t, q):
+    def _defl_major_axis_hyp2f1(x_, y_, b, t, q):
         # evaluate the profile following to Tessore et al. 2015
-        Z = np.empty(np.shape(x_), dtype=complex)
+        Z = np.empty(np.broadcast_shapes(np.shape(x_), np.shape(y_), np.shape(q)), dtype=complex)
         Z.real = q * x_
         Z.imag = y_
         R = np.abs(Z)
@@ -106,6 +164,38 @@ class PEMD(BaseMassProfile):
         a_y_ = np.nan_to_num(alpha.imag, neginf=-1e10, posinf=1e10)
         return a_x_, a_y_
 
+    @staticmethod
+    def _defl_major_axis_series(x_, y_, b, t, q, tol, max_terms):
+        # evaluate the profile following Eqs. (22) and (23) of Tessore et al. 2015
+        Z = np.empty(np.broadcast_shapes(np.shape(x_), np.shape(y_), np.shape(q)), dtype=complex)
+        Z.real = q * x_
+        Z.imag = y_
+        R = np.abs(Z)
+        R = np.maximum(R, 1e-9)
+        e_iphi = Z / R  # exp(i*phi) with phi the elliptical angle
+        e_2iphi = e_iphi * e_iphi
+        f = (1. - q) / (1. + q)
+        # the modulus of each term of the series does not depend on the position,
+        # so a single check is enough to stop the recursion for all points; the remaining 
+        # terms decrease faster than a geometric series of ratio f, and the first term is e_iphi
+        term = e_iphi
+        omega = e_iphi.copy()
+        term_modulus = np.ones_like(f * t)
+        for n in range(1, max_terms+1):
+            if np.all(term_modulus * f / (1. - f + 1e-15) < tol):
+                break
+            factor = - f * (2.*n - (2.-t)) / (2.*n + (2.-t))
+            term = factor * e_2iphi * term
+            omega += term
+            term_modulus = term_modulus * np.abs(factor)
+        else:
+            logging.warning(f"PEMD deflection series did not converge within {max_terms} terms "
+                            f"(tolerance {tol}).")
+        alpha = 2. * b / (1+q) * (b/R)**(t-1.) * omega
+        a_x_ = np.nan_to_num(alpha.real, neginf=-1e10, posinf=1e10)
+        a_y_ = np.nan_to_num(alpha.imag, neginf=-1e10, posinf=1e10)
+        return a_x_, a_y_
+
     def convergence(self, x, y, theta_E=1., gamma=2., phi=0., q=1., center_x=0., center_y=0.):
         """Returns the convergence (kappa) at the given position (x, y)"""
         phi_ = util.eastofnorth2normalradians(phi)
@@ -124,12 +214,39 @@ class PEMD(BaseMassProfile):
         x_, y_ = util.shift(x, y, center_x, center_y)
         x_, y_ = util.rotate(x_, y_, phi_)
 
-        # convergence
-        kappa_ = self._conv_major_axis(x_, y_, b, t, q)
-        kappa_ = np.nan_to_num(kappa_, neginf=-1e10, posinf=1e10)
+        # deflection
+        alpha_x_, alpha_y_ = self._defl_major_axis(x_, y_, b, t, q)
+
+        # convergence and shear
+        kappa, gamma_1, gamma_2 = self._conv_shear(x_, y_, alpha_x_, alpha_y_, b, t, q, phi_)
+
+        H_xx = kappa + gamma_1
+        H_yy = kappa - gamma_1
+        H_xy = gamma_2
+        H_yx = H_xy
+
+        return H_xx, H_xy, H_yx, H_yy
+
+    def lensing_quantities(self, x, y, theta_E=1., gamma=2., phi=0., q=1., center_x=0., center_y=0.):
+        """Returns (alpha_x, alpha_y, kappa, gamma_1, gamma_2) at the given position (x, y),
+        computing the deflection (hence the hypergeometric function) only once"""
+        b, t = self.param_conv(theta_E, q, gamma)
+        phi_ = util.eastofnorth2normalradians(phi)
+        x_, y_ = util.shift(x, y, center_x, center_y)
+        x_, y_ = util.rotate(x_, y_, phi_)
 
         # deflection
         alpha_x_, alpha_y_ = self._defl_major_axis(x_, y_, b, t, q)
+        alpha_x, alpha_y = util.rotate(alpha_x_, alpha_y_, - phi_)
+
+        # convergence and shear
+        kappa, gamma_1, gamma_2 = self._conv_shear(x_, y_, alpha_x_, alpha_y_, b, t, q, phi_)
+        return alpha_x, alpha_y, kappa, gamma_1, gamma_2
+
+    def _conv_shear(self, x_, y_, alpha_x_, alpha_y_, b, t, q, phi_):
+        # convergence
+        kappa_ = self._conv_major_axis(x_, y_, b, t, q)
+        kappa_ = np.nan_to_num(kappa_, neginf=-1e10, posinf=1e10)
 
         #R = np.hypot(q*x, y)
         #R = np.maximum(R, 1e-9)
@@ -151,13 +268,7 @@ class PEMD(BaseMassProfile):
         kappa = kappa_
         gamma_1 = np.cos(2 * phi_) * gamma_1_ - np.sin(2 * phi_) * gamma_2_
         gamma_2 = np.sin(2 * phi_) * gamma_1_ + np.cos(2 * phi_) * gamma_2_
-
-        H_xx = kappa + gamma_1
-        H_yy = kappa - gamma_1
-        H_xy = gamma_2
-        H_yx = H_xy
-
-        return H_xx, H_xy, H_yx, H_yy
+        return kappa, gamma_1, gamma_2
 
 
 class ExternalShear(BaseMassProfile):
@@ -195,6 +306,14 @@ class ExternalShear(BaseMassProfile):
         H_xy = gamma2
         H_yx = H_xy
         return H_xx, H_xy, H_yx, H_yy
+
+    def lensing_quantities(self, x, y, gamma_ext=0., phi_ext=0.):
+        a_x, a_y = self.deflection(x, y, gamma_ext=gamma_ext, phi_ext=phi_ext)
+        phi_ext_ = util.eastofnorth2normalradians(phi_ext)
+        kappa = np.zeros_like(x)
+        gamma1 = gamma_ext * np.cos(2.*phi_ext_)
+        gamma2 = gamma_ext * np.sin(2.*phi_ext_)
+        return a_x, a_y, kappa, gamma1, gamma2
     
 
 class ConvergenceSheet(BaseMassProfile):
@@ -216,10 +335,10 @@ class ConvergenceSheet(BaseMassProfile):
         return x_ * kappa_s, y_ * kappa_s
 
     def convergence(self, x, y, kappa_s=0.):
-        return np.full_like(x, kappa_s)
+        return kappa_s * np.ones_like(x)
 
     def hessian(self, x, y, kappa_s=0.):
-        kappa = np.full_like(x, kappa_s)
+        kappa = kappa_s * np.ones_like(x)
         gamma1 = 0.
         gamma2 = 0.
         H_xx = kappa + gamma1
@@ -227,3 +346,8 @@ class ConvergenceSheet(BaseMassProfile):
         H_xy = gamma2
         H_yx = H_xy
         return H_xx, H_xy, H_yx, H_yy
+
+    def lensing_quantities(self, x, y, kappa_s=0.):
+        a_x, a_y = self.deflection(x, y, kappa_s=kappa_s)
+        kappa = kappa_s * np.ones_like(x)
+        return a_x, a_y, kappa, 0., 0.
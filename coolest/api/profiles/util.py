@@ -1,6 +1,7 @@
 __author__ = 'aymgal'
 
 
+import itertools
 import numpy as np
 from scipy import ndimage
 
@@ -35,18 +36,61 @@ def cartesian2polar(x, y):
     phi = np.arctan2(y, x)
     return r, phi
 
+def same_array(a, b):
+    """Checks if `b` is an array with the same shape and values as `a` (`b` can be None)"""
+    return b is not None and np.shape(a) == b.shape and np.array_equal(a, b)
+
 
 class CartesianGridInterpolator(object):
     """
     Regular grid spline interpolator
     https://docs.scipy.org/doc/scipy/tutorial/interpolate/ND_regular_grid.html#uniformly-spaced-data
+
+    For spline orders larger than 1, the spline coefficients are computed once 
+    at initialization (prefiltering), such that the interpolant passes through
+    the values at the grid points, and re-used for all subsequent evaluations.
+
+    Parameters
+    ----------
+    points : tuple of ndarray
+        1D coordinates axes of the grid, in the same order as the axes of `values`
+    values : ndarray
+        Values at the grid points
+    method : str or int, optional
+        Interpolation method, either 'nearest', 'linear', 'cubic', 'quintic', 
+        or the spline order as an integer between 0 and 5, by default 'linear'
+    fill_value : float, optional
+        Value returned outside of the grid, by default 0.
+    prefilter : bool, optional
+        If False, the values are used directly as spline coefficients 
+        (i.e. the interpolant is smoothed for spline orders larger than 1), by default True
     """
+
+    _orders = {'nearest': 0, 'linear': 1, 'cubic': 3, 'quintic': 5}
     
-    def __init__(self, points, values, method='linear', fill_value=0.):
+    def __init__(self, points, values, method='linear', fill_value=0., prefilter=True):
         self.limits = np.array([[min(x), max(x)] for x in points])
         self.values = np.asarray(values, dtype=float)
-        self.order = {'linear': 1, 'cubic': 3, 'quintic': 5}[method]
+        self.order = self.get_order(method)
         self.fill_value = fill_value
+        if prefilter and self.order > 1:
+            # same coefficients as computed internally by map_coordinates(..., prefilter=True)
+            self.coefficients = ndimage.spline_filter(self.values, order=self.order, 
+                                                      output=np.float64, mode='constant')
+        else:
+            self.coefficients = self.values
+
+    @classmethod
+    def get_order(cls, method):
+        """Returns the spline order corresponding to an interpolation method"""
+        if isinstance(method, (int, np.integer)) and not isinstance(method, bool):
+            if not 0 <= method <= 5:
+                raise ValueError(f"Spline order must be between 0 and 5 (received {method}).")
+            return int(method)
+        if method not in cls._orders:
+            raise ValueError(f"Interpolation method '{method}' is not supported "
+                             f"(supported methods are {list(cls._orders.keys())}).")
+        return cls._orders[method]
 
     def __call__(self, xi):
         """
@@ -58,15 +102,57 @@ class CartesianGridInterpolator(object):
         # transpose the xi array into the ``map_coordinates`` convention
         # which takes coordinates of a point along columns of a 2D array.
         xi = np.asarray(xi).T
+        return self.evaluate_pixel_coordinates(self.pixel_coordinates(xi))
 
-        # convert from data coordinates to pixel coordinates
+    def pixel_coordinates(self, xi):
+        """Converts coordinates given along the first axis of `xi` (one row per grid axis)
+        to (fractional) pixel coordinates, which can be re-used for several evaluations"""
         ns = self.values.shape
-        coords = [(n-1)*(val - lo) / (hi - lo) 
-                  for val, n, (lo, hi) in zip(xi, ns, self.limits)]
+        return np.array([(n-1)*(val - lo) / (hi - lo) 
+                         for val, n, (lo, hi) in zip(xi, ns, self.limits)])
 
-        # interpolate
-        return ndimage.map_coordinates(self.values, coords,
+    def evaluate_pixel_coordinates(self, coords):
+        """Interpolates the values at given pixel coordinates (see `pixel_coordinates()`)"""
+        return ndimage.map_coordinates(self.coefficients, coords,
                                        order=self.order,
                                        mode='constant',
                                        cval=self.fill_value,
                                        prefilter=False)
+
+    def interpolation_matrix(self, coords):
+        """Returns the sparse matrix of shape (number of points, number of grid points)
+        which maps the (flattened) values of the grid to the interpolated values at given
+        pixel coordinates (see `pixel_coordinates()`), for spline orders 0 and 1.
+        Rows of points outside of the grid are empty (i.e. the fill value is zero).
+
+        Raises
+        ------
+        ValueError
+            If the spline order is larger than 1, as prefiltered splines depend on all values.
+        """
+        from scipy import sparse  # imported at first use, as scipy.sparse is slow to import
+        if self.order > 1:
+            raise ValueError(f"No sparse interpolation matrix for spline order {self.order}.")
+        coords = np.asarray(coords, dtype=float)
+        ns = np.array(self.values.shape)[:, None]
+        num_points = coords.shape[1]
+        # same convention as map_coordinates(..., mode='constant')
+        inside = np.all((coords >= 0) & (coords <= ns - 1), axis=0)
+        rows = np.where(inside)[0]
+        coords = coords[:, inside]
+        if self.order == 0:
+            indices = np.floor(coords + 0.5).astype(int)
+            cols = np.ravel_multi_index(indices, self.values.shape)
+            weights = np.ones(rows.size)
+        else:
+            base = np.clip(np.floor(coords).astype(int), 0, np.maximum(ns - 2, 0))
+            frac = coords - base
+            cols, weights = [], []
+            for corner in itertools.product((0, 1), repeat=len(self.values.shape)):
+                corner = np.array(corner)[:, None]
+                indices = np.minimum(base + corner, ns - 1)
+                cols.append(np.ravel_multi_index(indices, self.values.shape))
+                weights.append(np.prod(np.where(corner == 1, frac, 1. - frac), axis=0))
+            rows = np.tile(rows, len(cols))
+            cols, weights = np.concatenate(cols), np.concatenate(weights)
+        return sparse.csr_matrix((weights, (rows, cols)), shape=(num_points, self.values.size))
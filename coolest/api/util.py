@@ -3,11 +3,14 @@ __author__ = 'aymgal'
 
 import os
 import math
+import functools
+import logging
 import numpy as np
 # from astropy.coordinates import SkyCoord
-from skimage import measure
 
 from coolest.template.json import JSONSerializer
+from coolest.template.classes.probabilities import PosteriorStatistics
+from coolest.api.profiles import util as profile_util
 
 
 def convert_image_to_data_units(image, mag_tot, mag_zero_point=None, coolest_object=None):
@@ -128,18 +131,20 @@ def downsampling(image, factor=1):
     if factor == 1:
         return image
     f = int(factor)
-    nx, ny = np.shape(image)
+    *batch_shape, nx, ny = np.shape(image)  # leading axes (e.g. a stack of images) are kept
     if int(nx/f) == nx/f and int(ny/f) == ny/f:
-        down = image.reshape([int(nx/f), f, int(ny/f), f]).mean(3).mean(1)
+        down = image.reshape([*batch_shape, int(nx/f), f, int(ny/f), f]).mean(-1).mean(-2)
         return down
     else:
         raise ValueError(f"Downscaling factor {factor} is not possible with shape ({nx}, {ny})")
 
 
-def effective_radius(light_map, x, y, outer_radius=10, initial_guess=1, initial_delta_pix=10, n_iter=10):
+def effective_radius(light_map, x, y, outer_radius=10, initial_guess=1, initial_delta_pix=10, n_iter=10,
+                     fraction=0.5, center_x=0., center_y=0., q=1., phi=0.):
     """Computes the effective radius of the 2D surface brightness profile, 
     based on a definition similar to the half-light radius.
-    NOTE: This functions assumes that the profile is centered on the grid.
+    The radius is obtained from the growth curve of the image (see `GrowthCurve`),
+    which is computed once.
 
     Parameters
     ----------
@@ -151,53 +156,344 @@ def effective_radius(light_map, x, y, outer_radius=10, initial_guess=1, initial_
         y-coordinates associated to the light model
     outer_radius : int, optional
         outer limit of integration within which half the light is calculated to estimate the effective radius, by default 10
-    initial_guess : int, optional
-        Initial guess for effective radius in arcsecond, by default 1
-    initial_delta_pix : int, optional
-        Initial step size in pixels before shrinking in future iterations, by default 10
-    n_iter : int, optional
-        Number of iterations, by default 5
+    initial_guess, initial_delta_pix, n_iter : optional
+        Not used anymore, kept for backward compatibility
+    fraction : float or array_like, optional
+        Fraction(s) of the total flux enclosed by the radius, by default 0.5
+    center_x, center_y : float, optional
+        Center of the apertures, by default 0
+    q : float, optional
+        Axis ratio of the (elliptical) apertures, by default 1 (circular)
+    phi : float, optional
+        Position angle of the apertures, in degrees east of north, by default 0
 
     Returns
     -------
     (float, float)
-        Effective radius and spacing of the coordinates grid (approximate accuracy)
+        Effective radius (or array of radii for an array of fractions) 
+        and spacing of the coordinates grid (approximate accuracy)
+    """
+    grid_res = np.abs(x[0, 0] - x[0, 1])
+    growth = GrowthCurve(light_map, x, y, center_x=center_x, center_y=center_y,
+                         q=q, phi=phi, outer_radius=outer_radius)
+    return growth.radius(fraction), grid_res
 
-    Raises
-    ------
-    RuntimeError
-        If integration loop exceeds outer bound before convergence.
+
+class GrowthCurve(object):
+    """Cumulative flux of an image within concentric (circular or elliptical) apertures,
+    as a function of the aperture radius. Pixels are sorted once by radius, such that 
+    the flux enclosed within any radius, and the radius enclosing any fraction
+    of the total flux, are then obtained by a binary search.
+
+    For elliptical apertures, the radius is the circularized radius sqrt(q x'^2 + y'^2 / q),
+    with the same convention as for the elliptical light and mass profiles.
+
+    Parameters
+    ----------
+    light_map : ndarray
+        Surface brightness (or flux) values
+    x, y : ndarray
+        Coordinates of the pixels
+    center_x, center_y : float, optional
+        Center of the apertures, by default 0
+    q : float, optional
+        Axis ratio of the apertures, by default 1 (circular)
+    phi : float, optional
+        Position angle of the apertures, in degrees east of north, by default 0
+    outer_radius : float, optional
+        If not None, pixels outside this radius are ignored, by default None
     """
-    #initialize
-    grid_res=np.abs(x[0,0]-x[0,1])
-    initial_delta=grid_res*initial_delta_pix #default inital step size is 10 pixels
-    r_grid=np.hypot(x, y)
-    total_light=np.sum(light_map[r_grid<outer_radius])
-    cumulative_light=np.sum(light_map[r_grid<initial_guess])
-    if cumulative_light < total_light/2: #move outward
-        direction=1
-    elif cumulative_light > total_light/2: #move inward
-        direction=-1
-    else:
-        return initial_guess
-    r_eff=initial_guess
-    delta=initial_delta
-    loopcount=0
-
-    for n in range(n_iter): #overshoots, turn around and backtrack at higher precision
-        while (total_light/2.-cumulative_light)*direction>0: 
-            if loopcount > 100:
-                raise RuntimeError('Stuck in very long (possibly infinite) loop')
-            r_eff=r_eff+delta*direction
-            cumulative_light=np.sum(light_map[r_grid<r_eff])
-            loopcount+=1
-        direction=direction*-1
-        delta=delta/2.
-
-    return r_eff, grid_res
-            
+
+    def __init__(self, light_map, x, y, center_x=0., center_y=0., q=1., phi=0., outer_radius=None):
+        x, y, flux = np.ravel(x), np.ravel(y), np.ravel(light_map)
+        if q == 1.:
+            x_t, y_t = x - center_x, y - center_y
+        else:
+            phi_ = profile_util.eastofnorth2normalradians(phi)
+            x_t, y_t = profile_util.shift_rotate_elliptical(x, y, phi_, q, center_x, center_y)
+        # pixels sorted by squared radius (cheaper than the radius)
+        radius2 = x_t**2 + y_t**2
+        if outer_radius is not None:
+            inside = radius2 < outer_radius**2
+            radius2, flux = radius2[inside], flux[inside]
+        order = np.argsort(radius2)
+        self.radii = np.sqrt(radius2[order])
+        self.cumulative_flux = np.cumsum(np.where(np.isnan(flux[order]), 0., flux[order]))
+
+    @property
+    def total_flux(self):
+        """Flux within the outermost aperture"""
+        if self.cumulative_flux.size == 0:
+            return 0.
+        return self.cumulative_flux[-1]
+
+    def enclosed_flux(self, radius):
+        """Flux within (strictly) the aperture(s) of given radius"""
+        num_pix = np.searchsorted(self.radii, radius, side='left')
+        cumulative_flux = np.concatenate([[0.], self.cumulative_flux])
+        return cumulative_flux[num_pix]
+
+    def radius(self, fraction=0.5):
+        """Radius of the aperture(s) enclosing a given fraction(s) of the total flux,
+        linearly interpolated between consecutive pixels. If the growth curve 
+        is not monotonic (e.g. negative pixels), the first crossing is used.
+        Returns NaN if the total flux is not positive.
+        """
+        fraction = np.asarray(fraction, dtype=float)
+        total_flux = self.total_flux
+        if total_flux <= 0:
+            logging.warning("Total flux is not positive, radius undefined.")
+            return np.full(fraction.shape, np.nan)[()]
+        target = fraction * total_flux
+        running_max = np.maximum.accumulate(self.cumulative_flux)
+        i = np.clip(np.searchsorted(running_max, target, side='left'), 1, self.radii.size - 1)
+        flux_lo, flux_hi = running_max[i-1], running_max[i]
+        t = np.clip((target - flux_lo) / np.maximum(flux_hi - flux_lo, np.finfo(float).tiny), 0., 1.)
+        return (self.radii[i-1] + t * (self.radii[i] - self.radii[i-1]))[()]
+
+
+class RadialProfile(object):
+    """Averages images (e.g. convergence or surface brightness maps) within concentric
+    (circular or elliptical) annuli. Pixels are assigned to the radial bins once, 
+    such that the mean, scatter and number of pixels in each bin are then obtained 
+    with `np.bincount` for any image, or stack of images, on the same coordinates.
+
+    The bins are the intervals (edges[i], edges[i+1]], and pixels outside of all bins
+    (or excluded by the mask) are ignored. For elliptical annuli, the radius is 
+    the circularized radius, as in `GrowthCurve`.
+
+    Parameters
+    ----------
+    x, y : ndarray
+        Coordinates of the pixels
+    bin_edges : array_like
+        Increasing radii of the edges of the bins
+    center_x, center_y : float, optional
+        Center of the annuli, by default 0
+    q : float, optional
+        Axis ratio of the annuli, by default 1 (circular)
+    phi : float, optional
+        Position angle of the annuli, in degrees east of north, by default 0
+    mask : ndarray, optional
+        Binary mask (1 for pixels included), by default None
+    """
+
+    def __init__(self, x, y, bin_edges, center_x=0., center_y=0., q=1., phi=0., mask=None):
+        self.bin_edges = np.asarray(bin_edges, dtype=float)
+        self.num_bins = self.bin_edges.size - 1
+        self.image_shape = np.shape(x)
+        x, y = np.ravel(x), np.ravel(y)
+        if q == 1.:
+            x_t, y_t = x - center_x, y - center_y
+        else:
+            phi_ = profile_util.eastofnorth2normalradians(phi)
+            x_t, y_t = profile_util.shift_rotate_elliptical(x, y, phi_, q, center_x, center_y)
+        bin_indices = np.digitize(np.hypot(x_t, y_t), self.bin_edges, right=True) - 1
+        selected = (bin_indices >= 0) & (bin_indices < self.num_bins)
+        if mask is not None:
+            selected &= np.ravel(mask).astype(bool)
+        self._pixels = np.flatnonzero(selected)
+        self._bin_indices = bin_indices[selected]
+        self.counts = np.bincount(self._bin_indices, minlength=self.num_bins)
+
+    @property
+    def bin_centers(self):
+        return 0.5 * (self.bin_edges[:-1] + self.bin_edges[1:])
+
+    def mean(self, image):
+        """Mean of an image, or of a stack of images (along the leading axes), 
+        in each bin (NaN for empty bins)"""
+        return self.profile(image)[0]
+
+    def profile(self, image):
+        """Computes the mean and the standard deviation of an image, 
+        or of a stack of images (along the leading axes), in each bin
+
+        Parameters
+        ----------
+        image : ndarray
+            Image of shape `image_shape`, or stack of images of shape (..., *image_shape)
+
+        Returns
+        -------
+        (ndarray, ndarray, ndarray)
+            Mean and standard deviation of the pixel values in each bin (NaN for empty bins),
+            of shape (..., num_bins), and number of pixels in each bin
+        """
+        mean, std = _binned_mean_std(image, self.image_shape, self._pixels, 
+                                     self._bin_indices, self.counts)
+        return mean, std, self.counts.copy()
+
+
+def _binned_mean_std(image, image_shape, pixels, bin_indices, counts):
+    # mean and standard deviation of the selected pixels of an image, or of a stack 
+    # of images (along the leading axes), in each bin (NaN for empty bins)
+    image = np.asarray(image, dtype=float)
+    num_bins = counts.size
+    batch_shape = image.shape[:image.ndim-len(image_shape)]
+    values = image.reshape(-1, int(np.prod(image_shape)))[:, pixels]
+    # one set of bins for each image of the stack
+    offsets = num_bins * np.arange(values.shape[0])[:, None]
+    indices = (bin_indices + offsets).ravel()
+    minlength = values.shape[0] * num_bins
+    counts = np.tile(counts, values.shape[0]).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(indices, weights=values.ravel(), minlength=minlength) / counts
+        deviations = values - mean.reshape(-1, num_bins)[:, bin_indices]
+        variance = np.bincount(indices, weights=deviations.ravel()**2, minlength=minlength) / counts
+    mean = mean.reshape(*batch_shape, num_bins)
+    std = np.sqrt(variance).reshape(*batch_shape, num_bins)
+    return mean, std
+
+
+def mean_convergence_radius(kappa_image, x, y, center_x, center_y, mean_value=1.):
+    """Computes the radius of the circle within which the mean convergence
+    is equal to `mean_value`, assuming that it decreases with the radius.
+
+    Parameters
+    ----------
+    kappa_image : ndarray
+        Convergence values
+    x, y : ndarray
+        Coordinates of the pixels
+    center_x, center_y : float
+        Center of the circles
+    mean_value : float, optional
+        Target mean convergence, by default 1 (i.e. for the Einstein radius)
+
+    Returns
+    -------
+    float
+        Radius (NaN if the mean convergence is smaller than `mean_value` 
+        at the center, or larger at the edge of the grid)
+    """
+    # pixels sorted by squared radius (cheaper than the radius)
+    radius2 = (np.ravel(x) - center_x)**2 + (np.ravel(y) - center_y)**2
+    order = np.argsort(radius2)
+    radius = np.sqrt(radius2[order])
+    # cumulative excess of convergence with respect to the target mean,
+    # which is positive as long as the mean within the radius is larger than the target
+    excess = np.cumsum(np.ravel(kappa_image)[order] - mean_value)
+    num_pix = np.arange(1, radius.size + 1)
+    mean_excess = excess / num_pix  # decreasing
+    if mean_excess[0] < 0:
+        logging.warning('kappa is sub-critical, Einstein radius undefined.')
+        return np.nan
+    # last pixel with a mean convergence larger than or equal to the target
+    i = np.searchsorted(-mean_excess, 0., side='right') - 1
+    if i == radius.size - 1:
+        logging.warning(f'Mean convergence is larger than {mean_value} up to the edge of the grid, '
+                        'radius undefined.')
+        return np.nan
+    t = excess[i] / (excess[i] - excess[i+1])
+    return radius[i] + t * (radius[i+1] - radius[i])
+
+
+def power_law_angular_average(q, gamma, tol=1e-10):
+    """Computes the average over the polar angle of the convergence of an elliptical 
+    power-law profile (PEMD) with unit Einstein radius, relative to its value along 
+    the intermediate axis, i.e. the integral of (q cos^2(t) + sin^2(t) / q)^(-(gamma-1)/2)
+    over [0, 2pi] divided by 2pi, computed by 1D quadrature.
+
+    The azimuthally averaged convergence of a PEMD is then 
+    (3-gamma)/2 * A * (theta_E / r)^(gamma-1), and the mean convergence within 
+    a circle of radius r is A * (theta_E / r)^(gamma-1), where A is the returned value.
+
+    Parameters
+    ----------
+    q : float
+        Axis ratio
+    gamma : float
+        Logarithmic slope of the mass density
+    tol : float, optional
+        Relative tolerance of the quadrature, by default 1e-10
+
+    Returns
+    -------
+    float
+        Angular average
+    """
+    from scipy import integrate  # imported at first use, only needed for analytic profiles
+    if q == 1. or gamma == 1.:
+        return 1.
+    def integrand(t):
+        return (q * np.cos(t)**2 + np.sin(t)**2 / q)**(-(gamma - 1.) / 2.)
+    # by symmetry, the average over a quarter of the circle is sufficient
+    integral, _ = integrate.quad(integrand, 0., np.pi / 2., epsabs=0., epsrel=tol)
+    return integral * 2. / np.pi
+
+
+class PowerLawRadialProfile(object):
+    """Circularly averaged convergence of a sum of concentric elliptical power-law profiles
+    and of a uniform convergence sheet, which is a sum of power-laws of the radius
+
+        kappa(r) = kappa_sheet + sum_i amplitudes_i * r^(-exponents_i)
+
+    such that the mean convergence within any radius, the radius of given mean convergence
+    (e.g. the effective Einstein radius) and the logarithmic slope are analytic, 
+    or found by 1D root-finding for several power-laws.
+
+    Parameters
+    ----------
+    theta_E_list, gamma_list, q_list : list
+        Einstein radius, logarithmic slope and axis ratio of each PEMD profile
+    kappa_sheet : float, optional
+        Uniform convergence, by default 0
+    tol : float, optional
+        Relative tolerance of the angular averages and radii, by default 1e-10
+    """
+
+    def __init__(self, theta_E_list, gamma_list, q_list, kappa_sheet=0., tol=1e-10):
+        self.tol = tol
+        self.kappa_sheet = float(kappa_sheet)
+        self.exponents = np.array(gamma_list, dtype=float) - 1.
+        self._mean_amplitudes = np.array([
+            power_law_angular_average(q, gamma, tol=tol) * theta_E**(gamma - 1.)
+            for theta_E, gamma, q in zip(theta_E_list, gamma_list, q_list)
+        ])
+        self.amplitudes = (2. - self.exponents) / 2. * self._mean_amplitudes
+
+    def convergence(self, r):
+        """Circularly averaged convergence at radius r"""
+        r = np.asarray(r, dtype=float)[..., None]
+        return self.kappa_sheet + np.sum(self.amplitudes * r**(-self.exponents), axis=-1)
+
+    def mean_convergence(self, r):
+        """Mean convergence within the circle of radius r"""
+        r = np.asarray(r, dtype=float)[..., None]
+        return self.kappa_sheet + np.sum(self._mean_amplitudes * r**(-self.exponents), axis=-1)
+
+    def logarithmic_slope(self, r):
+        """Logarithmic slope d log(kappa) / d log(r) of the circularly averaged convergence at radius r
+        (its limit is used at r = 0)"""
+        r = np.asarray(r, dtype=float)
+        r_ = np.where(r > 0, r, 1.)[..., None]
+        terms = self.amplitudes * r_**(-self.exponents)
+        slope = - np.sum(self.exponents * terms, axis=-1) / (self.kappa_sheet + np.sum(terms, axis=-1))
+        return np.where(r > 0, slope, - np.max(self.exponents))
+
+    def mean_convergence_radius(self, mean_value=1.):
+        """Radius of the circle within which the mean convergence is equal to `mean_value`
+        (NaN if it does not exist)"""
+        excess = mean_value - self.kappa_sheet
+        if excess <= 0 or np.any(self.exponents <= 0):
+            logging.warning(f'Mean convergence never decreases to {mean_value}, radius undefined.')
+            return np.nan
+        if self.exponents.size == 1:
+            return (self._mean_amplitudes[0] / excess)**(1. / self.exponents[0])
+        from scipy import optimize  # imported at first use, only needed for analytic profiles
+        # each term alone gives a lower bound, and the number of terms times each term an upper bound
+        radii = (self._mean_amplitudes / excess)**(1. / self.exponents)
+        radii_max = (self.exponents.size * self._mean_amplitudes / excess)**(1. / self.exponents)
+        def log_mean_excess(log_r):
+            return np.log(self.mean_convergence(np.exp(log_r)) - self.kappa_sheet) - np.log(excess)
+        log_r = optimize.brentq(log_mean_excess, np.log(radii.max()), np.log(radii_max.max()), 
+                                xtol=self.tol, rtol=self.tol)
+        return np.exp(log_r)
+
 
 def ellipticity_from_moments(light_map, pixel_size):
+    from skimage import measure  # imported at first use, as scikit-image is slow to import
     # compute central momoments
     try:
         # scikit-image version 0.19.3 and older
@@ -228,10 +524,14 @@ def azim_averaged_two_point_correlation(light_image, dpix, rmax, Nbins):
     2) by calculating explicitly the covariance between any two pixels
     Here we use the first way.
 
+    The assignment of the covariance entries to the radial bins only depends on the 
+    image shape and the binning settings, hence it is computed once for these settings
+    (see `two_point_correlation_bins()`).
+
     Parameters
     ----------
-    light_image : 2D ndarray
-        Pixels of the image to analyse.
+    light_image : ndarray
+        Pixels of the image to analyse, or stack of images along leading axes.
     dpix : float
         Pixel size
     Nbins : int, optional
@@ -244,39 +544,53 @@ def azim_averaged_two_point_correlation(light_image, dpix, rmax, Nbins):
     (array, array, array, array)
         The location, value, uncertainty and covariance matrix 
         The covariance matrix here is the inverse of fourier transform of power spectrum)
+        For a stack of images, the last three have the same leading axes as the stack.
     """
+    light_image = np.asarray(light_image)
     # Fourier transform image
     fouriertf = np.fft.fft2(light_image, norm='ortho')
     # Power spectrum (the square of the signal)
     absval2 = fouriertf.real**2 + fouriertf.imag**2
     # Covariance matrix (the inverse fourier transform of the power spectrum)
-    complex_cov = np.fft.fftshift(np.fft.ifft2(absval2, norm='ortho'))
+    complex_cov = np.fft.fftshift(np.fft.ifft2(absval2, norm='ortho'), axes=(-2, -1))
     cov = complex_cov.real
-    
+
     # Bin the 2D covariance matrix into radial bins
+    bins, pixels, bin_indices, counts = two_point_correlation_bins(cov.shape[-2:], dpix, rmax, Nbins)
+    means, sdevs = _binned_mean_std(cov, cov.shape[-2:], pixels, bin_indices, counts)
+    # empty bins are set to zero
+    means[..., counts == 0] = 0.
+    sdevs[..., counts == 0] = 0.
+    return bins, means, sdevs, cov
+
+
+@functools.lru_cache(maxsize=32)
+def two_point_correlation_bins(shape, dpix, rmax, Nbins):
+    """Assigns the entries of the (shifted) covariance map of an image of a given shape to 
+    the radial bins used by `azim_averaged_two_point_correlation()`, i.e. bins of 
+    width rmax / Nbins starting at zero. Entries with rows equal to columns are ignored.
+    The output is cached for each set of arguments, and its arrays are read-only.
+
+    Returns
+    -------
+    (array, array, array, array)
+        Lower edges of the bins, flat indices of the binned entries, 
+        bin index of each binned entry, and number of entries in each bin
+    """
     rmin = 0.0
     dr = (rmax-rmin)/Nbins
     bins = np.arange(rmin,rmax,dr)
-    vals = [[] for _ in range(len(bins))]
-    # Ni = Nj = the total number of pixels in the image
-    Ni = cov.shape[1]
-    Nj = cov.shape[0]
-    for i in range(0,Ni):
-        for j in range(0,Nj):
-            r = np.hypot((j-Nj/2.0)*dpix,(i-Ni/2.0)*dpix)
-            if r < rmax and i != j:
-                index = int(np.floor(r/dr))
-                vals[index].append(cov[i][j])
-                
-    means = np.zeros(len(bins))                    
-    sdevs = np.zeros(len(bins))
-    for i in range(0,len(bins)):
-        if len(vals[i]) > 0:
-            means[i] = np.mean(vals[i])
-            sdevs[i] = np.std(vals[i])
+    num_rows, num_cols = shape
+    rows, cols = np.indices(shape)
+    r = np.hypot((cols - num_cols/2.0)*dpix, (rows - num_rows/2.0)*dpix)
+    selected = ((r < rmax) & (rows != cols)).ravel()
+    pixels = np.flatnonzero(selected)
+    bin_indices = np.minimum(np.floor(r.ravel()[selected]/dr).astype(int), len(bins) - 1)
+    counts = np.bincount(bin_indices, minlength=len(bins))
+    for array in (bins, pixels, bin_indices, counts):
+        array.flags.writeable = False
+    return bins, pixels, bin_indices, counts
 
-    return bins, means, sdevs, cov
-    
 
 def lensing_information(data_lens_sub, x, y, theta_E, noise_map, center_x_lens=0, center_y_lens=0,
                         a=16, b=0, arc_mask=None):
@@ -623,6 +937,7 @@ def read_sersic(light, param={}, prefix='Sersic_0_'):
 
 def find_critical_lines(coordinates, mag_map):
     # invert and find contours corresponding to infinite magnification (i.e., changing sign)
+    from skimage import measure  # imported at first use, as scikit-image is slow to import
     inv_mag = 1. / np.array(mag_map)
     contours = measure.find_contours(inv_mag, 0.)
     # convert to model coordinates
@@ -642,18 +957,255 @@ def find_caustics(crit_lines, composable_lens):
     return lines
 
 
-def find_all_lens_lines(coordinates, composable_lens):
-    """`composable_lens` can be an instance of `ComposableLens` or `ComposableMass`"""
+def find_critical_lines_adaptive(coordinates, composable_mass, point_spacing=None, 
+                                 tol=1e-10, max_iter=100, return_deflection=False):
+    """Finds the critical lines, where the determinant of the lensing Jacobian 
+    det(A) = (1 - H_xx) (1 - H_yy) - H_xy H_yx vanishes, with a precision that 
+    does not depend on the resolution of the coordinates grid.
+
+    The sign changes of det(A) are first detected on the (possibly coarse) grid, 
+    and connected into curves by marching squares. Each crossing is then refined 
+    by root-finding along its grid edge. If `point_spacing` is given, the curves are 
+    resampled at that spacing, and each new point is refined by root-finding along 
+    the normal to the curve.
+
+    The determinant is evaluated with the fused kernel `ComposableMassModel.evaluate_lensing_quantities()`, 
+    such that the deflection at the returned points (e.g. to compute caustics) is obtained 
+    from the last root-finding iteration, without evaluating the mass model again.
+
+    Note that critical lines smaller than the grid cells may be missed.
+
+    Parameters
+    ----------
+    coordinates : Coordinates
+        Coordinates grid on which sign changes are detected
+    composable_mass : ComposableMassModel
+        Mass model
+    point_spacing : float, optional
+        Approximate distance between consecutive points of the returned lines, 
+        by default None (points are the crossings of the grid edges)
+    tol : float, optional
+        Tolerance on the position of the points along their search segment, by default 1e-10
+    max_iter : int, optional
+        Maximum number of iterations of the root-finding, by default 100
+    return_deflection : bool, optional
+        If True, also returns the deflection at the points of each line, by default False
+
+    Returns
+    -------
+    list, or (list, list) if return_deflection is True
+        List of (x, y) tuples of arrays for each line (closed lines have the same
+        first and last points), as `find_critical_lines()`, 
+        and list of (alpha_x, alpha_y) tuples of arrays at the same points
+    """
+    def lensing_fn(x, y):
+        quantities = composable_mass.evaluate_lensing_quantities(x, y)
+        return quantities['det_A'], quantities['alpha_x'], quantities['alpha_y']
+
+    x, y = coordinates.pixel_coordinates
+    det_grid, _, _ = lensing_fn(x, y)
+    edge_points, edge_values, curves = _marching_squares(x, y, det_grid)
+    if len(curves) == 0:
+        return ([], []) if return_deflection else []
+    # refine the crossings along each grid edge
+    (x0, y0), (x1, y1) = edge_points
+    t, alpha = _bracketed_roots(lambda t_: lensing_fn(x0 + t_ * (x1 - x0), y0 + t_ * (y1 - y0)), 
+                                *edge_values, tol / coordinates.pixel_size, max_iter)
+    crossing_x, crossing_y = x0 + t * (x1 - x0), y0 + t * (y1 - y0)
+    lines, deflections = [], []
+    for edges, is_closed in curves:
+        curve_x, curve_y = crossing_x[edges], crossing_y[edges]
+        if alpha is None:
+            curve_alpha = None
+        else:
+            curve_alpha = (alpha[0][edges], alpha[1][edges])
+        if point_spacing is not None:
+            curve_x, curve_y, curve_alpha = _resample_curve(lensing_fn, curve_x, curve_y, is_closed, 
+                                                            point_spacing, coordinates.pixel_size, 
+                                                            tol, max_iter)
+        if is_closed:
+            curve_x, curve_y = np.append(curve_x, curve_x[0]), np.append(curve_y, curve_y[0])
+        lines.append((curve_x, curve_y))
+        if return_deflection:
+            if curve_alpha is None:
+                alpha_x, alpha_y = composable_mass.evaluate_deflection(curve_x, curve_y)
+            else:
+                alpha_x, alpha_y = curve_alpha
+                if is_closed:
+                    alpha_x, alpha_y = np.append(alpha_x, alpha_x[0]), np.append(alpha_y, alpha_y[0])
+            deflections.append((alpha_x, alpha_y))
+    if return_deflection:
+        return lines, deflections
+    return lines
+
+
+def _marching_squares(x, y, values):
+    # finds the grid edges where `values` changes sign, and orders them along the 
+    # zero-level curves; returns the end points of the edges (with values at each end), 
+    # and for each curve the indices of its edges and whether it is closed
+    ny, nx = values.shape
+    positive = values > 0
+    finite = np.isfinite(values)
+    # horizontal edges (i, j)-(i, j+1) have indices i*(nx-1) + j, 
+    # and vertical edges (i, j)-(i+1, j) have indices num_horiz + i*nx + j
+    num_horiz = ny * (nx - 1)
+    crossing_h = (positive[:, :-1] != positive[:, 1:]) & finite[:, :-1] & finite[:, 1:]
+    crossing_v = (positive[:-1, :] != positive[1:, :]) & finite[:-1, :] & finite[1:, :]
+    rows, cols = np.indices((ny, nx))
+    start = np.concatenate([(rows[:, :-1] * nx + cols[:, :-1]).ravel(), (rows[:-1, :] * nx + cols[:-1, :]).ravel()])
+    stop = np.concatenate([(rows[:, 1:] * nx + cols[:, 1:]).ravel(), (rows[1:, :] * nx + cols[1:, :]).ravel()])
+    crossing = np.concatenate([crossing_h.ravel(), crossing_v.ravel()])
+    edge_ids = np.flatnonzero(crossing)
+    # index of each crossing edge in the list of crossings
+    crossing_index = np.full(crossing.size, -1)
+    crossing_index[edge_ids] = np.arange(edge_ids.size)
+
+    # segments within each cell that has crossing edges
+    neighbors = [[] for _ in range(edge_ids.size)]
+    cell_crossings = (crossing_h[:-1, :].astype(int) + crossing_h[1:, :] 
+                      + crossing_v[:, :-1] + crossing_v[:, 1:])
+    for i, j in zip(*np.nonzero(cell_crossings)):
+        bottom = crossing_index[i*(nx-1) + j]
+        top = crossing_index[(i+1)*(nx-1) + j]
+        left = crossing_index[num_horiz + i*nx + j]
+        right = crossing_index[num_horiz + i*nx + j + 1]
+        if cell_crossings[i, j] == 4:
+            # saddle point: the sign at the cell center determines the connection
+            center_positive = values[i:i+2, j:j+2].mean() > 0
+            if center_positive == positive[i, j]:
+                pairs = [(bottom, right), (top, left)]
+            else:
+                pairs = [(bottom, left), (right, top)]
+        elif cell_crossings[i, j] == 2:
+            pairs = [tuple(e for e in (bottom, right, top, left) if e >= 0)]
+        else:
+            continue  # crossing at a non-finite value
+        for a, b in pairs:
+            neighbors[a].append(b)
+            neighbors[b].append(a)
+
+    # chain the segments, first the open curves (which end on the grid boundary)
+    visited = np.zeros(edge_ids.size, dtype=bool)
+    curves = []
+    ends = [k for k in range(edge_ids.size) if len(neighbors[k]) == 1]
+    for first in ends + list(range(edge_ids.size)):
+        if visited[first] or len(neighbors[first]) == 0:
+            continue
+        curve = [first]
+        visited[first] = True
+        previous, current = None, first
+        while True:
+            candidates = [k for k in neighbors[current] if k != previous and not visited[k]]
+            if len(candidates) == 0:
+                break
+            previous, current = current, candidates[0]
+            curve.append(current)
+            visited[current] = True
+        is_closed = len(neighbors[first]) == 2 and first in neighbors[current] and len(curve) > 2
+        curves.append((np.array(curve), is_closed))
+
+    flat_x, flat_y, flat_values = np.ravel(x), np.ravel(y), np.ravel(values)
+    edge_start, edge_stop = start[edge_ids], stop[edge_ids]
+    edge_points = ((flat_x[edge_start], flat_y[edge_start]), (flat_x[edge_stop], flat_y[edge_stop]))
+    edge_values = (flat_values[edge_start], flat_values[edge_stop])
+    return edge_points, edge_values, curves
+
+
+def _bracketed_roots(fn, f0, f1, tol, max_iter):
+    # finds roots t in [0, 1] of fn(t) (vectorized over independent brackets) such 
+    # that fn(0) = f0 and fn(1) = f1 have opposite signs, with the Illinois variant 
+    # of the false position method, until brackets are smaller than tol;
+    # fn returns a tuple whose first element is the function value, and the other 
+    # elements (e.g. the deflection) are returned at the roots, which are the points 
+    # of the last evaluation (None if fn has not been evaluated)
+    t0, t1 = np.zeros_like(f0), np.ones_like(f1)
+    f0, f1 = np.array(f0, dtype=float), np.array(f1, dtype=float)
+    side = np.zeros(f0.shape, dtype=int)  # which end has been kept at the last iteration
+    t = t0 - f0 * (t1 - t0) / (f1 - f0)
+    extra = None
+    for _ in range(max_iter):
+        active = np.abs(t1 - t0) > tol
+        if not np.any(active):
+            break
+        t = t0 - f0 * (t1 - t0) / (f1 - f0)
+        f, *extra = fn(t)
+        f = np.asarray(f, dtype=float)
+        same_as_0 = np.sign(f) == np.sign(f0)
+        root = (f == 0) & active
+        # the end point kept twice in a row has its value halved (Illinois)
+        f1 = np.where(active & same_as_0 & (side == 1), f1 / 2., f1)
+        f0 = np.where(active & ~same_as_0 & (side == -1), f0 / 2., f0)
+        t0 = np.where(active & same_as_0, t, t0)
+        f0 = np.where(active & same_as_0, f, f0)
+        t1 = np.where(active & ~same_as_0, t, t1)
+        f1 = np.where(active & ~same_as_0, f, f1)
+        side = np.where(active, np.where(same_as_0, 1, -1), side)
+        t0, t1 = np.where(root, t, t0), np.where(root, t, t1)
+    # each root t is an end of its bracket, hence within tol of the exact root
+    return t, extra
+
+
+def _resample_curve(fn, curve_x, curve_y, is_closed, point_spacing, search_length, tol, max_iter):
+    # resamples a curve at a regular spacing along its length, and moves each 
+    # new point along the normal to the curve to the closest root of fn 
+    # (see `_bracketed_roots()`); also returns the other outputs of fn at the new points
+    # (None if some points are not evaluated)
+    if is_closed:
+        curve_x, curve_y = np.append(curve_x, curve_x[0]), np.append(curve_y, curve_y[0])
+    arc_length = np.concatenate([[0.], np.cumsum(np.hypot(np.diff(curve_x), np.diff(curve_y)))])
+    num_points = max(2, int(np.ceil(arc_length[-1] / point_spacing)) + 1)
+    s = np.linspace(0., arc_length[-1], num_points)
+    if is_closed:
+        s = s[:-1]  # the last point is the first one
+    new_x, new_y = np.interp(s, arc_length, curve_x), np.interp(s, arc_length, curve_y)
+    # normal of the segment of the original curve containing each new point
+    k = np.clip(np.searchsorted(arc_length, s, side='right') - 1, 0, arc_length.size - 2)
+    seg_x, seg_y = np.diff(curve_x)[k], np.diff(curve_y)[k]
+    seg_length = np.maximum(np.hypot(seg_x, seg_y), np.finfo(float).tiny)
+    normal_x, normal_y = - seg_y / seg_length, seg_x / seg_length
+    x0, y0 = new_x - search_length / 2. * normal_x, new_y - search_length / 2. * normal_y
+    x1, y1 = new_x + search_length / 2. * normal_x, new_y + search_length / 2. * normal_y
+    f0, f1 = fn(x0, y0)[0], fn(x1, y1)[0]
+    bracketed = np.sign(f0) != np.sign(f1)
+    extra = None
+    if np.any(bracketed):
+        x0, y0, x1, y1 = x0[bracketed], y0[bracketed], x1[bracketed], y1[bracketed]
+        t, extra = _bracketed_roots(lambda t_: fn(x0 + t_ * (x1 - x0), y0 + t_ * (y1 - y0)), 
+                                    f0[bracketed], f1[bracketed], tol / search_length, max_iter)
+        new_x[bracketed], new_y[bracketed] = x0 + t * (x1 - x0), y0 + t * (y1 - y0)
+    if not np.all(bracketed):
+        logging.warning(f"{np.sum(~bracketed)} resampled points of a critical line could not be refined.")
+        extra = None
+    return new_x, new_y, extra
+
+
+def find_all_lens_lines(coordinates, composable_lens, method='adaptive', **kwargs_method):
+    """`composable_lens` can be an instance of `ComposableLens` or `ComposableMass`.
+
+    With `method='adaptive'` (default), critical lines are found with 
+    `find_critical_lines_adaptive()` (keyword arguments `kwargs_method`), and caustics
+    are obtained from the deflection evaluated along with the determinant of the lensing Jacobian. 
+    Otherwise with `method='contour'` they are contours of the inverse magnification 
+    evaluated on the grid (see `find_critical_lines()`).
+    """
     from coolest.api.composable_models import ComposableLensModel, ComposableMassModel  # avoiding circular imports 
     if isinstance(composable_lens, ComposableLensModel):
-        mag_fn = composable_lens.lens_mass.evaluate_magnification
+        composable_mass = composable_lens.lens_mass
     elif isinstance(composable_lens, ComposableMassModel):
-        mag_fn = composable_lens.evaluate_magnification
+        composable_mass = composable_lens
     else:
         raise ValueError("`composable_lens` must be a ComposableLensModel or a ComposableMassModel.")
-    mag_map = mag_fn(*coordinates.pixel_coordinates)
-    crit_lines = find_critical_lines(coordinates, mag_map)
-    caustics = find_caustics(crit_lines, composable_lens)
+    if method == 'adaptive':
+        crit_lines, deflections = find_critical_lines_adaptive(coordinates, composable_mass, 
+                                                               return_deflection=True, **kwargs_method)
+        caustics = [(cline[0] - alpha[0], cline[1] - alpha[1]) 
+                    for cline, alpha in zip(crit_lines, deflections)]
+    elif method == 'contour':
+        mag_map = composable_mass.evaluate_magnification(*coordinates.pixel_coordinates)
+        crit_lines = find_critical_lines(coordinates, mag_map)
+        caustics = find_caustics(crit_lines, composable_lens)
+    else:
+        raise ValueError(f"Method must be 'adaptive' or 'contour' (received '{method}').")
     return crit_lines, caustics
     
 
@@ -665,3 +1217,74 @@ def resample_multivariate_normal(samples, num_samples=5_000, **kwargs_cov):
     resampled = np.random.multivariate_normal(
         mean=mean, cov=cov, size=(int(num_samples/num_params), num_params)).reshape((-1, num_params))
     return resampled
+
+
+def weighted_percentiles(samples, weights, percentiles):
+    """Computes percentiles of weighted samples, along the first axis
+
+    Parameters
+    ----------
+    samples : ndarray
+        Samples of shape (num_samples, ...)
+    weights : array_like
+        Probability weights of each sample
+    percentiles : array_like
+        Percentiles between 0 and 100
+
+    Returns
+    -------
+    ndarray
+        Percentiles of shape (len(percentiles), ...)
+    """
+    samples = np.asarray(samples, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    quantiles = np.asarray(percentiles, dtype=float) / 100.
+    flat_samples = samples.reshape(samples.shape[0], -1)
+    result = np.empty((quantiles.size, flat_samples.shape[1]))
+    for i in range(flat_samples.shape[1]):
+        order = np.argsort(flat_samples[:, i])
+        sorted_weights = weights[order]
+        # cumulative weight at the middle of each sample
+        cdf = (np.cumsum(sorted_weights) - 0.5 * sorted_weights) / sorted_weights.sum()
+        result[:, i] = np.interp(quantiles, cdf, flat_samples[order, i])
+    return result.reshape(quantiles.shape + samples.shape[1:])
+
+
+def posterior_statistics(samples, weights=None):
+    """Computes the weighted mean, median, 16th and 84th percentiles of samples,
+    ignoring samples which have any NaN value.
+
+    Parameters
+    ----------
+    samples : ndarray
+        Samples of a scalar quantity of shape (num_samples,), 
+        or of a vector quantity of shape (num_samples, ...)
+    weights : array_like, optional
+        Probability weights of each sample, by default None (equal weights)
+
+    Returns
+    -------
+    PosteriorStatistics
+        Statistics of the samples (floats for a scalar quantity, arrays otherwise)
+
+    Raises
+    ------
+    ValueError
+        If no sample with non-zero weight is finite.
+    """
+    samples = np.asarray(samples, dtype=float)
+    if weights is None:
+        weights = np.ones(samples.shape[0])
+    weights = np.asarray(weights, dtype=float)
+    finite = np.all(np.isfinite(samples.reshape(samples.shape[0], -1)), axis=1)
+    if not np.all(finite):
+        logging.warning(f"{np.sum(~finite)} samples with non-finite values are ignored.")
+        samples, weights = samples[finite], weights[finite]
+    if samples.shape[0] == 0 or weights.sum() <= 0:
+        raise ValueError("No finite sample with non-zero weight.")
+    mean = np.average(samples, weights=weights, axis=0)
+    p16, median, p84 = weighted_percentiles(samples, weights, [16., 50., 84.])
+    def _output(value):
+        return float(value) if np.ndim(value) == 0 else value
+    return PosteriorStatistics(mean=_output(mean), median=_output(median), 
+                               percentile_16th=_output(p16), percentile_84th=_output(p84))
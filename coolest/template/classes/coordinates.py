@@ -1,8 +1,6 @@
 __author__ = 'aymgal'
 
 
-from astropy.coordinates import SkyCoord
-
 from coolest.template.classes.base import APIBaseObject
 
 
@@ -26,6 +24,7 @@ class CoordinatesOrigin(APIBaseObject):
 
     def _check_sky_coord(self, origin_ra, origin_dec):
         # creates astropy object to check everything is good
+        from astropy.coordinates import SkyCoord  # imported at first use, as it is slow to import
         sky_coord = SkyCoord(origin_ra, origin_dec, frame='icrs')
         return sky_coord.to_string(style='hmsdms').split(' ')
 
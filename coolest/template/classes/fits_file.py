@@ -2,7 +2,6 @@ __author__ = 'aymgal'
 
 
 import os
-from astropy.io import fits
 
 
 class FitsFile(object):
@@ -71,4 +70,5 @@ class FitsFile(object):
             abs_path = os.path.join(directory, self.path)
         else:
             abs_path = self.abs_path
+        from astropy.io import fits  # imported at first use, as it is slow to import
         return fits.getdata(abs_path, header=True)
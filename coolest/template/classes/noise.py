@@ -1,5 +1,7 @@
 __author__ = 'aymgal'
 
+import numpy as np
+
 from coolest.template.classes.grid import PixelatedRegularGrid
 from coolest.template.classes.base import APIBaseObject
 
@@ -32,6 +34,74 @@ class Noise(APIBaseObject):
             setattr(self, key, value)
         super().__init__()
 
+    @property
+    def model_dependent(self):
+        """True if the noise variance depends on the model image"""
+        return False
+
+    def get_variance_map(self, observation, instrument, model_image=None, directory=None):
+        """Computes the noise variance in each pixel of the observation, 
+        as the sum of the model-independent and model-dependent terms.
+
+        Parameters
+        ----------
+        observation : Observation
+            Observation instance
+        instrument : Instrument
+            Instrument instance
+        model_image : ndarray, optional
+            Model image, or stack of model images along the last two axes, 
+            required only if the noise is model-dependent, by default None
+        directory : str, optional
+            Absolute directory of the FITS files, by default None
+
+        Returns
+        -------
+        ndarray
+            Variance map (or stack of variance maps for a stack of model images)
+
+        Raises
+        ------
+        ValueError
+            If the noise is model-dependent and no model image is given.
+        """
+        variance = self.get_fixed_variance_map(observation, instrument, directory=directory)
+        if not self.model_dependent:
+            return variance
+        if model_image is None:
+            raise ValueError(f"A model image is required for computing the variance of noise type '{self.type}'.")
+        factor = self.get_model_variance_factor(observation, instrument, directory=directory)
+        return self.combine_variance_terms(variance, factor, model_image)
+
+    @staticmethod
+    def combine_variance_terms(fixed_variance, variance_factor, model_image):
+        """Sums the model-independent term of the noise variance and the model-dependent term
+        `variance_factor * max(model_image, 0)`. Pixels with an infinite factor 
+        (e.g., with no effective exposure) have an infinite variance, whatever the model.
+        """
+        finite_factor = np.isfinite(variance_factor)
+        model_term = np.where(finite_factor, variance_factor, 0.) * np.maximum(model_image, 0.)
+        return np.where(finite_factor, fixed_variance + model_term, np.inf)
+
+    def get_fixed_variance_map(self, observation, instrument, directory=None):
+        """Computes the model-independent term of the noise variance in each pixel,
+        which can be computed once and re-used for any model image.
+
+        Raises
+        ------
+        NotImplementedError
+            If the noise type does not support variance maps.
+        """
+        raise NotImplementedError(f"Noise type '{self.type}' does not support variance maps.")
+
+    def get_model_variance_factor(self, observation, instrument, directory=None):
+        """Computes the factor by which the (positive part of the) model image is multiplied
+        to obtain the model-dependent term of the noise variance in each pixel, i.e. 
+        the Gaussian approximation of the shot noise from the target flux.
+        This is the inverse of the effective exposure time, and zero for model-independent noise.
+        """
+        return np.zeros(observation.pixels.shape)
+
 
 class UniformGaussianNoise(Noise):
     """Uniform gaussian noise given a standard deviation and zero mean.
@@ -46,6 +116,9 @@ class UniformGaussianNoise(Noise):
         ntype = self.__class__.__name__
         super().__init__(ntype, std_dev=std_dev)
 
+    def get_fixed_variance_map(self, observation, instrument, directory=None):
+        return np.full(observation.pixels.shape, float(self.std_dev)**2)
+
 
 class NoiseMap(Noise):
     """Noise characterized by a noise map, which contains diagonal elements of the data covariance matrix.
@@ -62,6 +135,10 @@ class NoiseMap(Noise):
             noise_map = PixelatedRegularGrid()
         super().__init__(ntype, noise_map=noise_map)
 
+    def get_fixed_variance_map(self, observation, instrument, directory=None):
+        noise_map = self.noise_map.get_pixels(directory=directory)
+        return np.asarray(noise_map, dtype=float)**2
+
 
 class NoiseRealization(Noise):
     """A single realization of the noise.
@@ -78,6 +155,11 @@ class NoiseRealization(Noise):
             noise_realization = PixelatedRegularGrid()
         super().__init__(ntype, noise_realization=noise_realization)
 
+    def get_fixed_variance_map(self, observation, instrument, directory=None):
+        # a single realization only constrains the variance as a uniform value
+        realization = self.noise_realization.get_pixels(directory=directory)
+        return np.full(np.shape(realization), np.var(realization, dtype=float))
+
 
 class InstrumentalNoise(Noise):
     """Noise properties are computed directly based on the observed 
@@ -106,6 +188,42 @@ class InstrumentalNoise(Noise):
                          with_sky_shot_noise=with_sky_shot_noise,
                          with_target_shot_noise=with_target_shot_noise)
 
+    @property
+    def model_dependent(self):
+        return bool(self.with_target_shot_noise)
+
+    def get_fixed_variance_map(self, observation, instrument, directory=None):
+        # pixel values are assumed to be in electrons per second
+        variance = np.zeros(observation.pixels.shape)
+        if self.with_readout_noise or self.with_sky_shot_noise:
+            exposure_time = self._get_exposure_time(observation, directory)
+        if self.with_readout_noise:
+            variance = variance + (instrument.readout_noise / exposure_time)**2
+        if self.with_sky_shot_noise:
+            if observation.mag_sky_brightness is None or observation.mag_zero_point is None:
+                raise ValueError("Sky shot noise requires the sky brightness "
+                                 "and the zero-point magnitudes of the Observation.")
+            # sky flux in electrons per second per pixel
+            sky_flux = 10**(-0.4 * (observation.mag_sky_brightness - observation.mag_zero_point))
+            sky_flux *= observation.pixels.pixel_size**2
+            variance = variance + sky_flux / exposure_time
+        return variance
+
+    def get_model_variance_factor(self, observation, instrument, directory=None):
+        if not self.with_target_shot_noise:
+            return super().get_model_variance_factor(observation, instrument)
+        exposure_time = self._get_exposure_time(observation, directory)
+        return np.broadcast_to(1. / exposure_time, observation.pixels.shape).copy()
+
+    @staticmethod
+    def _get_exposure_time(observation, directory):
+        exposure_time = observation.exposure_time
+        if exposure_time is None:
+            raise ValueError("Instrumental noise requires the exposure time of the Observation.")
+        if isinstance(exposure_time, PixelatedRegularGrid):
+            return np.asarray(exposure_time.get_pixels(directory=directory), dtype=float)
+        return float(exposure_time)
+
 
 class DrizzledNoise(Noise):
     """Provide an exposure map as output by e.g., astrodrizzle with HST images (typically with '_wht' prefix).
@@ -124,3 +242,16 @@ class DrizzledNoise(Noise):
         if wht_map is None:
             wht_map = PixelatedRegularGrid()
         super().__init__(ntype, background_rms=background_rms, wht_map=wht_map)
+
+    @property
+    def model_dependent(self):
+        return True
+
+    def get_fixed_variance_map(self, observation, instrument, directory=None):
+        return np.full(observation.pixels.shape, float(self.background_rms)**2)
+
+    def get_model_variance_factor(self, observation, instrument, directory=None):
+        wht_map = np.asarray(self.wht_map.get_pixels(directory=directory), dtype=float)
+        # pixels with no effective exposure have an infinite variance
+        with np.errstate(divide='ignore'):
+            return np.where(wht_map > 0, 1. / wht_map, np.inf)
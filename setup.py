@@ -31,7 +31,6 @@ install_requires = [
 # Optional packages
 install_optional = [
     'matplotlib>=3.7.0',    # for plotting
-    'lenstronomy>=1.11.7',  # for shapelets light profiles
     'ipython',              # for running example notebooks
     'ipykernel',            # notebooks in custom environment
     'getdist>=1.3.2',       # for making corner plots
@@ -5,9 +5,11 @@ import pytest
 import os
 import numpy as np
 import numpy.testing as npt
+from astropy.io import fits
 
 from coolest.api.analysis import Analysis
 from coolest.api import util
+from coolest.template.classes.mass_light_model import LightModel
 
 
 def _get_analysis_instance(supersampling):
@@ -76,3 +78,198 @@ def test_effective_radius_light(supersampling, axis_ratio, radius):
         npt.assert_allclose(theta_eff_th, theta_eff, rtol=1)
     else:
         npt.assert_allclose(theta_eff_th, theta_eff, rtol=5e-2)
+
+@pytest.mark.parametrize("axis_ratio", [0.8, 0.6])
+def test_effective_radius_light_elliptical(axis_ratio):
+    analysis = _get_analysis_instance(3)
+    coolest = analysis.coolest
+    light_params = coolest.lensing_entities[1].light_model[0].parameters
+    light_params['q'].set_point_estimate(axis_ratio)
+    theta_eff_th = light_params['theta_eff'].point_estimate.value
+    phi = light_params['phi'].point_estimate.value
+    coord_large = analysis.coordinates.create_new_coordinates(grid_shape=(20, 20))
+    # apertures that follow the profile, and a single growth curve for several fractions
+    radii = analysis.effective_radius_light(coordinates=coord_large, fraction=[0.25, 0.5], 
+                                            q=axis_ratio, phi=phi, 
+                                            entity_selection=[1], profile_selection='all')
+    npt.assert_allclose(radii[1], theta_eff_th, rtol=2e-2)
+    assert radii[0] < radii[1]
+
+def test_radial_profiles():
+    analysis = _get_analysis_instance(1)
+    r_vec = np.linspace(0.1, 2., 20)
+    kappa, r_vec_out, kappa_std, counts = analysis.kappa_1d_profile(r_vec=r_vec, return_extra=True,
+                                                                    entity_selection=[0], 
+                                                                    profile_selection='all')
+    assert kappa.shape == r_vec_out.shape == kappa_std.shape == counts.shape == (20,)
+    assert np.all(np.diff(kappa) < 0)
+    light, _ = analysis.light_1d_profile(r_vec=r_vec, entity_selection=[1], profile_selection='all')
+    assert np.all(np.diff(light) < 0)
+
+def test_two_point_correlation_stack():
+    analysis = _get_analysis_instance(1)
+    x, y = analysis.coordinates.pixel_coordinates
+    images = np.stack([np.exp(- (x**2 + y**2) / (2. * s**2)) for s in (0.3, 0.6)])
+    bins, means, sdevs = analysis.two_point_correlation(Nbins=30, light_image=images, normalize=True,
+                                                        use_profile_coordinates=False)
+    assert means.shape == sdevs.shape == (2, len(bins))
+    for image, means_single in zip(images, means):
+        _, means_ref, _ = analysis.two_point_correlation(Nbins=30, light_image=image, normalize=True,
+                                                         use_profile_coordinates=False)
+        npt.assert_allclose(means_single, means_ref)
+    # the correlation of the wider image decreases more slowly
+    assert means[1, 10] / means[1, 0] > means[0, 10] / means[0, 0]
+
+def test_growth_curve_pixelated(tmp_path):
+    analysis = _get_analysis_instance(1)
+    analysis.coolest_dir = str(tmp_path)
+    # the source is replaced by a pixelated profile with uniform pixels
+    source = analysis.coolest.lensing_entities[1]
+    source.light_model = LightModel('PixelatedRegularGrid')
+    fits_path = os.path.join(str(tmp_path), 'source.fits')
+    fits.writeto(fits_path, np.ones((40, 40)))
+    source.light_model[0].parameters['pixels'].set_grid(fits_path, (-1., 1.), (-1., 1.), 
+                                                        check_fits_file=True)
+    kwargs_selection = dict(entity_selection=[1], profile_selection='all')
+    growth = analysis.growth_curve(no_re_eval=True, **kwargs_selection)
+    npt.assert_allclose(growth.total_flux, 1600.)
+    growth_masked = analysis.growth_curve(no_re_eval=True, circular_mask_radius=0.3, **kwargs_selection)
+    assert growth_masked.total_flux < 1600.
+    # the pixels of the cached light model are left unchanged
+    npt.assert_allclose(analysis.get_light_model(**kwargs_selection).surface_brightness(), 1.)
+    growth = analysis.growth_curve(no_re_eval=True, **kwargs_selection)
+    npt.assert_allclose(growth.total_flux, 1600.)
+
+class TestPosteriorDistribution(object):
+
+    def _setup_chain(self, tmp_path, num_samples=6):
+        analysis = _get_analysis_instance(1)
+        analysis.coolest_dir = str(tmp_path)
+        theta_E_param = analysis.coolest.lensing_entities[0].mass_model[0].parameters['theta_E']
+        rng = np.random.default_rng(2)
+        theta_E_samples = theta_E_param.point_estimate.value + 0.05 * rng.standard_normal(num_samples)
+        weights = rng.uniform(0.5, 1., num_samples)
+        table = np.array([theta_E_samples, weights]).T
+        np.savetxt(os.path.join(str(tmp_path), 'chain.csv'), table, delimiter=',',
+                   header=f'{theta_E_param.id},probability_weights', comments='')
+        analysis.coolest.meta['chain_file_name'] = 'chain.csv'
+        return analysis, theta_E_param, theta_E_samples, weights
+
+    def test_samples(self, tmp_path):
+        analysis, theta_E_param, theta_E_samples, weights = self._setup_chain(tmp_path)
+        theta_E_point = theta_E_param.point_estimate.value
+        kwargs_selection = dict(entity_selection=[0], profile_selection='all')
+        stats, values, weights_out = analysis.posterior_distribution('effective_einstein_radius', 
+                                                                     chunk_size=4, **kwargs_selection)
+        assert values.shape == (6,)
+        npt.assert_allclose(weights_out, weights)
+        npt.assert_allclose(values, theta_E_samples, rtol=4e-2)
+        npt.assert_allclose(stats.mean, np.average(values, weights=weights))
+        assert stats.percentile_16th < stats.median < stats.percentile_84th
+        # point estimates are restored
+        assert theta_E_param.point_estimate.value == theta_E_point
+        # process pool
+        _, values_pool, _ = analysis.posterior_distribution('effective_einstein_radius', chunk_size=2, 
+                                                            num_processes=2, **kwargs_selection)
+        npt.assert_allclose(values_pool, values)
+        # vector quantity
+        _, values_vector, _ = analysis.posterior_distribution('ellipticity_from_moments', 
+                                                              last_n_samples=2, entity_selection=[1])
+        assert values_vector.shape == (2, 2)
+        with pytest.raises(ValueError):
+            analysis.posterior_distribution('lensing_information')
+
+    def test_checkpoint(self, tmp_path, monkeypatch):
+        analysis, _, theta_E_samples, _ = self._setup_chain(tmp_path)
+        checkpoint_path = os.path.join(str(tmp_path), 'checkpoint.npz')
+        kwargs_selection = dict(entity_selection=[0], profile_selection='all')
+        _, values, _ = analysis.posterior_distribution('effective_einstein_radius', chunk_size=2, 
+                                                       **kwargs_selection)
+        evaluate_samples = analysis._evaluate_samples
+        calls = []
+        def evaluate_until_last_chunk(quantity, kwargs_quantity, param_ids, param_values):
+            calls.append(len(param_values))
+            if np.any(param_values[:, 0] == theta_E_samples[-1]):
+                raise KeyboardInterrupt
+            return evaluate_samples(quantity, kwargs_quantity, param_ids, param_values)
+        # interruption while evaluating the last chunk
+        monkeypatch.setattr(analysis, '_evaluate_samples', evaluate_until_last_chunk)
+        with pytest.raises(KeyboardInterrupt):
+            analysis.posterior_distribution('effective_einstein_radius', chunk_size=2, 
+                                            checkpoint_path=checkpoint_path, **kwargs_selection)
+        with np.load(checkpoint_path) as content:
+            assert int(content['num_done']) == 4
+        # resumes with the last chunk only
+        calls.clear()
+        monkeypatch.setattr(analysis, '_evaluate_samples', 
+                            lambda *args: calls.append(len(args[-1])) or evaluate_samples(*args))
+        _, values_resumed, _ = analysis.posterior_distribution('effective_einstein_radius', chunk_size=2, 
+                                                               checkpoint_path=checkpoint_path, 
+                                                               **kwargs_selection)
+        assert calls == [2]
+        npt.assert_allclose(values_resumed, values)
+        # resumes from the first pending sample with a different chunk size
+        monkeypatch.setattr(analysis, '_evaluate_samples', evaluate_until_last_chunk)
+        with pytest.raises(KeyboardInterrupt):
+            analysis.posterior_distribution('effective_einstein_radius', chunk_size=2, 
+                                            checkpoint_path=checkpoint_path + '.2', **kwargs_selection)
+        calls.clear()
+        monkeypatch.setattr(analysis, '_evaluate_samples', 
+                            lambda *args: calls.append(len(args[-1])) or evaluate_samples(*args))
+        _, values_resumed, _ = analysis.posterior_distribution('effective_einstein_radius', chunk_size=3, 
+                                                               checkpoint_path=checkpoint_path + '.2', 
+                                                               **kwargs_selection)
+        assert calls == [2]
+        npt.assert_allclose(values_resumed, values)
+
+@pytest.mark.parametrize("axis_ratio", [1.0, 0.7])
+def test_analytic_einstein_radius_and_slope(axis_ratio):
+    analysis = _get_analysis_instance(6)
+    mass_params = analysis.coolest.lensing_entities[0].mass_model[0].parameters
+    mass_params['q'].set_point_estimate(axis_ratio)
+    kwargs_selection = dict(entity_selection=[0], profile_selection='all')
+    theta_E_analytic = analysis.effective_einstein_radius(method='analytic', **kwargs_selection)
+    theta_E_grid, accuracy = analysis.effective_einstein_radius(method='grid', return_accuracy=True,
+                                                                **kwargs_selection)
+    npt.assert_allclose(theta_E_analytic, theta_E_grid, atol=accuracy)
+    if axis_ratio == 1.0:
+        npt.assert_allclose(theta_E_analytic, mass_params['theta_E'].point_estimate.value, rtol=1e-10)
+    slope = analysis.effective_radial_slope(r_eval=theta_E_analytic, method='analytic', **kwargs_selection)
+    npt.assert_allclose(slope, 1. - mass_params['gamma'].point_estimate.value, rtol=1e-10)
+    # not possible for profiles which are not centered on the circles
+    with pytest.raises(ValueError):
+        analysis.effective_einstein_radius(center=(0.5, 0.), method='analytic', **kwargs_selection)
+    theta_E_offset = analysis.effective_einstein_radius(center=(0.1, 0.), **kwargs_selection)
+    assert theta_E_offset != theta_E_analytic
+
+def test_shared_cache():
+    analysis = _get_analysis_instance(2)
+    kwargs_mass = dict(entity_selection=[0], profile_selection='all')
+    kwargs_light = dict(entity_selection=[1], profile_selection='all')
+    # the same model is re-used, until point estimates change
+    mass_model = analysis.get_mass_model(**kwargs_mass)
+    assert analysis.get_mass_model(**kwargs_mass) is mass_model
+    theta_E_param = analysis.coolest.lensing_entities[0].mass_model[0].parameters['theta_E']
+    theta_E_param.set_point_estimate(theta_E_param.point_estimate.value + 0.1)
+    assert analysis.get_mass_model(**kwargs_mass) is not mass_model
+    # only the most recently used models are kept
+    for k in range(analysis._max_cached_models + 2):
+        theta_E_param.set_point_estimate(1. + 0.01 * k)
+        analysis.get_mass_model(**kwargs_mass)
+    assert len(analysis._models) == analysis._max_cached_models
+    # each field is evaluated once for all metrics
+    analysis.clear_cache()
+    metrics = ['effective_einstein_radius', 'effective_radial_slope', 'effective_radius_light', 
+               'ellipticity_from_moments']
+    kwargs_metrics = {'effective_einstein_radius': {'method': 'grid'}, 
+                      'effective_radial_slope': {'method': 'grid', 'r_eval': 1.}}
+    results = analysis.compute_metrics(metrics, kwargs_selection_lens_mass=kwargs_mass, 
+                                       kwargs_selection_light=kwargs_light,
+                                       kwargs_metrics=kwargs_metrics)
+    assert list(results.keys()) == metrics
+    assert analysis.cache.misses == 2  # convergence and surface brightness maps
+    assert analysis.cache.hits == 2
+    npt.assert_allclose(results['effective_einstein_radius'], 
+                        analysis.effective_einstein_radius(method='analytic', **kwargs_mass), rtol=1e-2)
+    with pytest.raises(ValueError):
+        analysis.compute_metrics(['lensing_information'])
@@ -0,0 +1,53 @@
+__author__ = 'aymgal'
+
+
+import pytest
+import numpy as np
+import numpy.testing as npt
+
+from coolest.api.cache import EvaluationCache, fingerprint
+
+
+def test_fingerprint():
+    x = np.linspace(0, 1, 10)
+    params = [{'theta_E': 1., 'gamma': 2.}, {'pixels': np.ones((3, 3))}]
+    key = fingerprint('convergence', x, params)
+    assert key == fingerprint('convergence', x.copy(), [dict(params[0]), dict(params[1])])
+    assert key != fingerprint('deflection', x, params)
+    assert key != fingerprint('convergence', x + 1e-12, params)
+    assert key != fingerprint('convergence', x, [{'theta_E': 1., 'gamma': 2.1}, params[1]])
+    assert key != fingerprint('convergence', x.reshape(2, 5), params)
+    with pytest.raises(TypeError):
+        fingerprint(object())
+
+
+class TestEvaluationCache(object):
+
+    def test_get_or_compute(self):
+        cache = EvaluationCache()
+        calls = []
+        def compute():
+            calls.append(1)
+            return np.arange(4.), np.ones(4)
+        value_1 = cache.get_or_compute('a', compute)
+        value_2 = cache.get_or_compute('a', compute)
+        assert len(calls) == 1
+        assert cache.hits == 1 and cache.misses == 1
+        npt.assert_equal(value_1, value_2)
+        # returned values are copies
+        value_2[0][:] = -1.
+        npt.assert_equal(cache.get('a')[0], np.arange(4.))
+        cache.clear()
+        assert len(cache) == 0 and cache.nbytes == 0
+
+    def test_byte_budget(self):
+        cache = EvaluationCache(max_bytes=3 * 80)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, np.zeros(10))
+        cache.get('a')  # 'b' becomes the least recently used entry
+        cache.put('d', np.zeros(10))
+        assert 'b' not in cache
+        assert all(key in cache for key in ['a', 'c', 'd'])
+        assert cache.nbytes == 3 * 80
+        cache.put('e', np.zeros(100))  # too large to be cached
+        assert 'e' not in cache and len(cache) == 3
@@ -0,0 +1,112 @@
+__author__ = 'aymgal'
+
+
+import pytest
+import os
+import numpy as np
+import numpy.testing as npt
+
+from coolest.api.chain_reader import ChainReader, PosteriorSamples, get_chain_reader
+
+
+def _write_chain(file_path, num_samples=50, seed=3):
+    rng = np.random.default_rng(seed)
+    names = ['0-galaxy-mass-0-PEMD-theta_E', '0-galaxy-mass-0-PEMD-gamma', 'probability_weights']
+    table = rng.uniform(size=(num_samples, len(names)))
+    np.savetxt(file_path, table, delimiter=',', header=','.join(names), comments='')
+    return names, table
+
+
+class _DummyCOOLEST(object):
+
+    def __init__(self, file_name):
+        self.meta = {'chain_file_name': file_name}
+
+
+class TestChainReader(object):
+
+    @pytest.mark.parametrize("use_disk_cache", [True, False])
+    def test_columns(self, tmp_path, use_disk_cache):
+        file_path = os.path.join(str(tmp_path), 'chain.csv')
+        names, table = _write_chain(file_path)
+        chain = ChainReader(file_path, use_disk_cache=use_disk_cache)
+        assert chain.column_names == names
+        assert chain.parameter_ids == names[:-1]
+        assert chain.num_samples == table.shape[0]
+        npt.assert_allclose(chain.weights, table[:, -1])
+        npt.assert_allclose(chain.columns(names[::-1]), table[:, ::-1])
+        assert os.path.exists(chain.cache_path) is use_disk_cache
+        with pytest.raises(ValueError):
+            chain.column(names[0])[0] = 0.  # columns are read-only
+        with pytest.raises(KeyError):
+            chain.column('not-a-parameter')
+
+    def test_disk_cache(self, tmp_path):
+        file_path = os.path.join(str(tmp_path), 'chain.csv')
+        names, table = _write_chain(file_path)
+        ChainReader(file_path)
+        # the second reader reads the binary cache instead of parsing the file
+        chain = ChainReader(file_path)
+        assert chain._read_disk_cache() is not None
+        npt.assert_allclose(chain.columns(names), table)
+        # a modified chain file invalidates the cache
+        names, table = _write_chain(file_path, num_samples=30, seed=4)
+        os.utime(file_path, ns=(0, 0))
+        chain = ChainReader(file_path)
+        assert chain.num_samples == 30
+        npt.assert_allclose(chain.columns(names), table)
+        # a truncated cache file is ignored, and re-written
+        with open(chain.cache_path, 'rb+') as f:
+            f.truncate(100)
+        chain = ChainReader(file_path)
+        npt.assert_allclose(chain.columns(names), table)
+        assert chain._read_disk_cache() is not None
+        assert not any(name.endswith('.tmp') for name in os.listdir(str(tmp_path)))
+
+    def test_shared_reader(self, tmp_path):
+        _write_chain(os.path.join(str(tmp_path), 'chain.csv'))
+        coolest_object = _DummyCOOLEST('chain.csv')
+        chain_1 = get_chain_reader(coolest_object, str(tmp_path))
+        chain_2 = get_chain_reader(coolest_object, str(tmp_path))
+        assert chain_1 is chain_2
+        coolest_object.meta = {}
+        with pytest.raises(ValueError):
+            get_chain_reader(coolest_object, str(tmp_path))
+
+    def test_semicolon_separated(self, tmp_path):
+        file_path = os.path.join(str(tmp_path), 'chain.csv')
+        with open(file_path, 'w') as f:
+            f.write("a;probability_weights\n1.;1.\n")
+        with pytest.raises(ValueError):
+            ChainReader(file_path)
+
+
+class TestPosteriorSamples(object):
+
+    def test_views(self, tmp_path):
+        file_path = os.path.join(str(tmp_path), 'chain.csv')
+        names, table = _write_chain(file_path)
+        chain = ChainReader(file_path)
+        fixed_param_list = [{'theta_E': 1., 'gamma': 2., 'q': 0.7}, {'pixels': np.ones((3, 3))}]
+        param_ids = [{'theta_E': names[0], 'gamma': names[1], 'q': 'fixed-q'}, None]
+        samples = PosteriorSamples.from_chain(chain, param_ids, fixed_param_list=fixed_param_list)
+        assert len(samples) == table.shape[0]
+        assert samples.num_profiles == 2
+        # no copy of the chain columns
+        assert np.shares_memory(samples.get_profile_samples(0)['theta_E'], chain.column(names[0]))
+        # single sample organized as a list of parameters
+        sample = samples[-3]
+        assert np.shares_memory(sample[0]['gamma'], chain.column(names[1]))
+        npt.assert_allclose(sample[0]['gamma'], table[-3, 1])
+        npt.assert_allclose(sample[0]['q'], 0.7)
+        assert sample[1] is fixed_param_list[1]
+        # slices of samples
+        last_samples = samples[-10:]
+        assert len(last_samples) == 10
+        npt.assert_allclose(last_samples.weights, table[-10:, -1])
+        batched = last_samples.batched_param_list(ndim=2)
+        assert batched[0]['theta_E'].shape == (10, 1, 1)
+        npt.assert_allclose(batched[0]['theta_E'].ravel(), table[-10:, 0])
+        assert len(list(last_samples)) == 10
+        with pytest.raises(IndexError):
+            samples[table.shape[0]]
@@ -0,0 +1,302 @@
+__author__ = 'aymgal'
+
+
+import pytest
+import os
+import tracemalloc
+import numpy as np
+import numpy.testing as npt
+from scipy import signal
+
+from coolest.api.composable_models import ComposableMassModel, ComposableLensModel
+from coolest.api.cache import EvaluationCache
+from coolest.api.plotting import ModelPlotter
+from coolest.api import util
+from coolest.template.classes.psf import PixelatedPSF, GaussianPSF
+from coolest.template.classes.grid import PixelatedRegularGrid
+
+
+def _get_coolest_object():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    coolest_path = os.path.join(current_dir, '_templates', 'pemd_sersic')
+    return util.get_coolest_object(coolest_path, check_external_files=False)
+
+
+def _set_pixelated_psf(coolest_object, psf_supersampling=1):
+    # 99x99 PSF kernel with pixels smaller than the observation pixels by a given factor
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    fits_path = os.path.join(current_dir, '..', 'test_psf.fits')
+    half_size = 99 * coolest_object.observation.pixels.pixel_size / psf_supersampling / 2.
+    pixels = PixelatedRegularGrid(fits_path, (-half_size, half_size), (-half_size, half_size),
+                                  99, 99, check_fits_file=False)
+    coolest_object.instrument.psf = PixelatedPSF(pixels)
+
+
+def _write_chain_file(coolest_object, directory, num_samples=20, seed=12):
+    # random samples around the point estimates of the lens mass profile
+    rng = np.random.default_rng(seed)
+    params = coolest_object.lensing_entities[0].mass_model[0].parameters
+    scales = {'theta_E': 0.05, 'gamma': 0.05, 'phi': 5., 'q': 0.05,
+              'center_x': 0.01, 'center_y': 0.01}
+    columns = {}
+    for name, param in params.items():
+        value = param.point_estimate.value
+        if name == 'q':
+            value = 0.8  # such that the profile is elliptical
+        columns[param.id] = value + scales[name] * rng.standard_normal(num_samples)
+    columns['probability_weights'] = rng.uniform(0.5, 1., num_samples)
+    file_name = 'chain.csv'
+    header = ','.join(columns.keys())
+    table = np.array(list(columns.values())).T
+    np.savetxt(os.path.join(directory, file_name), table, delimiter=',',
+               header=header, comments='')
+    coolest_object.meta['chain_file_name'] = file_name
+    return columns
+
+
+class TestComposableMassModel(object):
+
+    @pytest.mark.parametrize("method_name", ['evaluate_potential', 'evaluate_deflection',
+                                             'evaluate_convergence', 'evaluate_hessian',
+                                             'evaluate_magnification'])
+    @pytest.mark.parametrize("chunk_size", [None, 1, 7])
+    def test_posterior_matches_loop(self, tmp_path, method_name, chunk_size):
+        coolest_object = _get_coolest_object()
+        _write_chain_file(coolest_object, str(tmp_path))
+        mass_model = ComposableMassModel(coolest_object, str(tmp_path),
+                                         load_posterior_samples=True,
+                                         posterior_chunk_size=chunk_size,
+                                         entity_selection=[0])
+        x, y = util.get_coordinates(coolest_object).pixel_coordinates
+        eval_fn = getattr(mass_model, method_name)
+        result = eval_fn(x, y, mode='posterior', last_n_samples=15)
+        # reference: loop over each sample
+        point_param_list = mass_model.param_list
+        result_ref = []
+        for sample_param_list in mass_model.post_param_list[-15:]:
+            mass_model.param_list = sample_param_list
+            result_ref.append(eval_fn(x, y, mode='point'))
+        mass_model.param_list = point_param_list
+        result_ref = np.array(result_ref)
+        if isinstance(result, tuple):
+            result = np.array(result).swapaxes(0, 1)
+        assert result.shape == result_ref.shape
+        npt.assert_allclose(result, result_ref, rtol=1e-10, atol=1e-12)
+
+    def test_pemd_backend(self):
+        coolest_object = _get_coolest_object()
+        mass_model = ComposableMassModel(coolest_object, entity_selection=[0])
+        mass_model_series = ComposableMassModel(coolest_object, entity_selection=[0], pemd_backend='series')
+        assert mass_model_series.profile_list[0].backend == 'series'
+        x, y = util.get_coordinates(coolest_object).pixel_coordinates
+        npt.assert_allclose(mass_model_series.evaluate_deflection(x, y), 
+                            mass_model.evaluate_deflection(x, y), rtol=1e-8, atol=1e-8)
+        with pytest.raises(ValueError):
+            ComposableMassModel(coolest_object, entity_selection=[0], pemd_backend='fft')
+
+    def test_posterior_fermat_potential(self, tmp_path):
+        coolest_object = _get_coolest_object()
+        columns = _write_chain_file(coolest_object, str(tmp_path))
+        mass_model = ComposableMassModel(coolest_object, str(tmp_path),
+                                         load_posterior_samples=True,
+                                         entity_selection=[0])
+        x, y = np.array([0.5, -1.2, 0.1]), np.array([1.1, -0.2, -1.3])
+        fermat = mass_model.fermat_potential(x, y, 0.05, -0.02, mode='posterior')
+        assert fermat.shape == (len(columns['probability_weights']), 3)
+        npt.assert_allclose(mass_model.post_weights, columns['probability_weights'])
+
+    def test_ray_shooting(self):
+        coolest_object = _get_coolest_object()
+        mass_model = ComposableMassModel(coolest_object, entity_selection=[0])
+        x, y = util.get_coordinates(coolest_object).pixel_coordinates
+        alpha_x, alpha_y = mass_model.evaluate_deflection(x, y)
+        x_rs, y_rs = mass_model.ray_shooting(x, y)
+        npt.assert_allclose(x_rs, x - alpha_x)
+        npt.assert_allclose(y_rs, y - alpha_y)
+
+    @pytest.mark.parametrize("mode", ['point', 'posterior'])
+    def test_lensing_quantities(self, tmp_path, mode):
+        coolest_object = _get_coolest_object()
+        _write_chain_file(coolest_object, str(tmp_path), num_samples=4)
+        mass_model = ComposableMassModel(coolest_object, str(tmp_path),
+                                         load_posterior_samples=True,
+                                         entity_selection=[0])
+        x, y = util.get_coordinates(coolest_object).pixel_coordinates
+        quantities = mass_model.evaluate_lensing_quantities(x, y, mode=mode)
+        alpha_x, alpha_y = mass_model.evaluate_deflection(x, y, mode=mode)
+        npt.assert_allclose(quantities['alpha_x'], alpha_x, rtol=1e-10)
+        npt.assert_allclose(quantities['alpha_y'], alpha_y, rtol=1e-10)
+        npt.assert_allclose(quantities['magnification'], 
+                            mass_model.evaluate_magnification(x, y, mode=mode), rtol=1e-8)
+        npt.assert_allclose(quantities['det_A'] * quantities['magnification'], 1.)
+
+
+class TestComposableLensModel(object):
+
+    @pytest.mark.parametrize("psf_supersampling, supersampling, super_convolution", 
+                             [(1, 3, True), (2, 2, True), (3, 3, True), (2, 2, False), (2, 4, True)])
+    @pytest.mark.parametrize("max_memory", [1, 2e6, 1e12])
+    def test_model_image_tiled(self, psf_supersampling, supersampling, super_convolution, max_memory):
+        coolest_object = _get_coolest_object()
+        _set_pixelated_psf(coolest_object, psf_supersampling)
+        lens_model = ComposableLensModel(coolest_object, 
+                                         kwargs_selection_source={'entity_selection': [1]},
+                                         kwargs_selection_lens_mass={'entity_selection': [0]})
+        kwargs = dict(supersampling=supersampling, super_convolution=super_convolution)
+        image_ref, _ = lens_model.model_image(**kwargs)
+        image, coordinates = lens_model.model_image(max_memory=max_memory, **kwargs)
+        assert coordinates is lens_model.coord_obs
+        npt.assert_allclose(image, image_ref, rtol=0, atol=1e-12 * image_ref.max())
+
+    def test_model_image_tiled_memory(self):
+        coolest_object = _get_coolest_object()
+        _set_pixelated_psf(coolest_object, psf_supersampling=5)
+        lens_model = ComposableLensModel(coolest_object, 
+                                         kwargs_selection_source={'entity_selection': [1]},
+                                         kwargs_selection_lens_mass={'entity_selection': [0]})
+        max_memory = 8 * 1024**2
+        tracemalloc.start()
+        lens_model.model_image(supersampling=5, max_memory=max_memory)
+        _, peak_memory_tiled = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        tracemalloc.start()
+        lens_model.model_image(supersampling=5)
+        _, peak_memory_full = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert peak_memory_tiled < max_memory < peak_memory_full
+
+    @pytest.mark.parametrize("super_convolution", [True, False])
+    def test_model_image_gaussian_psf(self, super_convolution):
+        coolest_object = _get_coolest_object()
+        fwhm = 2.  # in units of instrument pixels
+        coolest_object.instrument.psf = GaussianPSF(fwhm)
+        lens_model = ComposableLensModel(coolest_object, 
+                                         kwargs_selection_source={'entity_selection': [1]},
+                                         kwargs_selection_lens_mass={'entity_selection': [0]})
+        image = lens_model.model_image(supersampling=3, super_convolution=super_convolution)[0]
+        # reference with a (large) Gaussian kernel sampled at the relevant resolution
+        factor = 3 if super_convolution else 1
+        sigma = factor * fwhm / (2. * np.sqrt(2. * np.log(2.)))
+        coords = np.arange(-int(15 * sigma), int(15 * sigma) + 1)
+        kernel = np.outer(np.exp(- coords**2 / (2 * sigma**2)), np.exp(- coords**2 / (2 * sigma**2)))
+        kernel /= kernel.sum()
+        coord_super = lens_model.coord_obs.create_new_coordinates(pixel_scale_factor=1./3)
+        image_ref = lens_model.evaluate_lensed_surface_brightness(*coord_super.pixel_coordinates)
+        if super_convolution:
+            image_ref = util.downsampling(signal.fftconvolve(image_ref, kernel, mode='same'), factor=3)
+        else:
+            image_ref = signal.fftconvolve(util.downsampling(image_ref, factor=3), kernel, mode='same')
+        npt.assert_allclose(image, image_ref, rtol=0, atol=1e-12 * image_ref.max())
+        # tiled evaluation
+        image_tiled = lens_model.model_image(supersampling=3, super_convolution=super_convolution,
+                                             max_memory=2e6)[0]
+        npt.assert_allclose(image_tiled, image, rtol=0, atol=1e-12 * image.max())
+        # a single operator per resolution
+        assert lens_model.get_psf_convolution(3) is lens_model.get_psf_convolution(3)
+        assert lens_model.get_psf_convolution(3).fwhm == 3 * fwhm
+
+    def test_psf_convolution_reused(self):
+        coolest_object = _get_coolest_object()
+        _set_pixelated_psf(coolest_object, psf_supersampling=2)
+        lens_model = ComposableLensModel(coolest_object, 
+                                         kwargs_selection_source={'entity_selection': [1]},
+                                         kwargs_selection_lens_mass={'entity_selection': [0]})
+        psf_conv = lens_model.psf_convolution
+        lens_model.model_image(supersampling=2)
+        lens_model.model_image(supersampling=2)
+        lens_model.model_image(supersampling=2, max_memory=2e6)
+        assert lens_model.psf_convolution is psf_conv
+        # the full image and the two different tile shapes
+        assert len(psf_conv._kernel_ffts) == 3
+        # a new PSF creates a new operator
+        _set_pixelated_psf(coolest_object, psf_supersampling=1)
+        assert lens_model.psf_convolution is not psf_conv
+
+    @pytest.mark.parametrize("convolved", [True, False])
+    def test_model_image_adaptive_all_pixels(self, convolved):
+        coolest_object = _get_coolest_object()
+        _set_pixelated_psf(coolest_object, psf_supersampling=1)
+        lens_model = ComposableLensModel(coolest_object, 
+                                         kwargs_selection_source={'entity_selection': [1]},
+                                         kwargs_selection_lens_mass={'entity_selection': [0]})
+        # a negative tolerance refines all pixels, which is the uniform supersampling
+        image_ref, _ = lens_model.model_image(supersampling=4, convolved=convolved)
+        image, _, refinement_map = lens_model.model_image_adaptive(max_supersampling=4, tolerance=-1,
+                                                                   convolved=convolved)
+        npt.assert_allclose(image, image_ref, rtol=0, atol=1e-12 * image_ref.max())
+        assert np.all(refinement_map == 4)
+        # the PSF kernel must not be supersampled
+        _set_pixelated_psf(coolest_object, psf_supersampling=2)
+        with pytest.raises(ValueError):
+            lens_model.model_image_adaptive(convolved=True)
+
+    def test_model_image_adaptive(self):
+        coolest_object = _get_coolest_object()
+        lens_model = ComposableLensModel(coolest_object, 
+                                         kwargs_selection_source={'entity_selection': [1]},
+                                         kwargs_selection_lens_mass={'entity_selection': [0]})
+        image_ref, _ = lens_model.model_image(supersampling=8, convolved=False)
+        image_uniform, _ = lens_model.model_image(supersampling=4, convolved=False)
+        image, _, refinement_map = lens_model.model_image_adaptive(max_supersampling=8, tolerance=1e-3, 
+                                                                   magnification_threshold=50,
+                                                                   convolved=False)
+        assert set(np.unique(refinement_map)) <= {1, 2, 4, 8}
+        # more accurate than the uniform supersampling by a factor 4
+        error = np.abs(image - image_ref).max()
+        assert error < np.abs(image_uniform - image_ref).max()
+        # with at least 10 times less evaluations than the uniform supersampling by a factor 8
+        num_evaluations = refinement_map.size + sum(np.sum(refinement_map >= f) * f**2 for f in (2, 4, 8))
+        assert num_evaluations < refinement_map.size * 8**2 / 10
+
+
+class TestEvaluationCache(object):
+
+    def test_mass_model(self):
+        coolest_object = _get_coolest_object()
+        cache = EvaluationCache()
+        x, y = util.get_coordinates(coolest_object).pixel_coordinates
+        kappa_ref = ComposableMassModel(coolest_object, entity_selection=[0]).evaluate_convergence(x, y)
+        mass_model = ComposableMassModel(coolest_object, entity_selection=[0], cache=cache)
+        kappa = mass_model.evaluate_convergence(x, y)
+        # a new model with the same profiles re-uses the cached field
+        kappa = ComposableMassModel(coolest_object, entity_selection=[0], 
+                                    cache=cache).evaluate_convergence(x, y)
+        assert cache.hits == 1 and cache.misses == 1
+        npt.assert_array_equal(kappa, kappa_ref)
+        # different parameters or coordinates are evaluated again
+        mass_model.param_list[0] = dict(mass_model.param_list[0], theta_E=1.5)
+        kappa_2 = mass_model.evaluate_convergence(x, y)
+        mass_model.evaluate_convergence(x + 0.01, y)
+        assert cache.misses == 3
+        assert not np.allclose(kappa_2, kappa_ref)
+
+    def test_model_plotter(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        coolest_object = _get_coolest_object()
+        plotter = ModelPlotter(coolest_object, evaluation_cache=True)
+        kwargs_lens_mass = {'entity_selection': [0]}
+        kwargs_source = {'entity_selection': [1]}
+        fig, axes = plt.subplots(2, 3)
+        kappa = plotter.plot_convergence(axes[0, 0], kwargs_lens_mass=kwargs_lens_mass)
+        plotter.plot_convergence_diff(axes[0, 1], kappa, kwargs_lens_mass=kwargs_lens_mass)
+        mu = plotter.plot_magnification(axes[0, 2], kwargs_lens_mass=kwargs_lens_mass)
+        plotter.plot_magnification_diff(axes[1, 0], mu, kwargs_lens_mass=kwargs_lens_mass)
+        for ax in axes[1, 1:]:
+            plotter.plot_model_image(ax, convolved=False, supersampling=2,
+                                     kwargs_source=kwargs_source, 
+                                     kwargs_lens_mass=kwargs_lens_mass)
+        plt.close(fig)
+        # convergence, magnification, lensed surface brightness (with 
+        # the deflection field and source surface brightness) computed once
+        assert plotter.cache.misses == 5
+        assert plotter.cache.hits == 3
+        image_ref, _ = ComposableLensModel(coolest_object, 
+                                           kwargs_selection_source=kwargs_source,
+                                           kwargs_selection_lens_mass=kwargs_lens_mass
+                                           ).model_image(convolved=False, supersampling=2)
+        npt.assert_array_equal(plotter.plot_model_image(axes[1, 1], convolved=False, supersampling=2,
+                                                        kwargs_source=kwargs_source, 
+                                                        kwargs_lens_mass=kwargs_lens_mass), 
+                               image_ref)
@@ -0,0 +1,64 @@
+__author__ = 'aymgal'
+
+
+import pytest
+import numpy as np
+import numpy.testing as npt
+from scipy import signal
+
+from coolest.api.convolution import ConvolutionOperator, GaussianConvolutionOperator
+
+
+@pytest.mark.parametrize("image_shape", [(30, 30), (41, 27)])
+@pytest.mark.parametrize("kernel_shape", [(5, 5), (8, 7), (61, 61)])
+@pytest.mark.parametrize("mode", ['same', 'full'])
+def test_convolve(image_shape, kernel_shape, mode):
+    rng = np.random.default_rng(2)
+    image = rng.uniform(size=image_shape)
+    kernel = rng.uniform(size=kernel_shape).astype(np.float32)
+    kernel /= kernel.sum()
+    psf_conv = ConvolutionOperator(kernel)
+    result = psf_conv.convolve(image, mode=mode)
+    result_ref = signal.fftconvolve(image, kernel.astype(float), mode=mode)
+    assert result.shape == result_ref.shape
+    npt.assert_allclose(result, result_ref, rtol=0, atol=1e-14)
+
+
+def test_stack_and_cache():
+    rng = np.random.default_rng(3)
+    images = rng.uniform(size=(4, 20, 25))
+    kernel = rng.uniform(size=(7, 7))  # not normalized
+    psf_conv = ConvolutionOperator(kernel)
+    npt.assert_allclose(psf_conv.kernel.sum(), 1.)
+    result = psf_conv.convolve(images)
+    for image, image_conv in zip(images, result):
+        npt.assert_allclose(image_conv, psf_conv.convolve(image), rtol=0, atol=1e-14)
+    # the kernel is transformed only once for each padded shape
+    fft_shape = psf_conv.fft_shape(images.shape[1:])
+    assert psf_conv.kernel_fft(fft_shape) is psf_conv.kernel_fft(fft_shape)
+    assert len(psf_conv._kernel_ffts) == 1
+    with pytest.raises(ValueError):
+        psf_conv.convolve(images, mode='valid')
+
+
+@pytest.mark.parametrize("fwhm", [0.5, 1., 2.5, 6.])
+@pytest.mark.parametrize("mode", ['same', 'full'])
+def test_gaussian_convolve(fwhm, mode):
+    rng = np.random.default_rng(4)
+    image = rng.uniform(size=(50, 60))
+    psf_conv = GaussianConvolutionOperator(fwhm)
+    # reference: Gaussian sampled at pixel centers over a large area (negligible truncation)
+    sigma = fwhm / (2. * np.sqrt(2. * np.log(2.)))
+    coords = np.arange(-int(15 * sigma) - 1, int(15 * sigma) + 2)
+    kernel = np.outer(np.exp(- coords**2 / (2 * sigma**2)), np.exp(- coords**2 / (2 * sigma**2)))
+    kernel /= kernel.sum()
+    result_ref = signal.fftconvolve(image, kernel, mode='same')
+    result = psf_conv.convolve(image, mode=mode)
+    if mode == 'full':
+        # equivalent to a kernel of shape `kernel_shape`
+        assert result.shape == (50 + psf_conv.kernel_shape[0] - 1, 60 + psf_conv.kernel_shape[1] - 1)
+        start = (psf_conv.kernel_shape[0] - 1) // 2
+        result = result[start:start+50, start:start+60]
+    npt.assert_allclose(result, result_ref, rtol=0, atol=1e-13)
+    with pytest.raises(ValueError):
+        GaussianConvolutionOperator(0.)
@@ -0,0 +1,50 @@
+__author__ = 'aymgal'
+
+
+import sys
+import subprocess
+import pytest
+
+
+# budget (in seconds) for importing the modules needed to evaluate lens models,
+# about twice the typical ~0.25 s, while importing all dependencies eagerly takes more than 1 s
+_import_time_budget = 0.6
+
+# dependencies which should only be imported at first use
+_heavy_modules = ['matplotlib', 'getdist', 'pandas', 'skimage', 'lenstronomy', 
+                  'astropy.io.fits', 'astropy.coordinates', 'scipy.fft', 'scipy.sparse', 'scipy.spatial']
+
+
+def _import_times(module_name):
+    # cumulative import times (in microseconds) reported by `python -X importtime`
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module_name}'],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def _imported_modules(module_name):
+    # names of all the modules loaded after importing a module in a new interpreter
+    code = f'import sys, {module_name}; print(chr(10).join(sys.modules))'
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return set(result.stdout.split())
+
+
+@pytest.mark.parametrize("module_name", ['coolest.api.composable_models', 'coolest.api.likelihood'])
+def test_no_heavy_imports(module_name):
+    modules = _imported_modules(module_name)
+    assert module_name in modules
+    imported_heavy = [name for name in _heavy_modules if name in modules]
+    assert imported_heavy == []
+
+
+def test_import_time_budget():
+    module_name = 'coolest.api.composable_models'
+    # best of a few runs, as the first one may include reading files from disk
+    import_time = min(_import_times(module_name)[module_name] for _ in range(3))
+    assert import_time < _import_time_budget * 1e6
@@ -0,0 +1,100 @@
+__author__ = 'aymgal'
+
+
+import pytest
+import os
+import pickle
+import numpy as np
+import numpy.testing as npt
+from astropy.io import fits
+
+from coolest.api.lensing_operator import LensingOperator
+from coolest.api.composable_models import ComposableLensModel
+from coolest.api import util
+from coolest.template.classes.mass_light_model import LightModel
+from coolest.template.classes.psf import GaussianPSF
+
+
+_kwargs_selection = dict(kwargs_selection_source={'entity_selection': [1]},
+                         kwargs_selection_lens_mass={'entity_selection': [0]})
+
+
+def _get_lens_model(directory, source_type, interpolation_method='linear'):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    coolest_path = os.path.join(current_dir, '_templates', 'pemd_sersic')
+    coolest_object = util.get_coolest_object(coolest_path, check_external_files=False)
+    coolest_object.instrument.psf = GaussianPSF(0.15)
+    # the source is replaced by a pixelated profile
+    source = coolest_object.lensing_entities[1]
+    source.light_model = LightModel(source_type)
+    pixels = source.light_model[0].parameters['pixels']
+    if source_type == 'PixelatedRegularGrid':
+        x, y = np.meshgrid(np.linspace(-0.6, 0.6, 40), np.linspace(-0.6, 0.6, 40))
+        fits_path = os.path.join(directory, 'source.fits')
+        fits.writeto(fits_path, np.exp(- ((x - 0.05)**2 + (y + 0.1)**2) / 0.1**2))
+        pixels.set_grid(fits_path, (-0.615, 0.615), (-0.615, 0.615), check_fits_file=True)
+    else:
+        fits_path = os.path.join(current_dir, '..', 'test_irreg_grid.fits')
+        pixels.set_grid(os.path.abspath(fits_path), check_fits_file=True)
+    lens_model = ComposableLensModel(coolest_object, directory, **_kwargs_selection)
+    lens_model.source.profile_list[0].set_interpolation_method(interpolation_method)
+    return lens_model
+
+
+class TestLensingOperator(object):
+
+    @pytest.mark.parametrize("source_type", ['PixelatedRegularGrid', 'IrregularGrid'])
+    @pytest.mark.parametrize("interpolation_method", ['nearest', 'linear'])
+    @pytest.mark.parametrize("supersampling,convolved,super_convolution", 
+                             [(1, False, True), (2, False, True), (2, True, True), (2, True, False)])
+    def test_model_image(self, tmp_path, source_type, interpolation_method, 
+                         supersampling, convolved, super_convolution):
+        lens_model = _get_lens_model(str(tmp_path), source_type, interpolation_method)
+        kwargs = dict(supersampling=supersampling, convolved=convolved, super_convolution=super_convolution)
+        operator = lens_model.lensing_operator(**kwargs)
+        image_ref, _ = lens_model.model_image(**kwargs)
+        if convolved is False:
+            image_ref = np.nan_to_num(image_ref)  # outside of the convex hull of an irregular grid
+        source_values = lens_model.source.param_list[0].get('pixels', lens_model.source.param_list[0].get('z'))
+        assert operator.shape == (image_ref.size, source_values.size)
+        image = operator(source_values)
+        npt.assert_allclose(image, image_ref, rtol=0, atol=1e-10 * image_ref.max())
+        # stack of sources
+        images = operator.apply(np.array([source_values, 2. * source_values]))
+        npt.assert_allclose(images[1], 2. * image, rtol=1e-12)
+
+    def test_linear_algebra(self, tmp_path):
+        lens_model = _get_lens_model(str(tmp_path), 'PixelatedRegularGrid')
+        operator = lens_model.lensing_operator(supersampling=2, convolved=True)
+        rng = np.random.default_rng(4)
+        source_values, image = rng.uniform(size=operator.source_shape), rng.uniform(size=operator.image_shape)
+        # adjoint
+        npt.assert_allclose(np.sum(operator(source_values) * image),
+                            np.sum(source_values * operator.adjoint(image)), rtol=1e-10)
+        # normal equations
+        noise_variance = rng.uniform(0.5, 1.5, size=operator.image_shape)
+        mask = rng.uniform(size=operator.image_shape) > 0.2
+        lhs, rhs = operator.normal_equations(image, noise_variance=noise_variance, mask=mask)
+        weights = (mask / noise_variance).ravel()
+        matrix = operator.matrix.toarray()
+        npt.assert_allclose(lhs.toarray(), matrix.T @ (weights[:, None] * matrix), rtol=1e-10, atol=1e-14)
+        npt.assert_allclose(rhs, matrix.T @ (weights * image.ravel()), rtol=1e-10)
+
+    def test_serialization(self, tmp_path):
+        lens_model = _get_lens_model(str(tmp_path), 'IrregularGrid')
+        operator = lens_model.lensing_operator()
+        file_path = os.path.join(str(tmp_path), 'operator.npz')
+        operator.save(file_path)
+        for operator_copy in (LensingOperator.load(file_path), pickle.loads(pickle.dumps(operator))):
+            assert operator_copy.image_shape == operator.image_shape
+            assert operator_copy.source_shape == operator.source_shape
+            assert (operator_copy.matrix != operator.matrix).nnz == 0
+
+    def test_unsupported_source(self, tmp_path):
+        lens_model = _get_lens_model(str(tmp_path), 'PixelatedRegularGrid', 'cubic')
+        with pytest.raises(ValueError):
+            lens_model.lensing_operator()
+        lens_model = ComposableLensModel(lens_model.coolest, str(tmp_path), kwargs_selection_lens_mass={'entity_selection': [0]},
+                                         kwargs_selection_source={'entity_selection': [0]})
+        with pytest.raises(ValueError):
+            lens_model.lensing_operator()
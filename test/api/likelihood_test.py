@@ -0,0 +1,174 @@
+__author__ = 'aymgal'
+
+
+import pytest
+import os
+import numpy as np
+import numpy.testing as npt
+from astropy.io import fits
+
+from coolest.api.likelihood import ImagingLikelihood
+from coolest.api.composable_models import ComposableLensModel
+from coolest.api import util
+from coolest.template.classes.grid import PixelatedRegularGrid
+from coolest.template.classes.noise import NoiseMap, UniformGaussianNoise, InstrumentalNoise, DrizzledNoise
+from coolest.template.classes.psf import GaussianPSF, PixelatedPSF
+from coolest.template.classes.likelihood import ImagingDataLikelihood
+from coolest.template.classes.likelihood_list import DataLikelihoodList
+
+
+_kwargs_selection = dict(kwargs_selection_source={'entity_selection': [1]},
+                         kwargs_selection_lens_mass={'entity_selection': [0]})
+
+
+def _setup_coolest_object(directory, relative_sigma=0.02, seed=7):
+    # simulated data, noise map and mask in FITS files
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    coolest_path = os.path.join(current_dir, '_templates', 'pemd_sersic')
+    coolest_object = util.get_coolest_object(coolest_path, check_external_files=False)
+    coolest_object.instrument.psf = GaussianPSF(2.)
+    lens_model = ComposableLensModel(coolest_object, **_kwargs_selection)
+    model, coordinates = lens_model.model_image(supersampling=2)
+    rng = np.random.default_rng(seed)
+    noise_map = relative_sigma * model.max() * (1. + rng.uniform(size=model.shape))
+    data = model + noise_map * rng.standard_normal(model.shape)
+    x, y = coordinates.pixel_coordinates
+    mask = (np.hypot(x, y) < 2.5).astype(float)
+    fov_x = coolest_object.observation.pixels.field_of_view_x
+    fov_y = coolest_object.observation.pixels.field_of_view_y
+    grids = {}
+    for name, array in [('data', data), ('noise_map', noise_map), ('mask', mask)]:
+        fits_path = os.path.join(directory, f'{name}.fits')
+        fits.writeto(fits_path, array)
+        grids[name] = PixelatedRegularGrid(fits_path, fov_x, fov_y, *model.shape)
+    coolest_object.observation.pixels = grids['data']
+    coolest_object.observation.noise = NoiseMap(grids['noise_map'])
+    coolest_object.likelihoods = DataLikelihoodList(ImagingDataLikelihood(mask=grids['mask']))
+    return coolest_object, data, noise_map, mask
+
+
+class TestImagingLikelihood(object):
+
+    def test_point_estimate(self, tmp_path):
+        coolest_object, data, noise_map, mask = _setup_coolest_object(str(tmp_path))
+        likelihood = ImagingLikelihood(coolest_object, str(tmp_path), supersampling=2,
+                                       **_kwargs_selection)
+        assert likelihood.num_pixels == int(mask.sum())
+        assert len(likelihood.parameter_ids) == likelihood.num_parameters == 6 + 7
+        assert likelihood.parameter_ids[0].startswith('0-')
+        point_vector = likelihood.point_estimate_vector()
+        chi2 = likelihood.chi2(point_vector)
+        # reference from the normalized residuals
+        residuals, _ = likelihood.lens_model.model_residuals(mask=mask, supersampling=2)
+        npt.assert_allclose(chi2, np.sum(residuals**2), rtol=1e-10)
+        log_norm = - 0.5 * np.sum(np.log(2 * np.pi * noise_map[mask == 1]**2))
+        npt.assert_allclose(likelihood.log_likelihood(point_vector), - 0.5 * chi2 + log_norm, rtol=1e-10)
+        # the model parameters are left unchanged
+        npt.assert_array_equal(likelihood.point_estimate_vector(), point_vector)
+        with pytest.raises(ValueError):
+            likelihood.chi2(point_vector[:-1])
+
+    @pytest.mark.parametrize("batch_size", [None, 1, 3])
+    def test_batch(self, tmp_path, batch_size):
+        coolest_object, _, _, _ = _setup_coolest_object(str(tmp_path))
+        likelihood = ImagingLikelihood(coolest_object, str(tmp_path), supersampling=2,
+                                       batch_size=batch_size, **_kwargs_selection)
+        rng = np.random.default_rng(1)
+        param_vectors = likelihood.point_estimate_vector() * (1. + 0.05 * rng.standard_normal((7, 13)))
+        chi2, log_likelihood = likelihood.evaluate_batch(param_vectors)
+        assert chi2.shape == log_likelihood.shape == (7,)
+        assert likelihood.throughput > 0
+        chi2_ref = [likelihood.chi2(param_vector) for param_vector in param_vectors]
+        npt.assert_allclose(chi2, chi2_ref, rtol=1e-10)
+        # the point estimate is a better fit than perturbed parameters
+        assert np.all(chi2 > likelihood.chi2(likelihood.point_estimate_vector()))
+
+    def test_chain(self, tmp_path):
+        coolest_object, _, _, _ = _setup_coolest_object(str(tmp_path))
+        likelihood = ImagingLikelihood(coolest_object, str(tmp_path), supersampling=2,
+                                       **_kwargs_selection)
+        # chain with only a subset of the parameters
+        rng = np.random.default_rng(3)
+        point_vector = likelihood.point_estimate_vector()
+        values = point_vector[0] + 0.01 * rng.standard_normal(5)
+        table = np.array([values, np.ones(5)]).T
+        header = f'{likelihood.parameter_ids[0]},probability_weights'
+        np.savetxt(os.path.join(str(tmp_path), 'chain.csv'), table, delimiter=',',
+                   header=header, comments='')
+        coolest_object.meta['chain_file_name'] = 'chain.csv'
+        chi2, _ = likelihood.evaluate_chain(last_n_samples=3)
+        param_vectors = np.tile(point_vector, (3, 1))
+        param_vectors[:, 0] = values[-3:]
+        npt.assert_allclose(chi2, likelihood.evaluate_batch(param_vectors)[0], rtol=1e-12)
+
+    def test_batch_size_supersampling(self, tmp_path):
+        coolest_object, _, _, _ = _setup_coolest_object(str(tmp_path))
+        likelihood = ImagingLikelihood(coolest_object, str(tmp_path), supersampling=2,
+                                       **_kwargs_selection)
+        num_pixels = likelihood.mask.size
+        assert likelihood._get_batch_size() == likelihood._max_points_per_batch // (num_pixels * 2**2)
+        # the supersampling is adapted to a PSF kernel with pixels 4 times smaller
+        psf_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_psf.fits')
+        half_size = 99 * coolest_object.observation.pixels.pixel_size / 4 / 2.
+        coolest_object.instrument.psf = PixelatedPSF(PixelatedRegularGrid(
+            psf_path, (-half_size, half_size), (-half_size, half_size), 99, 99, check_fits_file=False))
+        likelihood = ImagingLikelihood(coolest_object, str(tmp_path), supersampling=2,
+                                       **_kwargs_selection)
+        assert likelihood.lens_model.get_supersampling(supersampling=2) == 4
+        assert likelihood._get_batch_size() == likelihood._max_points_per_batch // (num_pixels * 4**2)
+
+    @pytest.mark.parametrize("noise_type", ['UniformGaussianNoise', 'InstrumentalNoise', 'DrizzledNoise'])
+    def test_noise_types(self, tmp_path, noise_type):
+        coolest_object, _, _, _ = _setup_coolest_object(str(tmp_path))
+        observation, instrument = coolest_object.observation, coolest_object.instrument
+        if noise_type == 'UniformGaussianNoise':
+            coolest_object.observation.noise = UniformGaussianNoise(std_dev=0.001)
+        elif noise_type == 'InstrumentalNoise':
+            observation.exposure_time, observation.mag_zero_point, observation.mag_sky_brightness = 1e3, 25., 22.
+            instrument.readout_noise = 5.
+            coolest_object.observation.noise = InstrumentalNoise()
+        else:
+            wht_grid = observation.noise.noise_map  # any positive map
+            coolest_object.observation.noise = DrizzledNoise(background_rms=0.001, wht_map=wht_grid)
+        likelihood = ImagingLikelihood(coolest_object, str(tmp_path), supersampling=2,
+                                       **_kwargs_selection)
+        rng = np.random.default_rng(5)
+        param_vectors = likelihood.point_estimate_vector() * (1. + 0.05 * rng.standard_normal((3, 13)))
+        chi2, log_likelihood = likelihood.evaluate_batch(param_vectors)
+        # reference from the normalized residuals and the variance map of each model image
+        mask = likelihood.mask
+        for i, param_vector in enumerate(param_vectors):
+            model = likelihood._model_images(param_vector[None, :])[0]
+            variance = observation.noise.get_variance_map(observation, instrument, model_image=model, 
+                                                          directory=str(tmp_path))
+            chi2_ref = np.sum((observation.pixels.get_pixels() - model)[mask]**2 / variance[mask])
+            log_norm = - 0.5 * np.sum(np.log(2 * np.pi * variance[mask]))
+            npt.assert_allclose(chi2[i], chi2_ref, rtol=1e-10)
+            npt.assert_allclose(log_likelihood[i], - 0.5 * chi2_ref + log_norm, rtol=1e-10)
+        if noise_type == 'DrizzledNoise':
+            # pixels with zero weight are excluded from the likelihood and its normalization
+            wht_map = np.array(wht_grid.get_pixels())
+            wht_map[:10, :] = 0.
+            fits_path = os.path.join(str(tmp_path), 'wht_zeros.fits')
+            fits.writeto(fits_path, wht_map)
+            observation.noise.wht_map = PixelatedRegularGrid(fits_path, wht_grid.field_of_view_x, 
+                                                             wht_grid.field_of_view_y, *wht_map.shape)
+            likelihood_zeros = ImagingLikelihood(coolest_object, str(tmp_path), supersampling=2,
+                                                 **_kwargs_selection)
+            npt.assert_array_equal(likelihood_zeros.mask, mask & (wht_map > 0))
+            chi2_zeros, log_likelihood_zeros = likelihood_zeros.evaluate_batch(param_vectors)
+            assert np.all(np.isfinite(log_likelihood_zeros))
+            assert np.all(chi2_zeros < chi2)
+            # zero residuals in pixels with zero weight, including where the model is zero
+            model = likelihood_zeros.lens_model.model_image(supersampling=2)[0]
+            model[0, :5], model[0, 5:10] = 0., -1.
+            variance = likelihood_zeros.lens_model.noise_variance_map(model)
+            assert np.all(variance[wht_map == 0] == np.inf)
+            residuals, _ = likelihood_zeros.lens_model.model_residuals(supersampling=2)
+            assert np.all(residuals[wht_map == 0] == 0.)
+        if observation.noise.model_dependent:
+            with pytest.raises(ValueError):
+                likelihood.log_likelihood_from_chi2(chi2)
+        # residuals consistent with the variance map
+        residuals, _ = likelihood.lens_model.model_residuals(supersampling=2)
+        assert np.all(np.isfinite(residuals))
@@ -1,13 +1,18 @@
 __author__ = 'lynevdv'
 
 import pytest
+import sys
+import subprocess
 import numpy as np
 import numpy.testing as npt
 
-from coolest.api.profiles.light import Sersic
+from scipy import ndimage, interpolate
+
+from coolest.api.profiles.light import Sersic, Shapelets, PixelatedRegularGrid, IrregularGrid
 
 from lenstronomy.Util import param_util
 from lenstronomy.LightModel.light_model import LightModel
+from lenstronomy.LightModel.Profiles.shapelets import ShapeletSet
 
 
 class TestSersic(object):
@@ -47,3 +52,127 @@ class TestSersic(object):
 
         # compare
         npt.assert_almost_equal(result, result_ref, decimal=8)
+
+
+class TestShapelets(object):
+
+    @pytest.mark.parametrize("n_max", [0, 1, 4, 12])
+    def test_surface_brightness(self, n_max):
+        x, y = np.meshgrid(np.linspace(-1., 1., 40), np.linspace(-0.8, 1.2, 30))
+        amps = np.random.default_rng(n_max).normal(size=(n_max+1)*(n_max+2)//2)
+        kwargs = dict(n_max=n_max, beta=0.2, center_x=0.1, center_y=-0.05)
+        profile = Shapelets()
+        result = profile.evaluate_surface_brightness(x, y, amps=amps, **kwargs)
+        # reference (which sets basis functions to zero far from the center)
+        result_ref = ShapeletSet().function(x.ravel(), y.ravel(), amps, **kwargs).reshape(x.shape)
+        npt.assert_allclose(result, result_ref, rtol=0, atol=1e-10 * np.abs(result_ref).max())
+        # linear in the amplitudes
+        basis = profile.basis_matrix(x, y, **kwargs)
+        assert basis.shape == (x.size, amps.size)
+        npt.assert_allclose(basis.dot(amps), result.ravel(), rtol=1e-10, atol=1e-14)
+
+    def test_basis_cache(self):
+        x, y = np.meshgrid(np.linspace(-1., 1., 20), np.linspace(-1., 1., 20))
+        profile = Shapelets()
+        kwargs = dict(n_max=3, beta=0.3, center_x=0., center_y=0.)
+        profile.evaluate_surface_brightness(x, y, amps=np.ones(10), **kwargs)
+        basis = profile.get_basis(x.copy(), y.copy(), 3, 0.3, 0., 0.)
+        profile.evaluate_surface_brightness(x, y, amps=np.arange(10), **kwargs)
+        assert profile.get_basis(x, y, 3, 0.3, 0., 0.) is basis
+        assert profile.get_basis(x, y, 3, 0.4, 0., 0.) is not basis
+
+    def test_no_lenstronomy_import(self):
+        code = ("import sys, numpy as np; from coolest.api.profiles.light import Shapelets; "
+                "Shapelets().evaluate_surface_brightness(np.zeros(3), np.ones(3), amps=[1.], n_max=0, beta=1.); "
+                "assert 'lenstronomy' not in sys.modules")
+        subprocess.run([sys.executable, '-c', code], check=True)
+
+
+class TestPixelatedRegularGrid(object):
+
+    def setup_method(self):
+        # field-of-view offset along y only
+        self.profile = PixelatedRegularGrid((-1., 1.), (-0.5, 1.5), 20, 20)
+        x_axis, y_axis = self.profile.get_coordinates().pixel_axes
+        self.x, self.y = np.meshgrid(x_axis, y_axis)
+
+    def test_interpolation(self):
+        # linear interpolation of a plane is exact
+        pixels = 2. * self.x - 3. * self.y
+        x_eval, y_eval = np.meshgrid(np.linspace(-0.9, 0.9, 7), np.linspace(-0.4, 1.4, 5))
+        self.profile.set_interpolation_method('linear')
+        result = self.profile.evaluate_surface_brightness(x_eval, y_eval, pixels=pixels)
+        npt.assert_allclose(result, 2. * x_eval - 3. * y_eval, atol=1e-12)
+        # cubic interpolation passes through the pixel values, as map_coordinates with prefiltering
+        pixels = np.random.default_rng(1).uniform(size=(20, 20))
+        self.profile.set_interpolation_method('cubic')
+        result = self.profile.evaluate_surface_brightness(self.x, self.y, pixels=pixels)
+        npt.assert_allclose(result, pixels, atol=1e-10)
+        interp = self.profile.get_interpolator(pixels)
+        coords = interp.pixel_coordinates(np.array([y_eval.ravel(), x_eval.ravel()]))
+        result = self.profile.evaluate_surface_brightness(x_eval, y_eval, pixels=pixels)
+        result_ref = ndimage.map_coordinates(pixels, coords, order=3, mode='constant', prefilter=True)
+        npt.assert_allclose(result.ravel(), result_ref, rtol=1e-10)
+
+    def test_caching(self):
+        pixels = np.random.default_rng(2).uniform(size=(20, 20))
+        interp = self.profile.get_interpolator(pixels)
+        assert self.profile.get_interpolator(pixels.copy()) is interp
+        result = self.profile.evaluate_surface_brightness(self.x, self.y, pixels=pixels)
+        coords = self.profile._cache_pixel_coords[2]
+        # same coordinates values, modified pixels
+        pixels[0, 0] = 2.
+        result = self.profile.evaluate_surface_brightness(self.x.copy(), self.y.copy(), pixels=pixels)
+        assert self.profile.get_interpolator(pixels) is not interp
+        assert self.profile._cache_pixel_coords[2] is coords
+        npt.assert_allclose(result[0, 0], 2., rtol=1e-10)
+        # modified coordinates
+        x = self.x.copy()
+        x[0, 0] = 0.
+        self.profile.evaluate_surface_brightness(x, self.y, pixels=pixels)
+        assert self.profile._cache_pixel_coords[2] is not coords
+        # other spline order
+        self.profile.set_interpolation_method(1)
+        assert self.profile.get_interpolator(pixels).order == 1
+        with pytest.raises(ValueError):
+            self.profile.set_interpolation_method('spline')
+
+
+class TestIrregularGrid(object):
+
+    def setup_method(self):
+        rng = np.random.default_rng(3)
+        self.x, self.y, self.z = rng.uniform(-1., 1., size=(3, 200))
+        # evaluation points partly outside of the convex hull
+        self.x_eval, self.y_eval = np.meshgrid(np.linspace(-1.1, 1.1, 30), np.linspace(-1.1, 1.1, 25))
+
+    @pytest.mark.parametrize("method", ['nearest', 'linear', 'cubic'])
+    def test_griddata(self, method):
+        profile = IrregularGrid((-1., 1.), (-1., 1.), 200, interpolation_method=method)
+        for z in (self.z, self.z**2):
+            result = profile.evaluate_surface_brightness(self.x_eval, self.y_eval, 
+                                                         x=self.x, y=self.y, z=z)
+            result_ref = interpolate.griddata((self.x, self.y), z, (self.x_eval, self.y_eval), method=method)
+            assert result.shape == self.x_eval.shape
+            npt.assert_array_equal(np.isnan(result), np.isnan(result_ref))
+            npt.assert_allclose(result, result_ref, rtol=1e-10, atol=1e-12)
+
+    def test_caching(self):
+        profile = IrregularGrid((-1., 1.), (-1., 1.), 200, interpolation_method='linear')
+        weights = profile.interpolation_matrix(self.x_eval, self.y_eval, self.x, self.y)
+        tri = profile.get_triangulation(self.x, self.y)
+        assert weights.shape == (self.x_eval.size, 200)
+        # weights sum to one inside of the convex hull
+        row_sums = np.asarray(weights.sum(axis=1)).ravel()
+        npt.assert_allclose(row_sums[row_sums > 0], 1., rtol=1e-12)
+        # same coordinates
+        assert profile.interpolation_matrix(self.x_eval.copy(), self.y_eval, self.x.copy(), self.y) is weights
+        assert profile.get_triangulation(self.x.copy(), self.y) is tri
+        # new evaluation coordinates or grid points
+        assert profile.interpolation_matrix(self.x_eval + 0.1, self.y_eval, self.x, self.y) is not weights
+        assert profile.get_triangulation(self.x + 0.1, self.y) is not tri
+        with pytest.raises(ValueError):
+            IrregularGrid((-1., 1.), (-1., 1.), 200).interpolation_matrix(self.x_eval, self.y_eval, 
+                                                                           self.x, self.y)
+        with pytest.raises(ValueError):
+            IrregularGrid((-1., 1.), (-1., 1.), 200, interpolation_method='quintic')
@@ -5,7 +5,7 @@ import pytest
 import numpy as np
 import numpy.testing as npt
 
-from coolest.api.profiles.mass import PEMD, ExternalShear
+from coolest.api.profiles.mass import PEMD, ExternalShear, ConvergenceSheet
 
 from lenstronomy.Util import param_util
 from lenstronomy.LensModel.lens_model import LensModel
@@ -158,6 +158,59 @@ class TestPEMD(object):
         # compare
         npt.assert_almost_equal(result, result_ref, decimal=8)
 
+    @pytest.mark.parametrize("q", [0.95, 0.7, 0.3])
+    @pytest.mark.parametrize("gamma", [1.6, 2., 2.4])
+    def test_deflection_series_backend(self, q, gamma):
+        # define some coordinates grid (avoiding the singular center of the profile)
+        n_points = 50
+        x_, y_ = np.linspace(-2.4, 2.6, n_points), np.linspace(-2.65, 2.35, n_points)
+        x, y = np.meshgrid(x_, y_)
+        kwargs = dict(theta_E=1.1, gamma=gamma, phi=22., q=q, center_x=0.1, center_y=-0.15)
+
+        # reference
+        alpha_x_ref, alpha_y_ref = PEMD(backend='hyp2f1').deflection(x, y, **kwargs)
+
+        # series
+        profile = PEMD(backend='series', series_tol=1e-12)
+        alpha_x, alpha_y = profile.deflection(x, y, **kwargs)
+        npt.assert_allclose(alpha_x, alpha_x_ref, rtol=1e-9, atol=1e-9)
+        npt.assert_allclose(alpha_y, alpha_y_ref, rtol=1e-9, atol=1e-9)
+
+        # quantities derived from the deflection
+        npt.assert_allclose(profile.potential(x, y, **kwargs),
+                            PEMD().potential(x, y, **kwargs), rtol=1e-9, atol=1e-9)
+        npt.assert_allclose(profile.hessian(x, y, **kwargs),
+                            PEMD().hessian(x, y, **kwargs), rtol=1e-8, atol=1e-8)
+
+    def test_deflection_series_backend_samples(self):
+        # parameters with a leading sample axis
+        x, y = np.meshgrid(np.linspace(-1, 1, 4), np.linspace(-1, 1, 6))
+        kwargs = dict(theta_E=np.array([1., 1.2, 0.9]).reshape(3, 1, 1), 
+                      gamma=np.array([1.8, 2., 2.2]).reshape(3, 1, 1), 
+                      q=np.array([0.9, 0.5, 0.2]).reshape(3, 1, 1), 
+                      phi=10., center_x=0., center_y=0.)
+        alpha_ref = PEMD().deflection(x, y, **kwargs)
+        alpha = PEMD(backend='series').deflection(x, y, **kwargs)
+        assert alpha[0].shape == (3, 6, 4)
+        npt.assert_allclose(alpha, alpha_ref, rtol=1e-8, atol=1e-8)
+
+    def test_backend_selection(self):
+        profile = PEMD()
+        assert profile.backend == 'hyp2f1'
+        profile.set_backend('series', series_max_terms=2)
+        assert profile.backend == 'series' and profile.series_max_terms == 2
+        with pytest.raises(ValueError):
+            profile.set_backend('fft')
+
+    def test_deflection_many_points(self):
+        # 10^6 points
+        rng = np.random.default_rng(1)
+        x, y = rng.uniform(-3, 3, size=(2, 10**6))
+        kwargs = dict(theta_E=1.2, gamma=2.1, phi=30., q=0.7, center_x=0.1, center_y=-0.1)
+        alpha_ref = PEMD(backend='hyp2f1').deflection(x, y, **kwargs)
+        alpha = PEMD(backend='series').deflection(x, y, **kwargs)
+        npt.assert_allclose(alpha, alpha_ref, rtol=1e-8, atol=1e-8)
+
 
 
 class TestExternalShear(object):
@@ -216,3 +269,29 @@ class TestExternalShear(object):
         # compare
         npt.assert_almost_equal(alpha_x, alpha_x_ref, decimal=8)
         npt.assert_almost_equal(alpha_y, alpha_y_ref, decimal=8)
+
+
+@pytest.mark.parametrize("profile, params", [
+    (PEMD(), {'theta_E': 1.1, 'gamma': 1.9, 'q': 0.7, 'phi': 22., 'center_x': 0.1, 'center_y': -0.15}),
+    (ExternalShear(), {'gamma_ext': 0.08, 'phi_ext': 22.}),
+    (ConvergenceSheet(), {'kappa_s': 0.1}),
+])
+def test_lensing_quantities(profile, params):
+    # define some coordinates grid
+    n_points = 10
+    x_, y_ = np.linspace(-0.4, 0.2, n_points), np.linspace(-0.3, 0.5, n_points)
+    x, y = np.meshgrid(x_, y_)
+
+    # fused evaluation
+    alpha_x, alpha_y, kappa, gamma_1, gamma_2 = profile.lensing_quantities(x, y, **params)
+
+    # separate evaluations
+    alpha_x_ref, alpha_y_ref = profile.deflection(x, y, **params)
+    H_xx, H_xy, _, H_yy = profile.hessian(x, y, **params)
+
+    # compare
+    npt.assert_almost_equal(alpha_x, alpha_x_ref, decimal=10)
+    npt.assert_almost_equal(alpha_y, alpha_y_ref, decimal=10)
+    npt.assert_almost_equal(kappa, (H_xx + H_yy) / 2., decimal=10)
+    npt.assert_almost_equal(gamma_1, (H_xx - H_yy) / 2., decimal=10)
+    npt.assert_almost_equal(gamma_2, H_xy, decimal=10)
@@ -22,3 +22,192 @@ def test_get_coordinates_from_regular_grid(field_of_view_x, field_of_view_y, num
     retrieved_field_of_view_y = [plt_extent[2], plt_extent[3]]
     npt.assert_allclose(retrieved_field_of_view_y, field_of_view_y, atol=1e-8)
     npt.assert_allclose(coordinates.center, (np.mean(field_of_view_x), np.mean(field_of_view_y)), atol=1e-8)
+
+
+@pytest.mark.parametrize("pixel_scale_factor", [1., 1./2, 1./5])
+def test_new_pixel_axes(pixel_scale_factor):
+    # tests that the 1D axes are the same as those of the new coordinates grid
+    coordinates = util.get_coordinates_from_regular_grid([-1., 1.], [-1., 1.], 10, 10)
+    x_axis, y_axis = coordinates.new_pixel_axes(pixel_scale_factor=pixel_scale_factor)
+    x, y = coordinates.create_new_coordinates(pixel_scale_factor=pixel_scale_factor).pixel_coordinates
+    x_grid, y_grid = np.meshgrid(x_axis, y_axis)
+    npt.assert_array_equal(x_grid, x)
+    npt.assert_array_equal(y_grid, y)
+
+
+@pytest.mark.parametrize("amplitude", [2., 5.])
+@pytest.mark.parametrize("center", [(0., 0.), (0.23, -0.11)])
+def test_mean_convergence_radius(amplitude, center):
+    x, y = util.get_coordinates_from_regular_grid((-3, 3), (-3, 3), 300, 300).pixel_coordinates
+    # gaussian convergence, for which the mean convergence within R is analytic
+    sigma = 0.5
+    kappa = amplitude * np.exp(- ((x - center[0])**2 + (y - center[1])**2) / (2. * sigma**2))
+    def mean_kappa(R):
+        return amplitude * 2. * sigma**2 * (1. - np.exp(- R**2 / (2. * sigma**2))) / R**2
+    for mean_value in (1., 1.5):
+        radius = util.mean_convergence_radius(kappa, x, y, *center, mean_value=mean_value)
+        npt.assert_allclose(mean_kappa(radius), mean_value, rtol=2e-3)
+    # sub-critical convergence, or Einstein radius outside of the grid
+    assert np.isnan(util.mean_convergence_radius(0.1 * np.ones_like(x), x, y, *center))
+    assert np.isnan(util.mean_convergence_radius(2. * np.ones_like(x), x, y, *center))
+
+
+@pytest.mark.parametrize("q", [1., 0.6])
+@pytest.mark.parametrize("center", [(0., 0.), (0.23, -0.11)])
+def test_growth_curve(q, center):
+    from coolest.api.profiles import util as profile_util
+    x, y = util.get_coordinates_from_regular_grid((-3, 3), (-3, 3), 300, 300).pixel_coordinates
+    # elliptical gaussian, for which the flux within elliptical apertures is analytic
+    sigma, phi = 0.4, 30.
+    phi_ = profile_util.eastofnorth2normalradians(phi)
+    x_t, y_t = profile_util.shift_rotate_elliptical(x, y, phi_, q, *center)
+    light = np.exp(- (x_t**2 + y_t**2) / (2. * sigma**2))
+    growth = util.GrowthCurve(light, x, y, center_x=center[0], center_y=center[1], q=q, phi=phi)
+    fractions = np.array([0.2, 0.5, 0.8])
+    radii = growth.radius(fractions)
+    npt.assert_allclose(radii, sigma * np.sqrt(- 2. * np.log(1. - fractions)), atol=5e-3)  # 1/4 pixel
+    npt.assert_allclose(growth.enclosed_flux(radii) / growth.total_flux, fractions, atol=5e-3)
+    npt.assert_allclose(growth.total_flux, light.sum())
+    # single fraction, and consistency with effective_radius()
+    r_eff, _ = util.effective_radius(light, x, y, center_x=center[0], center_y=center[1], q=q, phi=phi)
+    assert np.ndim(r_eff) == 0
+    npt.assert_allclose(r_eff, radii[1])
+    # undefined radius
+    assert np.isnan(util.GrowthCurve(np.zeros_like(x), x, y).radius(0.5))
+
+
+@pytest.mark.parametrize("q", [1., 0.7])
+def test_radial_profile(q):
+    x, y = util.get_coordinates_from_regular_grid((-2, 2), (-2, 2), 80, 80).pixel_coordinates
+    bin_edges = np.linspace(0., 2., 11)
+    profile = util.RadialProfile(x, y, bin_edges, center_x=0.1, center_y=-0.2, q=q, phi=20.)
+    # reference with one boolean mask per bin
+    from coolest.api.profiles import util as profile_util
+    phi_ = profile_util.eastofnorth2normalradians(20.)
+    radius = np.hypot(*profile_util.shift_rotate_elliptical(x, y, phi_, q, 0.1, -0.2))
+    image = np.random.default_rng(0).normal(size=x.shape)
+    mean, std, counts = profile.profile(image)
+    for i in range(10):
+        in_bin = (radius > bin_edges[i]) & (radius <= bin_edges[i+1])
+        assert counts[i] == in_bin.sum()
+        npt.assert_allclose(mean[i], image[in_bin].mean())
+        npt.assert_allclose(std[i], image[in_bin].std())
+    # stack of images
+    mean_stack, std_stack, _ = profile.profile(np.stack([image, 3. * image]))
+    assert mean_stack.shape == (2, 10)
+    npt.assert_allclose(mean_stack[1], 3. * mean)
+    npt.assert_allclose(std_stack[0], std)
+    # empty bins
+    profile = util.RadialProfile(x, y, [0., 1e-4, 1.])
+    assert np.isnan(profile.mean(image)[0])
+
+
+def test_azim_averaged_two_point_correlation():
+    image = np.random.default_rng(1).random((30, 30))
+    dpix, rmax, Nbins = 0.1, 1., 20
+    bins, means, sdevs, cov = util.azim_averaged_two_point_correlation(image, dpix, rmax, Nbins)
+    # reference binning of the covariance map with per-entry loops
+    vals = [[] for _ in range(len(bins))]
+    for i in range(cov.shape[0]):
+        for j in range(cov.shape[1]):
+            r = np.hypot((j - 15.) * dpix, (i - 15.) * dpix)
+            if r < rmax and i != j:
+                vals[int(np.floor(r / (rmax / Nbins)))].append(cov[i, j])
+    npt.assert_allclose(means, [np.mean(v) if v else 0. for v in vals], atol=1e-12)
+    npt.assert_allclose(sdevs, [np.std(v) if v else 0. for v in vals], atol=1e-12)
+    # stack of images
+    bins_stack, means_stack, sdevs_stack, cov_stack = util.azim_averaged_two_point_correlation(
+        np.stack([image, 2. * image]), dpix, rmax, Nbins)
+    npt.assert_array_equal(bins_stack, bins)
+    assert means_stack.shape == sdevs_stack.shape == (2, len(bins))
+    npt.assert_allclose(means_stack[0], means)
+    npt.assert_allclose(means_stack[1], 4. * means)
+    npt.assert_allclose(cov_stack[1], 4. * cov)
+
+
+def test_posterior_statistics():
+    rng = np.random.default_rng(4)
+    samples = rng.normal(1., 0.5, size=20000)
+    # equal weights compared to unweighted percentiles
+    stats = util.posterior_statistics(samples)
+    npt.assert_allclose(stats.mean, np.mean(samples))
+    npt.assert_allclose([stats.percentile_16th, stats.median, stats.percentile_84th], 
+                        np.percentile(samples, [16, 50, 84]), atol=1e-3)
+    # integer weights are equivalent to repeated samples
+    weights = rng.integers(0, 3, size=samples.size)
+    stats = util.posterior_statistics(samples, weights)
+    npt.assert_allclose(stats.median, np.median(np.repeat(samples, weights)), atol=1e-3)
+    # vector quantity, and non-finite samples
+    vectors = np.stack([samples, 2. * samples], axis=1)
+    vectors[0, 1] = np.nan
+    stats = util.posterior_statistics(vectors)
+    assert stats.mean.shape == (2,)
+    npt.assert_allclose(stats.median[1], 2. * stats.median[0])
+
+
+@pytest.mark.parametrize("q", [1., 0.7])
+def test_power_law_radial_profile(q):
+    from coolest.api.profiles.mass import PEMD
+    theta_E_list, gamma_list, q_list = [1.2, 0.3], [2.1, 1.8], [q, 0.9]
+    profile = util.PowerLawRadialProfile(theta_E_list, gamma_list, q_list, kappa_sheet=0.05)
+    # reference from the convergence of the PEMD profiles on a polar grid
+    pemd = PEMD()
+    r_max = 1.5
+    r = np.linspace(0., r_max, 2001)[1:]
+    angles = np.linspace(0., 2. * np.pi, 720, endpoint=False)
+    r_grid, angle_grid = np.meshgrid(r, angles)
+    x, y = r_grid * np.cos(angle_grid), r_grid * np.sin(angle_grid)
+    kappa = 0.05 + sum(pemd.convergence(x, y, theta_E=theta_E, gamma=gamma, q=q_, phi=20.) 
+                       for theta_E, gamma, q_ in zip(theta_E_list, gamma_list, q_list))
+    kappa_avg = kappa.mean(axis=0)
+    npt.assert_allclose(profile.convergence(r), kappa_avg, rtol=1e-8)
+    mean_r_max = 2. / r_max**2 * np.sum(kappa_avg * r) * (r[1] - r[0])
+    npt.assert_allclose(profile.mean_convergence(r_max), mean_r_max, rtol=1e-2)
+    # effective Einstein radius and logarithmic slope
+    r_Ein = profile.mean_convergence_radius()
+    npt.assert_allclose(profile.mean_convergence(r_Ein), 1., rtol=1e-8)
+    log_r = np.log([0.99 * r_Ein, 1.01 * r_Ein])
+    slope_fd = np.diff(np.log(profile.convergence(np.exp(log_r)))) / np.diff(log_r)
+    npt.assert_allclose(profile.logarithmic_slope(r_Ein), slope_fd[0], rtol=1e-3)
+    # a single power-law without convergence sheet
+    single = util.PowerLawRadialProfile([1.2], [2.], [1.])
+    npt.assert_allclose(single.mean_convergence_radius(), 1.2)
+    npt.assert_allclose(single.logarithmic_slope([0., 0.5, 3.]), -1.)
+
+
+@pytest.mark.parametrize("point_spacing", [None, 0.02])
+def test_find_critical_lines_adaptive(point_spacing):
+    import os
+    from coolest.api.composable_models import ComposableMassModel
+    coolest_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '_templates', 'pemd_sersic')
+    coolest_object = util.get_coolest_object(coolest_path, check_external_files=False)
+    mass_params = coolest_object.lensing_entities[0].mass_model[0].parameters
+    mass_params['gamma'].set_point_estimate(2.)
+    mass_params['q'].set_point_estimate(1.)
+    # coarse grid, with cells of 0.24 arcsec
+    coordinates = util.get_coordinates(coolest_object).create_new_coordinates(pixel_scale_factor=4)
+    mass_model = ComposableMassModel(coolest_object, entity_selection=[0], profile_selection='all')
+    # the critical line of a singular isothermal sphere is the Einstein ring
+    lines, caustics = util.find_all_lens_lines(coordinates, mass_model, point_spacing=point_spacing)
+    assert len(lines) == len(caustics) == 1
+    line_x, line_y = lines[0]
+    assert line_x[0] == line_x[-1] and line_y[0] == line_y[-1]  # closed line
+    radius = np.hypot(line_x - mass_params['center_x'].point_estimate.value, 
+                      line_y - mass_params['center_y'].point_estimate.value)
+    npt.assert_allclose(radius, mass_params['theta_E'].point_estimate.value, rtol=1e-8)
+    if point_spacing is not None:
+        spacing = np.hypot(np.diff(line_x), np.diff(line_y))
+        npt.assert_allclose(spacing, point_spacing, rtol=5e-2)
+    # caustics from the deflection of the last root-finding iteration
+    npt.assert_allclose(caustics[0], mass_model.ray_shooting(line_x, line_y), atol=1e-12)
+    # elliptical power-law with a radial critical line
+    mass_params['gamma'].set_point_estimate(1.8)
+    mass_params['q'].set_point_estimate(0.6)
+    mass_model = ComposableMassModel(coolest_object, entity_selection=[0], profile_selection='all')
+    lines = util.find_critical_lines_adaptive(coordinates, mass_model, point_spacing=point_spacing)
+    assert len(lines) == 2
+    for line_x, line_y in lines:
+        H_xx, H_xy, H_yx, H_yy = mass_model.evaluate_hessian(line_x, line_y)
+        npt.assert_allclose((1 - H_xx) * (1 - H_yy) - H_xy * H_yx, 0., atol=1e-7)
+    with pytest.raises(ValueError):
+        util.find_all_lens_lines(coordinates, mass_model, method='unknown')
@@ -0,0 +1,84 @@
+__author__ = 'aymgal'
+
+
+import pytest
+import os
+import numpy as np
+import numpy.testing as npt
+from astropy.io import fits
+
+from coolest.template.classes.grid import PixelatedRegularGrid
+from coolest.template.classes.instrument import Instrument
+from coolest.template.classes.observation import Observation
+from coolest.template.classes.noise import (Noise, UniformGaussianNoise, NoiseMap, NoiseRealization,
+                                            InstrumentalNoise, DrizzledNoise)
+
+
+def _grid(directory, name, array):
+    fits_path = os.path.join(directory, f'{name}.fits')
+    fits.writeto(fits_path, array)
+    return PixelatedRegularGrid(fits_path, (-0.5, 0.5), (-0.5, 0.5), *array.shape)
+
+
+@pytest.fixture
+def setup(tmp_path):
+    rng = np.random.default_rng(2)
+    model = rng.uniform(-1., 10., size=(10, 10))
+    observation = Observation(pixels=_grid(str(tmp_path), 'data', model), exposure_time=100.,
+                              mag_zero_point=25., mag_sky_brightness=22.)
+    instrument = Instrument(0.1, readout_noise=4.)
+    return str(tmp_path), rng, model, observation, instrument
+
+
+def test_uniform_and_noise_map(setup):
+    directory, rng, model, observation, instrument = setup
+    noise = UniformGaussianNoise(std_dev=0.3)
+    assert not noise.model_dependent
+    npt.assert_allclose(noise.get_variance_map(observation, instrument), np.full((10, 10), 0.09))
+    sigma = rng.uniform(0.1, 1., size=(10, 10))
+    noise = NoiseMap(_grid(directory, 'sigma', sigma))
+    npt.assert_allclose(noise.get_variance_map(observation, instrument), sigma**2)
+    realization = rng.normal(0., 0.5, size=(10, 10))
+    noise = NoiseRealization(_grid(directory, 'realization', realization))
+    npt.assert_allclose(noise.get_variance_map(observation, instrument), np.var(realization))
+    with pytest.raises(NotImplementedError):
+        Noise().get_variance_map(observation, instrument)
+
+
+def test_instrumental_noise(setup):
+    directory, rng, model, observation, instrument = setup
+    noise = InstrumentalNoise()
+    assert noise.model_dependent
+    with pytest.raises(ValueError):
+        noise.get_variance_map(observation, instrument)  # no model image
+    sky_flux = 10**(-0.4 * (22. - 25.)) * 0.1**2
+    variance_ref = (4. / 100.)**2 + sky_flux / 100. + np.maximum(model, 0) / 100.
+    npt.assert_allclose(noise.get_variance_map(observation, instrument, model_image=model), variance_ref)
+    # stack of model images
+    variance = noise.get_variance_map(observation, instrument, model_image=np.array([model, 2*model]))
+    npt.assert_allclose(variance[0], variance_ref)
+    # exposure map and no target shot noise
+    exposure_map = rng.uniform(50., 150., size=(10, 10))
+    observation.exposure_time = _grid(directory, 'exposure', exposure_map)
+    noise = InstrumentalNoise(with_sky_shot_noise=False, with_target_shot_noise=False)
+    assert not noise.model_dependent
+    npt.assert_allclose(noise.get_variance_map(observation, instrument), (4. / exposure_map)**2)
+    observation.mag_sky_brightness = None
+    with pytest.raises(ValueError):
+        InstrumentalNoise().get_variance_map(observation, instrument, model_image=model)
+
+
+def test_drizzled_noise(setup):
+    directory, rng, model, observation, instrument = setup
+    wht_map = rng.uniform(50., 150., size=(10, 10))
+    wht_map[0, 0] = 0.
+    noise = DrizzledNoise(background_rms=0.2, wht_map=_grid(directory, 'wht', wht_map))
+    assert noise.model_dependent
+    variance = noise.get_variance_map(observation, instrument, model_image=model)
+    npt.assert_allclose(variance[1:, 1:], 0.04 + np.maximum(model, 0)[1:, 1:] / wht_map[1:, 1:])
+    assert variance[0, 0] == np.inf
+    # infinite (not NaN) variance where the model is zero
+    model_zero = model.copy()
+    model_zero[0, 0] = 0.
+    variance = noise.get_variance_map(observation, instrument, model_image=model_zero)
+    assert variance[0, 0] == np.inf